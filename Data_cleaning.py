@@ -1,23 +1,160 @@
 import pandas as pd
 import google.generativeai as genai
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import os
+import time
 from datetime import datetime
 import re
+import json
 import logging
+import threading
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from analysis_cache import AnalysisCache
+from rate_limiter import TokenBucket, call_with_backoff
+from keyword_classifier import CATEGORY_KEYWORDS, DEFAULT_CLASSIFIER
+from local_classifier import CONFIDENCE_THRESHOLD, LocalClassifier
+from near_duplicates import NearDuplicateIndex, identifiers, minhash, personalize
+from body_extraction import prepare_body
+from thread_reduction import reduce_thread
+from metrics import ANALYSES, GEMINI_REQUESTS, STAGE_SECONDS, track_stage
 load_dotenv()
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Bump whenever build_prompt changes so cached analyses from the old prompt are not reused
+PROMPT_VERSION = "2"
+# Concurrency and quota for Gemini calls; match GEMINI_RPM to the API key's requests-per-minute limit
+ANALYSIS_WORKERS = int(os.getenv("analysis_workers", "4"))
+GEMINI_RPM = float(os.getenv("gemini_rpm", "60"))
+# Emails packed into one Gemini request in batch mode (1 = one request per email)
+ANALYSIS_BATCH_SIZE = int(os.getenv("analysis_batch_size", "1"))
+# clean_text: everything except word characters, whitespace and basic punctuation becomes a space
+SPECIAL_CHARACTERS = re.compile(r'[^\w\s@.,-]')
+# Read Gemini responses as a stream so routing fields are available before the actions arrive
+STREAMING_ANALYSIS = os.getenv("analysis_streaming", "false").lower() == "true"
+ROUTING_FIELDS = ("request_type", "category", "priority")
+ACTION_VERBS = ["review", "process", "send", "contact", "verify", "check",
+                "update", "analyze", "schedule", "create", "assign", "escalate"]
+
+# Classification rules shared by the single-email and batch prompts
+CLASSIFICATION_GUIDE = """            1. REQUEST TYPE CLASSIFICATION
+            Identify the SPECIFIC type of request from these categories:
+
+            CLAIMS:
+            - New Claim Submission (accident/injury reports, new claims)
+            - Claim Status Inquiry (following up on existing claims)
+            - Claim Documentation (sending or requesting documents)
+            - Claim Appeal/Dispute (disagreeing with claim decision)
+
+            BILLING:
+            - Premium Payment Issue (payment problems/questions)
+            - Billing Dispute (disagreeing with charges)
+            - Payment Arrangement Request (payment plans)
+            - Refund Request (requesting money back)
+
+            POLICY:
+            - Policy Modification (changes to existing policy)
+            - Policy Cancellation (ending policy)
+            - Coverage Question (questions about what's covered)
+            - New Policy Interest (wanting new policy)
+
+            TECHNICAL:
+            - Portal Access Problem (can't access account)
+            - Login Issues (password/username problems)
+            - Website Technical Error (site not working)
+            - Document Upload Problem (can't upload files)
+
+            2. CATEGORY: Pick the main category that best fits:
+            - Claim
+            - Billing
+            - Policy Update
+            - Technical Support
+            - Other (specify)
+
+            3. RECOMMENDED ACTIONS
+            List 4 specific steps starting with action verbs (e.g., Review, Process, Contact, Verify)
+            Make each step specific to this exact request.
+
+            4. PRIORITY LEVEL
+            High: Accidents, injuries, system-wide technical issues
+            Medium: Billing disputes, regular policy updates
+            Low: Information requests, general questions
+
+"""
+
+# Default recommended actions per request type, used when the LLM returns none
+DEFAULT_ACTIONS = {
+    "New Claim Submission": [
+        "Review claim documentation and validate all required information",
+        "Create new claim record in the system and assign claim number",
+        "Assign appropriate claims handler based on claim type",
+        "Send acknowledgment email with claim number and next steps"
+    ],
+    "Claim Status Inquiry": [
+        "Locate claim in system using customer information",
+        "Review current claim status and recent updates",
+        "Prepare detailed status update for customer",
+        "Send status update with estimated timeline for next steps"
+    ],
+    "Billing Dispute": [
+        "Review billing history and identify disputed charges",
+        "Investigate validity of dispute and calculate any adjustments",
+        "Process necessary corrections or adjustments",
+        "Send detailed explanation of resolution to customer"
+    ],
+    "Policy Cancellation Request": [
+        "Verify policyholder identity and policy details",
+        "Calculate any refunds or outstanding payments",
+        "Process cancellation in system with effective date",
+        "Send confirmation of cancellation with final documentation"
+    ],
+    "Technical Support Request": [
+        "Diagnose specific technical issue from user description",
+        "Attempt basic troubleshooting steps",
+        "Escalate to IT support if necessary",
+        "Follow up with user to confirm resolution"
+    ]
+}
+
+GENERIC_ACTIONS = [
+    "Review customer request details",
+    "Determine appropriate department for handling",
+    "Process request according to standard procedures",
+    "Send confirmation and next steps to customer"
+]
+
 class EmailProcessor:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache: Optional[AnalysisCache] = None,
+                 requests_per_minute: float = GEMINI_RPM, max_retries: int = 5,
+                 local_classifier: Optional[LocalClassifier] = None,
+                 confidence_threshold: float = CONFIDENCE_THRESHOLD,
+                 near_duplicates: Optional[NearDuplicateIndex] = None):
         # Initialize Gemini API
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel('gemini-pro')
         
+        # Shared by all worker threads so concurrent analysis stays within the API quota
+        self.rate_limiter = TokenBucket(requests_per_minute / 60.0, capacity=max(1.0, requests_per_minute / 60.0))
+        self.max_retries = max_retries
+        
+        # Content-addressed cache of analysis results (memory LRU + SQLite)
+        self.cache = cache if cache is not None else AnalysisCache()
+        
+        # Local first tier: confident predictions skip Gemini (train with `python local_classifier.py train`)
+        self.local_classifier = local_classifier if local_classifier is not None else LocalClassifier.load_if_available()
+        self.confidence_threshold = confidence_threshold
+        
+        # Near-copies of analyzed emails reuse their analysis and share a dashboard thread
+        self.near_duplicates = (near_duplicates if near_duplicates is not None
+                                else NearDuplicateIndex(version=PROMPT_VERSION))
+        
+        # Running totals of prompt tokens removed by thread reduction
+        self._stats_lock = threading.Lock()
+        self.thread_reduction_totals = {"emails": 0, "original_tokens": 0, "saved_tokens": 0}
+        
         # Define request types and categories for validation
         self.request_types = {
             "claims": [
@@ -54,15 +191,11 @@ class EmailProcessor:
             ]
         }
         
-        # Keywords for category detection
-        self.category_keywords = {
-            "claim": ["claim", "accident", "damage", "injury", "loss", "medical", "hospital"],
-            "billing": ["bill", "payment", "premium", "charge", "refund", "overcharge", "cost"],
-            "policy_update": ["update", "change", "modify", "cancel", "cancellation"],
-            "premium_inquiry": ["quote", "cost", "price", "rate", "calculation"],
-            "technical_support": ["portal", "website", "login", "technical", "error", "access", "online"]
-        }
+        # Keywords for category detection, compiled once into a single-pass matcher
+        self.category_keywords = CATEGORY_KEYWORDS
+        self.keyword_classifier = DEFAULT_CLASSIFIER
 
+    @track_stage("clean_text")
     def clean_text(self, text: str) -> str:
         """Clean and normalize text data"""
         try:
@@ -73,7 +206,7 @@ class EmailProcessor:
             text = str(text).strip()
             
             # Remove special characters except basic punctuation
-            text = re.sub(r'[^\w\s@.,-]', ' ', text)
+            text = SPECIAL_CHARACTERS.sub(' ', text)
             
             # Remove extra whitespace
             text = ' '.join(text.split())
@@ -83,89 +216,35 @@ class EmailProcessor:
             logger.error(f"Error in clean_text: {str(e)}")
             return ""
 
+    def clean_series(self, texts: pd.Series) -> pd.Series:
+        """clean_text for a whole column at once (non-strings become empty strings)"""
+        # Object dtype keeps Python's Unicode-aware regex; Arrow-backed strings would use RE2,
+        # whose \w and \s are narrower than clean_text's
+        texts = texts.where(texts.map(lambda value: isinstance(value, str)), '').astype(object)
+        return (texts.str.replace(SPECIAL_CHARACTERS, ' ', regex=True)
+                .str.replace(r'\s+', ' ', regex=True)
+                .str.strip())
+
+    def reduce_series(self, bodies: pd.Series) -> pd.Series:
+        """HTML-to-text and thread reduction for a column of raw bodies, as done before cleaning"""
+        reduced = bodies.where(bodies.map(lambda value: isinstance(value, str)), '').map(
+            lambda body: reduce_thread(prepare_body(body))
+        )
+        for _, reduction in reduced:
+            self._record_thread_reduction(reduction)
+        return reduced.str[0]
+
     def determine_request_type(self, subject: str, body: str) -> str:
         """Determine the specific request type based on content"""
-        combined_text = f"{subject} {body}".lower()
-        
-        # Check for claim-related requests
-        if any(word in combined_text for word in ["claim", "accident", "damage", "injury"]):
-            if "status" in combined_text:
-                return "Claim Status Inquiry"
-            return "New Claim Submission"
-            
-        # Check for billing-related requests
-        if any(word in combined_text for word in ["bill", "payment", "charge"]):
-            if "dispute" in combined_text or "overcharge" in combined_text:
-                return "Billing Dispute"
-            return "Premium Payment Request"
-            
-        # Check for policy-related requests
-        if any(word in combined_text for word in ["policy", "coverage"]):
-            if "cancel" in combined_text:
-                return "Policy Cancellation Request"
-            if "update" in combined_text or "change" in combined_text:
-                return "Policy Update Request"
-            return "Policy Information Request"
-            
-        # Check for technical issues
-        if any(word in combined_text for word in ["portal", "login", "technical", "website"]):
-            return "Technical Support Request"
-            
-        return "General Inquiry"
+        return self.keyword_classifier.classify(subject, body)["request_type"]
 
     def get_default_actions(self, request_type: str) -> List[str]:
         """Get default actions based on request type"""
-        default_actions = {
-            "New Claim Submission": [
-                "Review claim documentation and validate all required information",
-                "Create new claim record in the system and assign claim number",
-                "Assign appropriate claims handler based on claim type",
-                "Send acknowledgment email with claim number and next steps"
-            ],
-            "Claim Status Inquiry": [
-                "Locate claim in system using customer information",
-                "Review current claim status and recent updates",
-                "Prepare detailed status update for customer",
-                "Send status update with estimated timeline for next steps"
-            ],
-            "Billing Dispute": [
-                "Review billing history and identify disputed charges",
-                "Investigate validity of dispute and calculate any adjustments",
-                "Process necessary corrections or adjustments",
-                "Send detailed explanation of resolution to customer"
-            ],
-            "Policy Cancellation Request": [
-                "Verify policyholder identity and policy details",
-                "Calculate any refunds or outstanding payments",
-                "Process cancellation in system with effective date",
-                "Send confirmation of cancellation with final documentation"
-            ],
-            "Technical Support Request": [
-                "Diagnose specific technical issue from user description",
-                "Attempt basic troubleshooting steps",
-                "Escalate to IT support if necessary",
-                "Follow up with user to confirm resolution"
-            ]
-        }
-        
-        return default_actions.get(request_type, [
-            "Review customer request details",
-            "Determine appropriate department for handling",
-            "Process request according to standard procedures",
-            "Send confirmation and next steps to customer"
-        ])
-
-    def analyze_email(self, subject: str, body: str) -> Dict:
-        """Analyze email content using Gemini API"""
-        try:
-            # Clean the inputs
-            clean_subject = self.clean_text(subject)
-            clean_body = self.clean_text(body or '')
-            
-            # Determine request type
-            initial_request_type = self.determine_request_type(clean_subject, clean_body)
-            
-            prompt = f"""
+        return list(DEFAULT_ACTIONS.get(request_type, GENERIC_ACTIONS))
+
+    def build_prompt(self, clean_subject: str, clean_body: str) -> str:
+        """Build the Gemini classification prompt for a cleaned email (versioned by PROMPT_VERSION)"""
+        return f"""
             Analyze this insurance-related email and provide a detailed response:
 
             EMAIL CONTENT:
@@ -174,91 +253,389 @@ class EmailProcessor:
 
             TASK: As an insurance service representative, analyze this email and provide specific classification.
 
-            1. REQUEST TYPE CLASSIFICATION
-            Identify the SPECIFIC type of request from these categories:
-
-            CLAIMS:
-            - New Claim Submission (accident/injury reports, new claims)
-            - Claim Status Inquiry (following up on existing claims)
-            - Claim Documentation (sending or requesting documents)
-            - Claim Appeal/Dispute (disagreeing with claim decision)
-
-            BILLING:
-            - Premium Payment Issue (payment problems/questions)
-            - Billing Dispute (disagreeing with charges)
-            - Payment Arrangement Request (payment plans)
-            - Refund Request (requesting money back)
-
-            POLICY:
-            - Policy Modification (changes to existing policy)
-            - Policy Cancellation (ending policy)
-            - Coverage Question (questions about what's covered)
-            - New Policy Interest (wanting new policy)
-
-            TECHNICAL:
-            - Portal Access Problem (can't access account)
-            - Login Issues (password/username problems)
-            - Website Technical Error (site not working)
-            - Document Upload Problem (can't upload files)
-
-            2. CATEGORY: Pick the main category that best fits:
-            - Claim
-            - Billing
-            - Policy Update
-            - Technical Support
-            - Other (specify)
-
-            3. RECOMMENDED ACTIONS
-            List 4 specific steps starting with action verbs (e.g., Review, Process, Contact, Verify)
-            Make each step specific to this exact request.
-
-            4. PRIORITY LEVEL
-            High: Accidents, injuries, system-wide technical issues
-            Medium: Billing disputes, regular policy updates
-            Low: Information requests, general questions
-
-            Format the response EXACTLY as follows:
+{CLASSIFICATION_GUIDE}            Format the response EXACTLY as follows:
             Request Type: [Specific type from above categories] - [Brief description]
             Category: [Main category]
+            Priority: [High/Medium/Low]
             Actions:
             1. [Action verb] [Specific step]
             2. [Action verb] [Specific step]
             3. [Action verb] [Specific step]
             4. [Action verb] [Specific step]
-            Priority: [High/Medium/Low]
             """
+
+    def build_batch_prompt(self, emails: List[Tuple[int, str, str]]) -> str:
+        """Build one prompt for several cleaned (id, subject, body) emails, asking for a JSON array back"""
+        email_blocks = "\n".join(
+            f"""
+            [EMAIL ID {email_id}]
+            Subject: {clean_subject}
+            Body: {clean_body}
+"""
+            for email_id, clean_subject, clean_body in emails
+        )
+        return f"""
+            Analyze each of these insurance-related emails and provide a classification for EVERY email:
+{email_blocks}
+            TASK: As an insurance service representative, classify each email above independently.
+
+{CLASSIFICATION_GUIDE}            Respond with ONLY a JSON array containing one object per email, in this exact shape:
+            [{{"id": <EMAIL ID>, "request_type": "<Specific type from above categories> - <Brief description>",
+              "category": "<Main category>", "actions": ["<Action verb> <Specific step>", "...4 steps"],
+              "priority": "High|Medium|Low"}}]
+            """
+
+    def _generate_content(self, prompt: str, stream: bool = False):
+        """Call Gemini under the rate limiter, backing off on 429/5xx errors (stream=True returns chunks)"""
+        def _call():
+            self.rate_limiter.acquire()
+            try:
+                # Timed after the rate limiter so this is the API's own latency (to the first chunk when streaming)
+                with STAGE_SECONDS.time(stage="gemini_request"):
+                    if stream:
+                        response = self.model.generate_content(prompt, stream=True)
+                    else:
+                        response = self.model.generate_content(prompt)
+            except Exception:
+                GEMINI_REQUESTS.inc(outcome="error")
+                raise
+            GEMINI_REQUESTS.inc(outcome="ok")
+            return response
+        return call_with_backoff(_call, max_retries=self.max_retries)
+
+    def _prepare_analysis(self, subject: str, body: str, cleaned: bool = False) -> Dict:
+        """
+        Clean an email and resolve it without the LLM when possible (cache hit, near-duplicate or
+        confident local model)
+
+        With cleaned=True, subject and body are already the output of clean_series/reduce_series.
+        """
+        if cleaned:
+            clean_subject, clean_body = subject, body
+        else:
+            # Clean the inputs; HTML bodies are reduced to capped plain text first, then quoted
+            # history, signatures and legal footers are dropped so only the newest content remains
+            clean_subject = self.clean_text(subject)
+            reduced_body, reduction = reduce_thread(prepare_body(body or ''))
+            self._record_thread_reduction(reduction)
+            clean_body = self.clean_text(reduced_body)
+        
+        prepared = {
+            "clean_subject": clean_subject,
+            "clean_body": clean_body,
+            # Single keyword scan gives the fallback request type, category and priority hint
+            "keyword_hint": self.keyword_classifier.classify(clean_subject, clean_body),
+            # Identical emails (forwards, resends, replays) reuse the earlier analysis
+            "cache_key": AnalysisCache.make_key(clean_subject, clean_body, PROMPT_VERSION),
+            "local_prediction": None,
+            "result": None
+        }
+        
+        result = self.cache.get(prepared["cache_key"])
+        if result is not None:
+            ANALYSES.inc(path="cache")
+            # The thread of identical content is a plain lookup; only entries cached before
+            # the index existed need the near-duplicate search
+            thread_id = self.near_duplicates.thread_of(prepared["cache_key"])
+            if thread_id is None:
+                self._find_near_duplicate(prepared)
+                prepared["result"] = self._record_analysis(result, prepared, "cache")
+            else:
+                prepared["result"] = dict(result, thread_id=thread_id, analysis_source="cache")
+            return prepared
+        
+        match = self._find_near_duplicate(prepared)
+        if prepared["near_duplicate"]:
+            result = personalize(match["analysis"], match["identifiers"],
+                                 identifiers(f"{clean_subject} {clean_body}"))
+            self.cache.put(prepared["cache_key"], result)
+            self.near_duplicates.record_reuse(prepared["cache_key"], prepared["thread_id"])
+            ANALYSES.inc(path="near_duplicate")
+            prepared["result"] = dict(result, thread_id=prepared["thread_id"], analysis_source="near_duplicate")
+            return prepared
+        
+        # Obvious emails are classified locally; only ambiguous ones go to the LLM
+        if self.local_classifier is not None:
+            local_prediction = self.local_classifier.predict(clean_subject, clean_body)
+            prepared["local_prediction"] = local_prediction
+            if local_prediction["confidence"] >= self.confidence_threshold:
+                prepared["result"] = self._record_analysis({
+                    "request_type": local_prediction["request_type"],
+                    "category": local_prediction["category"],
+                    "actions": self.get_default_actions(local_prediction["request_type"]),
+                    "priority": local_prediction["priority"]
+                }, prepared, "local")
+                ANALYSES.inc(path="local")
+        return prepared
+
+    def _find_near_duplicate(self, prepared: Dict) -> Optional[Dict]:
+        """Closest earlier email with similar content: same thread, and its analysis if close enough"""
+        prepared["signature"] = minhash(f"{prepared['clean_subject']} {prepared['clean_body']}")
+        match = self.near_duplicates.find(prepared["signature"])
+        prepared["near_duplicate"] = match is not None and match["similarity"] >= self.near_duplicates.reuse_threshold
+        prepared["thread_id"] = match["thread_id"] if match else NearDuplicateIndex.new_thread_id()
+        return match
+
+    def _record_analysis(self, result: Dict, prepared: Dict, source: str) -> Dict:
+        """
+        Index a newly analyzed email for near-duplicate reuse and tag the result with its thread
+        and the path that produced it (stored, so only LLM answers are used to train the local model)
+        """
+        if not prepared["near_duplicate"]:
+            self.near_duplicates.add(prepared["signature"], result,
+                                     identifiers(f"{prepared['clean_subject']} {prepared['clean_body']}"),
+                                     prepared["thread_id"], key=prepared["cache_key"])
+        else:
+            self.near_duplicates.remember_thread(prepared["cache_key"], prepared["thread_id"])
+        return dict(result, thread_id=prepared["thread_id"], analysis_source=source)
+
+    def _record_thread_reduction(self, reduction: Dict[str, int]) -> None:
+        """Log the per-email token savings of thread reduction and keep running totals"""
+        with self._stats_lock:
+            self.thread_reduction_totals["emails"] += 1
+            self.thread_reduction_totals["original_tokens"] += reduction["original_tokens"]
+            self.thread_reduction_totals["saved_tokens"] += reduction["saved_tokens"]
+        if reduction["saved_tokens"] > 0:
+            logger.info(
+                f"Thread reduction saved ~{reduction['saved_tokens']} of "
+                f"{reduction['original_tokens']} body tokens"
+            )
+
+    def _finalize_analysis(self, parsed_response: Dict, prepared: Dict) -> Dict:
+        """Fill gaps in a parsed LLM result, then record and cache it"""
+        # If no request type was determined, use the initial determination
+        if parsed_response["request_type"] == "Unknown":
+            parsed_response["request_type"] = prepared["keyword_hint"]["request_type"]
+        
+        # Get default actions if none were parsed
+        if not parsed_response["actions"]:
+            parsed_response["actions"] = self.get_default_actions(parsed_response["request_type"])
+        
+        if prepared["local_prediction"] is not None:
+            self.local_classifier.record_agreement(prepared["local_prediction"], parsed_response)
+        
+        self.cache.put(prepared["cache_key"], parsed_response)
+        ANALYSES.inc(path="llm")
+        return self._record_analysis(parsed_response, prepared, "llm")
+
+    def _fallback_analysis(self, subject: str, body: str, prepared: Optional[Dict]) -> Dict:
+        """Keyword-based analysis used when the LLM path fails"""
+        keyword_hint = prepared["keyword_hint"] if prepared else self.keyword_classifier.classify(
+            str(subject or ''), str(body or '')
+        )
+        ANALYSES.inc(path="fallback")
+        return {
+            "request_type": keyword_hint["request_type"],
+            "category": keyword_hint["category"],
+            "actions": self.get_default_actions(keyword_hint["request_type"]),
+            "priority": keyword_hint["priority"],
+            "thread_id": prepared.get("thread_id") if prepared else None,
+            "analysis_source": "fallback"
+        }
+
+    @track_stage("analyze_email")
+    def analyze_email(self, subject: str, body: str, cleaned: bool = False) -> Dict:
+        """Analyze email content using Gemini API (cleaned=True for pre-cleaned subject/body)"""
+        prepared = None
+        try:
+            prepared = self._prepare_analysis(subject, body, cleaned)
+            if prepared["result"] is not None:
+                return prepared["result"]
             
-            response = self.model.generate_content(prompt)
-            parsed_response = self._parse_gemini_response(response.text)
+            prompt = self.build_prompt(prepared["clean_subject"], prepared["clean_body"])
             
-            # If no request type was determined, use the initial determination
-            if parsed_response["request_type"] == "Unknown":
-                parsed_response["request_type"] = initial_request_type
+            response = self._generate_content(prompt)
+            return self._finalize_analysis(self._parse_gemini_response(response.text), prepared)
             
-            # Get default actions if none were parsed
-            if not parsed_response["actions"]:
-                parsed_response["actions"] = self.get_default_actions(parsed_response["request_type"])
+        except Exception as e:
+            logger.error(f"Error in analyze_email: {str(e)}")
+            return self._fallback_analysis(subject, body, prepared)
+
+    @track_stage("analyze_email")
+    def analyze_email_streaming(self, subject: str, body: str,
+                                on_partial: Optional[Callable[[Dict], None]] = None,
+                                cleaned: bool = False) -> Dict:
+        """
+        analyze_email with the Gemini response read as a stream.
+
+        on_partial(fields) is called each time request_type, category or priority first
+        appears, with every routing field known so far, so routing and High priority
+        alerting can start while the actions are still being generated. The returned
+        analysis is the same as analyze_email's.
+        """
+        prepared = None
+        try:
+            prepared = self._prepare_analysis(subject, body, cleaned)
+            if prepared["result"] is not None:
+                self._emit_partial(on_partial, {field: prepared["result"][field] for field in ROUTING_FIELDS})
+                return prepared["result"]
             
-            return parsed_response
+            prompt = self.build_prompt(prepared["clean_subject"], prepared["clean_body"])
+            started = time.perf_counter()
+            parser = StreamingResponseParser(self)
+            for chunk in self._generate_content(prompt, stream=True):
+                if parser.feed(chunk.text):
+                    if parser.routing_complete:
+                        STAGE_SECONDS.observe(time.perf_counter() - started, stage="routing_decision")
+                    self._emit_partial(on_partial, dict(parser.routing))
+            return self._finalize_analysis(self._parse_gemini_response(parser.text), prepared)
             
         except Exception as e:
-            logger.error(f"Error in analyze_email: {str(e)}")
-            return {
-                "request_type": initial_request_type,
-                "category": self.determine_category(clean_subject, clean_body),
-                "actions": self.get_default_actions(initial_request_type),
-                "priority": "Medium"
-            }
+            logger.error(f"Error in analyze_email_streaming: {str(e)}")
+            return self._fallback_analysis(subject, body, prepared)
+
+    def _emit_partial(self, on_partial: Optional[Callable[[Dict], None]], fields: Dict) -> None:
+        """Hand early routing fields to the caller; its failures never abort the analysis"""
+        if on_partial is None:
+            return
+        try:
+            on_partial(fields)
+        except Exception as e:
+            logger.error(f"Error handling partial analysis: {str(e)}")
+
+    @track_stage("analyze_batch")
+    def analyze_emails_batch(self, emails: List[Tuple[str, str]], batch_size: int = ANALYSIS_BATCH_SIZE,
+                             max_workers: int = ANALYSIS_WORKERS, cleaned: bool = False) -> List[Dict]:
+        """
+        Analyze (subject, body) pairs with several emails packed into each Gemini request.
+
+        Cache hits and confident local predictions are resolved first. The rest are sent in
+        groups of `batch_size` with a JSON-array response format; items that come back
+        missing or invalid are retried one at a time through analyze_email. Results are
+        returned in input order.
+        """
+        results = [None] * len(emails)
+        pending = []
+        for index, (subject, body) in enumerate(emails):
+            try:
+                prepared = self._prepare_analysis(subject, body, cleaned)
+            except Exception as e:
+                logger.error(f"Error preparing email {index} for batch analysis: {str(e)}")
+                continue
+            if prepared["result"] is not None:
+                results[index] = prepared["result"]
+            else:
+                pending.append((index, prepared))
+        
+        groups = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        
+        def _analyze_group(group):
+            try:
+                prompt = self.build_batch_prompt(
+                    [(index, prepared["clean_subject"], prepared["clean_body"]) for index, prepared in group]
+                )
+                response = self._generate_content(prompt)
+                parsed_items = self._parse_gemini_json_response(response.text)
+            except Exception as e:
+                logger.error(f"Error in batch analysis of {len(group)} emails: {str(e)}")
+                parsed_items = {}
+            for index, prepared in group:
+                if index in parsed_items:
+                    results[index] = self._finalize_analysis(parsed_items[index], prepared)
+        
+        if max_workers <= 1 or len(groups) <= 1:
+            for group in groups:
+                _analyze_group(group)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(_analyze_group, groups))
+        
+        # Anything the batch did not answer properly is analyzed on its own
+        retry = [index for index, result in enumerate(results) if result is None]
+        if retry:
+            logger.info(f"Retrying {len(retry)} of {len(emails)} emails individually")
+            for index in retry:
+                results[index] = self.analyze_email(*emails[index], cleaned=cleaned)
+        return results
+
+    def analyze_emails_concurrently(self, emails: List[Tuple[str, str]],
+                                    max_workers: int = ANALYSIS_WORKERS, cleaned: bool = False) -> List[Dict]:
+        """
+        Analyze (subject, body) pairs on a thread pool.
+
+        Results are returned in input order; the shared token bucket keeps the pool
+        inside the Gemini quota.
+        """
+        if max_workers <= 1 or len(emails) <= 1:
+            return [self.analyze_email(subject, body, cleaned) for subject, body in emails]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda pair: self.analyze_email(*pair, cleaned=cleaned), emails))
+
+    def analyze_emails(self, emails: List[Tuple[str, str]], max_workers: int = ANALYSIS_WORKERS,
+                       batch_size: int = ANALYSIS_BATCH_SIZE, cleaned: bool = False) -> List[Dict]:
+        """Analyze many emails in input order, using multi-email prompts when batch_size > 1"""
+        if batch_size > 1:
+            return self.analyze_emails_batch(emails, batch_size, max_workers, cleaned)
+        return self.analyze_emails_concurrently(emails, max_workers, cleaned)
 
     def determine_category(self, subject: str, body: str) -> str:
         """Determine the main category based on content"""
-        combined_text = f"{subject} {body}".lower()
+        return self.keyword_classifier.classify(subject, body)["category"]
+
+    def _validate_json_analysis(self, item: Dict) -> Optional[Dict]:
+        """Validate one JSON analysis object; returns the normalized result or None if unusable"""
+        if not isinstance(item, dict):
+            return None
+        request_type = item.get("request_type")
+        category = item.get("category")
+        priority = str(item.get("priority", "")).strip().lower()
+        actions = item.get("actions", [])
+        if not isinstance(request_type, str) or not request_type.strip():
+            return None
+        if not isinstance(category, str) or not category.strip():
+            return None
+        if priority not in ["high", "medium", "low"] or not isinstance(actions, list):
+            return None
         
-        for category, keywords in self.category_keywords.items():
-            if any(keyword in combined_text for keyword in keywords):
-                return category.replace('_', ' ').title()
+        request_type = request_type.strip()
+        # Ensure we have both type and description
+        if ' - ' not in request_type:
+            request_type = f"{request_type} - General Request"
+        return {
+            "request_type": request_type,
+            "category": category.strip().title(),
+            "actions": [str(action).strip() for action in actions if str(action).strip()],
+            "priority": priority.capitalize()
+        }
+
+    def _extract_json(self, response: str):
+        """Decode a JSON document from a response, tolerating ```json fences and surrounding prose"""
+        text = response.strip()
+        fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+        if fenced:
+            text = fenced.group(1).strip()
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+        for opener, closer in (("[", "]"), ("{", "}")):
+            start, end = text.find(opener), text.rfind(closer)
+            if start != -1 and end > start:
+                try:
+                    return json.loads(text[start:end + 1])
+                except ValueError:
+                    continue
+        return None
+
+    def _parse_gemini_json_response(self, response: str) -> Dict[int, Dict]:
+        """Parse a batch response (JSON array of analyses with ids) into {id: result}, skipping invalid items"""
+        data = self._extract_json(response)
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list):
+            logger.warning("Batch response was not a JSON array")
+            return {}
         
-        return "Other"
+        parsed = {}
+        for item in data:
+            try:
+                email_id = int(item.get("id"))
+            except (AttributeError, TypeError, ValueError):
+                continue
+            result = self._validate_json_analysis(item)
+            if result is not None:
+                parsed[email_id] = result
+        return parsed
 
     def _parse_gemini_response(self, response: str) -> Dict:
         """Parse the Gemini API response with enhanced extraction"""
@@ -269,35 +646,15 @@ class EmailProcessor:
             "priority": "Medium"
         }
         
+        # Strict path: a JSON object with the expected fields
+        if response.lstrip().startswith(("{", "```")):
+            result = self._validate_json_analysis(self._extract_json(response))
+            if result is not None:
+                return result
+        
         try:
-            lines = response.split('\n')
-            action_verbs = ["review", "process", "send", "contact", "verify", "check", 
-                          "update", "analyze", "schedule", "create", "assign", "escalate"]
-            
-            for line in lines:
-                line = line.strip()
-                
-                if line.lower().startswith("request type:"):
-                    request_type = line.split(":", 1)[1].strip()
-                    # Ensure we have both type and description
-                    if ' - ' in request_type:
-                        parsed_data["request_type"] = request_type
-                    else:
-                        parsed_data["request_type"] = f"{request_type} - General Request"
-                
-                elif line.lower().startswith("category:"):
-                    category = line.split(":", 1)[1].strip()
-                    parsed_data["category"] = category.title()
-                
-                elif line.lower().startswith("priority:"):
-                    priority = line.split(":", 1)[1].strip().lower()
-                    if priority in ["high", "medium", "low"]:
-                        parsed_data["priority"] = priority.capitalize()
-                
-                elif line[0].isdigit() and "." in line:
-                    action = line.split(".", 1)[1].strip()
-                    if any(action.lower().startswith(verb) for verb in action_verbs):
-                        parsed_data["actions"].append(action)
+            for line in response.split('\n'):
+                self._parse_response_line(line, parsed_data)
             
             return parsed_data
             
@@ -305,57 +662,138 @@ class EmailProcessor:
             logger.error(f"Error in _parse_gemini_response: {str(e)}")
             return parsed_data
 
-    def process_emails(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Process all emails in the DataFrame"""
-        results = []
+    def _parse_response_line(self, line: str, parsed_data: Dict) -> Optional[str]:
+        """Apply one line of the text response format to parsed_data; returns the field it set"""
+        line = line.strip()
+        
+        if line.lower().startswith("request type:"):
+            request_type = line.split(":", 1)[1].strip()
+            # Ensure we have both type and description
+            if ' - ' in request_type:
+                parsed_data["request_type"] = request_type
+            else:
+                parsed_data["request_type"] = f"{request_type} - General Request"
+            return "request_type"
+        
+        elif line.lower().startswith("category:"):
+            category = line.split(":", 1)[1].strip()
+            parsed_data["category"] = category.title()
+            return "category"
         
+        elif line.lower().startswith("priority:"):
+            priority = line.split(":", 1)[1].strip().lower()
+            if priority in ["high", "medium", "low"]:
+                parsed_data["priority"] = priority.capitalize()
+                return "priority"
+        
+        elif line and line[0].isdigit() and "." in line:
+            action = line.split(".", 1)[1].strip()
+            if any(action.lower().startswith(verb) for verb in ACTION_VERBS):
+                parsed_data["actions"].append(action)
+                return "actions"
+        return None
+
+    def analyze_frame(self, df: pd.DataFrame, max_workers: int = ANALYSIS_WORKERS,
+                      batch_size: int = ANALYSIS_BATCH_SIZE) -> pd.DataFrame:
+        """
+        Analyze a DataFrame of emails (date, from, subject, body) into result rows.
+
+        Subjects and bodies are cleaned column-wise, and the result frame is assembled from
+        columns rather than row by row. Errors propagate, so a caller processing chunks
+        can decide what to keep.
+        """
+        bodies = df['body'] if 'body' in df else pd.Series('', index=df.index)
+        clean_subjects = self.clean_series(df['subject'])
+        clean_bodies = self.clean_series(self.reduce_series(bodies))
+        analyses = pd.DataFrame(
+            self.analyze_emails(list(zip(clean_subjects, clean_bodies)), max_workers, batch_size, cleaned=True),
+            index=df.index,
+            columns=['request_type', 'category', 'actions', 'priority', 'thread_id', 'analysis_source']
+        )
+        return pd.DataFrame({
+            'date': df['date'],
+            'from': df['from'],
+            'subject': df['subject'],
+            'body': df['body'] if 'body' in df else 'No body content',
+            'request_type': analyses['request_type'],
+            'category': analyses['category'],
+            'actions': analyses['actions'].map('\n'.join),
+            'priority': analyses['priority'],
+            'processed_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'thread_id': analyses['thread_id'],
+            'analysis_source': analyses['analysis_source']
+        }).reset_index(drop=True)
+
+    def log_stats(self) -> None:
+        """Log cache, near-duplicate, thread-reduction and local-classifier statistics for the run so far"""
+        logger.info(f"Analysis cache stats: {self.cache.stats()}")
+        logger.info(f"Near-duplicate index stats: {self.near_duplicates.stats()}")
+        logger.info(f"Thread reduction totals: {self.thread_reduction_totals}")
+        if self.local_classifier is not None:
+            logger.info(f"Local classifier agreement with LLM: {self.local_classifier.agreement_stats()}")
+
+    def process_emails(self, df: pd.DataFrame, max_workers: int = ANALYSIS_WORKERS,
+                       batch_size: int = ANALYSIS_BATCH_SIZE) -> pd.DataFrame:
+        """Process all emails in the DataFrame"""
         try:
-            total_emails = len(df)
-            for index, row in df.iterrows():
-                logger.info(f"Processing email {index + 1} of {total_emails}")
-                
-                analysis = self.analyze_email(row['subject'], row.get('body', ''))
-                
-                result = {
-                    'date': row['date'],
-                    'from': row['from'],
-                    'subject': row['subject'],
-                    'body': row.get('body', 'No body content'),
-                    'request_type': analysis.get('request_type'),
-                    'category': analysis.get('category'),
-                    'actions': '\n'.join(analysis.get('actions', [])),
-                    'priority': analysis.get('priority'),
-                    'processed_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                }
-                results.append(result)
-                
-            return pd.DataFrame(results)
+            logger.info(f"Processing {len(df)} emails with {max_workers} workers")
+            results = self.analyze_frame(df, max_workers, batch_size)
+            self.log_stats()
+            return results
         
         except Exception as e:
             logger.error(f"Error in process_emails: {str(e)}")
             return pd.DataFrame()
 
-def main():
-    try:
-        # Load your email data
-        df = pd.read_excel("sample data.xlsx")
-        
-        # Initialize processor with your API key
-        api_key = os.getenv("gemini_api") # Replace with actual API key
-        processor = EmailProcessor(api_key)
-        
-        # Process emails
-        results_df = processor.process_emails(df)
-        
-        # Save results
-        output_file = 'processed_emails.csv'
-        results_df.to_csv(output_file, index=False)
-        logger.info(f"Results saved to {output_file}")
-        print("\nProcessed Results:")
-        print(results_df)
+class StreamingResponseParser:
+    """
+    Parses a streamed Gemini response line by line as chunks arrive.
+
+    Only the text response format is parsed incrementally; a response that turns out to
+    be JSON is left to the final _parse_gemini_response over the full text.
+    """
+
+    def __init__(self, processor: EmailProcessor):
+        self.processor = processor
+        self.routing = {}
+        self._chunks = []
+        self._buffer = ""
+        self._parsed = {"request_type": "Unknown", "category": "Unknown", "actions": [], "priority": "Medium"}
+        self._is_json = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    @property
+    def routing_complete(self) -> bool:
+        return len(self.routing) == len(ROUTING_FIELDS)
+
+    def feed(self, text: str) -> bool:
+        """Add a chunk; True if it completed a line with a routing field not seen before."""
+        self._chunks.append(text)
+        if self._is_json is None:
+            start = self.text.lstrip()
+            if not start:
+                return False
+            self._is_json = start.startswith(("{", "```"))
+        if self._is_json:
+            return False
         
-    except Exception as e:
-        logger.error(f"Error in main: {str(e)}")
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split('\n')
+        found = False
+        for line in lines:
+            field = self.processor._parse_response_line(line, self._parsed)
+            if field in ROUTING_FIELDS and field not in self.routing:
+                self.routing[field] = self._parsed[field]
+                found = True
+        return found
+
+def main():
+    # Chunked and resumable; see batch_processing.py for input/output paths and chunk size
+    from batch_processing import main as batch_main
+    batch_main([])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
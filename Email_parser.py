@@ -1,82 +1,406 @@
 import imaplib
 import email
-from email.header import decode_header
+from email.header import decode_header, make_header
+from email.utils import parsedate_to_datetime
 import pandas as pd
-from datetime import datetime
-import time
+from datetime import datetime, timezone
 import os
+import re
+import json
+import binascii
+import quopri
+import time
 from dotenv import load_dotenv
+from imap_idle import MailWatcher
+from body_extraction import decode_payload, prepare_body, extract_body
+from metrics import EMAILS_FETCHED, new_trace_id, track_stage
 load_dotenv()
 # Email configuration
 IMAP_SERVER = "imap.gmail.com"  # Replace with your email provider's IMAP server
 EMAIL = os.getenv("user_email")
 PASSWORD = os.getenv("password")
+# Last-seen UID per mailbox, so each poll only downloads mail that is actually new
+UID_STATE_FILE = "uid_state.json"
+# "bulk" fetches headers + BODYSTRUCTURE for all new UIDs in one command and then only
+# the first text part (capped at BODY_BYTE_CAP bytes); "full" downloads each RFC822 message
+FETCH_MODE = os.getenv("fetch_mode", "bulk")
+BODY_BYTE_CAP = int(os.getenv("body_byte_cap", "16384"))
+FETCH_BATCH_SIZE = 500  # UIDs per FETCH command, keeps command lines a sane length
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)]"
 
-def connect_to_email():
-    """Connect to the email server and select the inbox."""
+def connect_to_email(server=None, user=None, password=None, mailbox="inbox", timeout=None):
+    """Connect to the email server and select a mailbox (defaults to the account from .env)."""
     try:
         # Connect to the IMAP server
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(EMAIL, PASSWORD)
-        mail.select("inbox")  # Select the inbox folder
+        mail = imaplib.IMAP4_SSL(server or IMAP_SERVER)
+        if timeout:
+            # Reads on a silently dropped connection fail instead of blocking forever
+            mail.sock.settimeout(timeout)
+        mail.login(user or EMAIL, password or PASSWORD)
+        mail.select(mailbox)  # Select the folder to read
         return mail
     except Exception as e:
         print(f"Failed to connect to the email server: {e}")
         return None
 
-def fetch_incoming_emails(mail):
-    """Fetch all incoming emails from the inbox."""
-    emails = []
+def mailbox_key(mailbox="inbox", account=None):
+    """Key used to track UID state for one mailbox of one account."""
+    return f"{account or EMAIL}:{mailbox}"
+
+def load_uid_state(path=UID_STATE_FILE):
+    """Load the persisted UIDVALIDITY / last-seen UID watermarks."""
     try:
-        # Use the "SINCE" filter with the current date to fetch new emails
-        today = datetime.now().strftime("%d-%b-%Y")  # e.g., "17-Nov-2024"
-        status, messages = mail.search(None, f"SINCE {today}")
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Failed to load UID state from {path}: {e}")
+        return {}
+
+def save_uid_state(state, path=UID_STATE_FILE):
+    """Persist the UID watermarks, replacing the file atomically."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+def select_mailbox(mail, mailbox="inbox"):
+    """Select a mailbox and return its (UIDVALIDITY, UIDNEXT) as ints (None if not reported)."""
+    status, _ = mail.select(mailbox)
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"Failed to select mailbox {mailbox}")
+
+    def _response_int(name):
+        _, data = mail.response(name)
+        if data and data[-1] is not None:
+            value = data[-1].decode() if isinstance(data[-1], bytes) else str(data[-1])
+            return int(value.split()[0])
+        return None
+
+    return _response_int("UIDVALIDITY"), _response_int("UIDNEXT")
+
+def decode_subject(value):
+    """Decode every RFC 2047 chunk of a Subject header in its own charset."""
+    value = str(value or "")
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, UnicodeDecodeError, email.errors.HeaderParseError):
+        # Unknown charset or broken encoding: keep the header as sent rather than lose the email
+        return value
+
+def parse_email_headers(msg):
+    """Extract date, subject and sender from a parsed email message."""
+    subject = decode_subject(msg["Subject"])
+    from_ = msg.get("From")
+
+    # Any RFC 5322 date (weekday optional); "-0000" means UTC with no local zone known
+    date = parsedate_to_datetime(msg.get("Date"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    date = date.astimezone().strftime('%Y-%m-%d %H:%M:%S')
+
+    return {"date": date, "subject": subject, "from": from_}
+
+def parse_email_message(msg):
+    """Extract date, subject, sender and body from a parsed email message."""
+    email_data = parse_email_headers(msg)
+
+    # Extract a bounded plain-text body (HTML reduced to text, attachments never decoded);
+    # its line breaks are kept so thread reduction can find quotes and signatures
+    email_data["body"] = "\n".join(extract_body(msg).splitlines()).strip()
+    return email_data
+
+def flatten_body(body):
+    """Join a body's lines so it is stored in a single cell."""
+    return " ".join(str(body or "").splitlines()).strip()
+
+def compress_uid_set(uids):
+    """Turn a list of UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7] -> "1:3,7"."""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+_IMAP_TOKEN = re.compile(rb'''
+    \s*(?:
+        (?P<open>\() | (?P<close>\)) |
+        "(?P<quoted>(?:[^"\\]|\\.)*)" |
+        \{(?P<literal>\d+)\}$ |
+        (?P<atom>(?:[^\s()\[\]"]+|\[[^\]]*\])+)
+    )''', re.VERBOSE)
+
+def _tokenize_fetch_data(data):
+    """Yield tokens from imaplib FETCH data, substituting literals in place of {n} markers."""
+    for item in data:
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        if not text:
+            continue
+        pos = 0
+        while pos < len(text):
+            match = _IMAP_TOKEN.match(text, pos)
+            if not match or match.end() == pos:
+                break
+            pos = match.end()
+            if match.group("open"):
+                yield "("
+            elif match.group("close"):
+                yield ")"
+            elif match.group("quoted") is not None:
+                yield re.sub(rb"\\(.)", rb"\1", match.group("quoted")).decode(errors="replace")
+            elif match.group("literal") is not None:
+                yield literal if literal is not None else b""
+            else:
+                atom = match.group("atom").decode(errors="replace")
+                yield None if atom.upper() == "NIL" else atom
+
+def parse_fetch_response(data):
+    """Parse UID FETCH data into {uid: {ITEM-NAME: value}}; lists become nested Python lists."""
+    root = []
+    stack = [root]
+    for token in _tokenize_fetch_data(data):
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        else:
+            stack[-1].append(token)
+
+    messages = {}
+    for entry in root:
+        if not isinstance(entry, list):
+            continue  # message sequence numbers
+        items = {}
+        for name, value in zip(entry[0::2], entry[1::2]):
+            if isinstance(name, str):
+                items[name.upper()] = value
+        if "UID" in items:
+            messages.setdefault(int(items["UID"]), {}).update(items)
+    return messages
+
+def _structure_params(params):
+    """Convert a BODYSTRUCTURE parameter list into a dict with lower-case keys."""
+    if not isinstance(params, list):
+        return {}
+    return {str(k).lower(): v for k, v in zip(params[0::2], params[1::2])}
+
+def find_text_part(structure, prefix=""):
+    """
+    Locate the body part to download from a BODYSTRUCTURE.
+
+    Returns (part_number, subtype, charset, encoding) or None. Multipart messages yield the
+    first non-attachment text/plain part, or text/html when there is no plain part;
+    single-part messages yield their only part.
+    """
+    if not isinstance(structure, list) or not structure:
+        return None
+
+    if isinstance(structure[0], list):
+        # Multipart: child parts come first, then the subtype string
+        html_part = None
+        for index, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                break
+            found = find_text_part(child, f"{prefix}{index}.")
+            if found and found[1] == "plain":
+                return found
+            if found and found[1] == "html" and html_part is None:
+                html_part = found
+        return html_part
+
+    media_type = str(structure[0]).lower()
+    subtype = str(structure[1]).lower()
+    params = _structure_params(structure[2])
+    encoding = str(structure[5] or "7bit").lower()
+    # text parts carry a line count before the extension data
+    disposition = structure[9] if media_type == "text" and len(structure) > 9 else None
+    is_attachment = isinstance(disposition, list) and str(disposition[0]).lower() == "attachment"
+    if not prefix:
+        return ("1", subtype, params.get("charset"), encoding)
+    if media_type == "text" and subtype in ("plain", "html") and not is_attachment:
+        return (prefix.rstrip("."), subtype, params.get("charset"), encoding)
+    return None
+
+def decode_partial_body(raw, encoding, charset):
+    """Decode a (possibly truncated) body part fetched with a byte cap."""
+    if encoding == "base64":
+        compact = re.sub(rb"\s+", b"", raw)
+        compact = compact[:len(compact) - len(compact) % 4]
+        try:
+            raw = binascii.a2b_base64(compact)
+        except binascii.Error:
+            raw = b""
+    elif encoding == "quoted-printable":
+        raw = quopri.decodestring(raw)
+    return decode_payload(raw, charset)
+
+def bulk_fetch_emails(mail, uids, body_byte_cap=BODY_BYTE_CAP):
+    """
+    Fetch new emails with pipelined UID FETCH commands instead of one RFC822 round trip each.
+
+    Headers and BODYSTRUCTURE for a whole UID batch come back in a single command, then the
+    chosen text parts are pulled with BODY.PEEK[part]<0.cap>, grouped by part number.
+    """
+    emails = []
+    for start in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[start:start + FETCH_BATCH_SIZE]
+        status, data = mail.uid("fetch", compress_uid_set(batch), f"(UID {HEADER_FIELDS} BODYSTRUCTURE)")
         if status != "OK":
-            print("Failed to retrieve incoming emails.")
-            return emails
-
-        # Fetch email data
-        email_ids = messages[0].split()
-        for email_id in email_ids:
-            # Fetch the email by ID
-            status, msg_data = mail.fetch(email_id, "(RFC822)")
+            raise imaplib.IMAP4.error(f"Failed to fetch headers for UIDs {compress_uid_set(batch)}")
+        headers = parse_fetch_response(data)
+
+        # Group UIDs by the body part they need so each part number costs one command
+        parts_by_spec = {}
+        text_parts = {}
+        for uid, items in headers.items():
+            text_part = find_text_part(items.get("BODYSTRUCTURE"))
+            if text_part:
+                text_parts[uid] = text_part
+                parts_by_spec.setdefault(text_part[0], []).append(uid)
+
+        bodies = {}
+        for part_number, part_uids in parts_by_spec.items():
+            status, data = mail.uid(
+                "fetch", compress_uid_set(part_uids), f"(UID BODY.PEEK[{part_number}]<0.{body_byte_cap}>)"
+            )
             if status != "OK":
-                print(f"Failed to fetch email ID {email_id.decode()}")
+                raise imaplib.IMAP4.error(f"Failed to fetch body part {part_number}")
+            for uid, items in parse_fetch_response(data).items():
+                for name, value in items.items():
+                    if name.startswith("BODY[") and isinstance(value, bytes):
+                        _, subtype, charset, encoding = text_parts[uid]
+                        bodies[uid] = prepare_body(
+                            decode_partial_body(value, encoding, charset), is_html=subtype == "html"
+                        )
+
+        for uid in batch:
+            items = headers.get(uid)
+            if not items:
                 continue
+            header_bytes = next(
+                (v for k, v in items.items() if k.startswith("BODY[HEADER") and isinstance(v, bytes)), b""
+            )
+            try:
+                email_data = parse_email_headers(email.message_from_bytes(header_bytes))
+            except Exception as e:
+                print(f"Skipping unparseable email UID {uid}: {e}")
+                continue
+            email_data["body"] = "\n".join(bodies.get(uid, "").splitlines()).strip()
+            email_data["uid"] = uid
+            emails.append(email_data)
+    return emails
+
+def search_new_uids(mail, entry, uidvalidity):
+    """Return the UIDs above the stored watermark, or today's UIDs on a first sync."""
+    if entry and entry.get("uidvalidity") == uidvalidity:
+        last_uid = entry.get("last_uid", 0)
+        status, data = mail.uid("search", None, f"UID {last_uid + 1}:*")
+    else:
+        # First sync, or the mailbox was recreated and old UIDs are meaningless
+        last_uid = 0
+        today = datetime.now().strftime("%d-%b-%Y")  # e.g., "17-Nov-2024"
+        status, data = mail.uid("search", None, f"SINCE {today}")
+    if status != "OK":
+        raise imaplib.IMAP4.error("Failed to search for new emails")
+
+    # "UID n:*" always matches the newest message, even when it is below n
+    uids = sorted(int(uid) for uid in data[0].split())
+    return [uid for uid in uids if uid > last_uid]
 
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    # Parse the email content
-                    msg = email.message_from_bytes(response_part[1])
-                    subject = decode_header(msg["Subject"])[0][0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode()
-                    from_ = msg.get("From")
-
-                    # Extract email date
-                    date = msg.get("Date")
-                    date = datetime.strptime(date[:31], "%a, %d %b %Y %H:%M:%S %z").astimezone().strftime('%Y-%m-%d %H:%M:%S')
-
-                    # Extract email body
-                    body = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            content_type = part.get_content_type()
-                            content_disposition = str(part.get("Content-Disposition"))
-                            if content_type == "text/plain" and "attachment" not in content_disposition:
-                                body = part.get_payload(decode=True).decode()
-                                break
-                    else:
-                        body = msg.get_payload(decode=True).decode()
-
-                    # Format the body to ensure it's stored in a single cell
-                    body = " ".join(body.splitlines()).strip()
-
-                    # Append email data to the list
-                    emails.append({"date": date, "subject": subject, "from": from_, "body": body})
+@track_stage("fetch")
+def fetch_new_emails(mail, entry, mailbox="inbox", mode=FETCH_MODE, body_byte_cap=BODY_BYTE_CAP, pool=None):
+    """
+    Fetch emails above a UID watermark without persisting anything.
+
+    Args:
+        entry (dict or None): Watermark {"uidvalidity", "last_uid"} to fetch from (None on first sync)
+        pool (ImapConnectionPool, optional): Extra connections to the same mailbox used to
+            fetch large bulk batches in parallel
+
+    Returns:
+        tuple: (emails, new_entry) where new_entry is the watermark after this fetch; the caller
+            decides when it is safe to commit it with commit_uid_watermark
+    """
+    emails = []
+    uidvalidity, uidnext = select_mailbox(mail, mailbox)
+    uids = search_new_uids(mail, entry, uidvalidity)
+
+    if entry and entry.get("uidvalidity") == uidvalidity:
+        last_uid = entry.get("last_uid", 0)
+    elif uids:
+        # Start just below today's first message; it only advances past what was fetched, so a
+        # failed fetch is retried next cycle instead of skipped
+        last_uid = uids[0] - 1
+    else:
+        # Start the watermark at the mailbox head so older mail is never back-filled
+        last_uid = uidnext - 1 if uidnext else 0
+
+    if mode == "bulk" and uids:
+        if pool and len(uids) > FETCH_BATCH_SIZE:
+            emails = pool.bulk_fetch(uids, body_byte_cap)
+        else:
+            emails = bulk_fetch_emails(mail, uids, body_byte_cap)
+        last_uid = max(last_uid, uids[-1])
+        uids = []
+
+    # Fetch email data
+    for uid in uids:
+        # Fetch the email by UID
+        status, msg_data = mail.uid("fetch", str(uid), "(RFC822)")
+        if status != "OK":
+            # Leave the watermark here so the message is retried next cycle
+            print(f"Failed to fetch email UID {uid}")
+            break
+
+        for response_part in msg_data:
+            if isinstance(response_part, tuple):
+                # Parse the email content
+                msg = email.message_from_bytes(response_part[1])
+                try:
+                    email_data = parse_email_message(msg)
+                except Exception as e:
+                    print(f"Skipping unparseable email UID {uid}: {e}")
+                    continue
+                email_data["uid"] = uid
+                emails.append(email_data)
+        last_uid = max(last_uid, uid)
+
+    # Each email carries a trace ID through analysis and storage logs, and its fetch time for lag metrics
+    fetched_at = time.time()
+    for email_data in emails:
+        email_data["trace_id"] = new_trace_id()
+        email_data["fetched_at"] = fetched_at
+    EMAILS_FETCHED.inc(len(emails))
+    return emails, {"uidvalidity": uidvalidity, "last_uid": last_uid}
+
+def commit_uid_watermark(entry, mailbox="inbox", state_file=UID_STATE_FILE, account=None):
+    """Persist the watermark of one mailbox; everything at or below last_uid is never fetched again."""
+    state = load_uid_state(state_file)
+    state[mailbox_key(mailbox, account)] = entry
+    save_uid_state(state, state_file)
+
+def fetch_incoming_emails(mail, mailbox="inbox", state_file=UID_STATE_FILE, mode=FETCH_MODE,
+                          body_byte_cap=BODY_BYTE_CAP, account=None):
+    """Fetch emails that arrived since the last call, using a persisted UID watermark."""
+    try:
+        entry = load_uid_state(state_file).get(mailbox_key(mailbox, account))
+        emails, entry = fetch_new_emails(mail, entry, mailbox, mode, body_byte_cap)
+        commit_uid_watermark(entry, mailbox, state_file, account)
+        return emails
+    except (imaplib.IMAP4.abort, OSError, EOFError):
+        # A dead connection is the caller's to repair; retrying it here would only poll a closed socket
+        raise
     except Exception as e:
         print(f"Error fetching incoming emails: {e}")
-    return emails
+        return []
 
 def save_to_csv(emails):
     """Save the email data to a CSV file, sorted latest to oldest."""
@@ -84,7 +408,9 @@ def save_to_csv(emails):
         # Convert emails to a DataFrame
         today = datetime.now().strftime("%Y-%m-%d")  # e.g., "2024-11-17"
         filename = f"emails_{today}.csv" 
-        df = pd.DataFrame(emails)
+        df = pd.DataFrame(emails).drop(columns=["trace_id", "fetched_at"], errors="ignore")
+        # Format the body to ensure it's stored in a single cell
+        df["body"] = df["body"].map(flatten_body)
 
         # If the file already exists, append new emails
         try:
@@ -106,24 +432,33 @@ def save_to_csv(emails):
 
 def main():
     """Main function to parse incoming emails periodically."""
-    mail = connect_to_email()
-    if not mail:
-        return
+    from imap_connection import CONNECTION_ERRORS, KEEPALIVE_SECONDS, ImapConnection
 
+    connection = ImapConnection()
     print("Starting email monitoring...")
+    watcher, generation = None, None
     try:
         while True:
-            print("Checking for incoming emails...")
-            emails = fetch_incoming_emails(mail)
-            if emails:
-                save_to_csv(emails)
-            else:
-                print("No new emails.")
-            time.sleep(60)  # Check every 60 seconds (adjust as needed)
+            try:
+                mail = connection.mail
+                if generation != connection.generation:
+                    watcher, generation = MailWatcher(mail, KEEPALIVE_SECONDS), connection.generation
+                print("Checking for incoming emails...")
+                emails = fetch_incoming_emails(mail)
+                if emails:
+                    save_to_csv(emails)
+                else:
+                    print("No new emails.")
+                # Block on IDLE until the server pushes new mail (adaptive polling if unsupported)
+                watcher.wait(found_mail=bool(emails))
+                connection.touch()
+            except CONNECTION_ERRORS as e:
+                print(f"Connection lost ({e}), reconnecting...")
+                connection.reconnect()
     except KeyboardInterrupt:
         print("\nStopping email monitoring.")
     finally:
-        mail.logout()
+        connection.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_CACHE_FILE = "analysis_cache.db"
+
+class AnalysisCache:
+    """
+    Two-tier cache for email analysis results.
+
+    Entries are keyed on a hash of the cleaned subject/body and the prompt version, so an
+    identical email never costs a second LLM call. A bounded in-memory LRU sits in front
+    of an SQLite table that survives restarts.
+    """
+
+    def __init__(self, path: Optional[str] = ANALYSIS_CACHE_FILE, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS analysis_cache (key TEXT PRIMARY KEY, result TEXT NOT NULL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Analysis cache disabled on disk, could not open {path}: {str(e)}")
+                self._db = None
+
+    @staticmethod
+    def make_key(clean_subject: str, clean_body: str, prompt_version: str) -> str:
+        """Build the content address for a cleaned email under a given prompt version."""
+        digest = hashlib.sha256()
+        for part in (prompt_version, clean_subject, clean_body):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return a cached analysis (as a fresh copy) or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(self._memory[key])
+
+            row = None
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        "SELECT result FROM analysis_cache WHERE key = ?", (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    logger.error(f"Error reading analysis cache: {str(e)}")
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            self._remember(key, row[0])
+            return json.loads(row[0])
+
+    def put(self, key: str, result: Dict) -> None:
+        """Store an analysis result in both tiers."""
+        payload = json.dumps(result)
+        with self._lock:
+            self._remember(key, payload)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO analysis_cache (key, result) VALUES (?, ?)", (key, payload)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing analysis cache: {str(e)}")
+
+    def _remember(self, key: str, payload: str) -> None:
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = payload
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters since the cache was created."""
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+            }
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -1,6 +1,11 @@
-from flask import Flask, send_from_directory
+from flask import Flask, Response, request
+import json
 import os
+import uuid
 from integrated_parser import IntegratedEmailSystem  # Assuming your script is named IntegratedEmailSystem.py
+from latest_result import LATEST_RESULT
+from metrics import REGISTRY
+from email_storage import DEFAULT_PAGE_SIZE, QUERY_FILTERS, SqliteEmailStore, get_storage
 
 # Create Flask app
 app = Flask(__name__)
@@ -8,6 +13,30 @@ app = Flask(__name__)
 # Define the directory where the HTML file will be stored
 HTML_DIR = os.path.abspath(".")  # Current directory
 HTML_FILE = "latest_email.html"
+# Idle SSE connections get a comment line this often so proxies keep them open
+SSE_KEEPALIVE_SECONDS = 15
+# SSE event ids are "<boot>-<version>"; versions restart with the process, so an id from an
+# earlier run must not be compared with the new counter
+SSE_BOOT_ID = uuid.uuid4().hex[:8]
+
+_store = None
+
+def get_store():
+    """Storage opened once for the API; WAL lets it read while the processor writes."""
+    global _store
+    if _store is None:
+        _store = get_storage()
+    return _store
+
+def query_filters():
+    return {name: request.args[name] for name in QUERY_FILTERS if request.args.get(name)}
+
+def load_saved_display():
+    """Seed the in-memory result from the HTML written by a previous run, if any."""
+    path = os.path.join(HTML_DIR, HTML_FILE)
+    if LATEST_RESULT.version == 0 and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            LATEST_RESULT.publish(None, f.read())
 
 @app.route("/")
 def welcome():
@@ -15,18 +44,80 @@ def welcome():
     return {
         "message": "Welcome to the Email Processing API!",
         "endpoints": {
-            "get_latest_email": "/latest-email"
+            "get_latest_email": "/latest-email",
+            "latest_email_events": "/events",
+            "list_emails": "/emails?priority=&category=&request_type=&sender=&thread_id=&date_from=&date_to=&limit=&cursor=",
+            "email_counts": "/emails/counts",
+            "metrics": "/metrics"
         }
     }
 
 @app.route("/latest-email", methods=["GET"])
 def get_latest_email():
-    """Serve the latest email HTML file"""
-    if os.path.exists(os.path.join(HTML_DIR, HTML_FILE)):
-        return send_from_directory(HTML_DIR, HTML_FILE)
-    else:
+    """Serve the latest email HTML from memory; answers 304 when the client copy is current"""
+    latest = LATEST_RESULT.snapshot()
+    if latest["html"] is None:
         return {"error": "No processed email available yet."}, 404
 
+    response = Response(latest["html"], mimetype="text/html")
+    response.set_etag(latest["etag"])
+    response.last_modified = latest["last_modified"]
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route("/events", methods=["GET"])
+def latest_email_events():
+    """Server-Sent Events stream with one 'email' event per newly processed email"""
+    # A reconnecting EventSource sends the last id it saw, so no update is missed
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    boot_id, _, last_version = last_event_id.partition("-")
+    if boot_id == SSE_BOOT_ID and last_version.isdigit():
+        since = int(last_version)
+    else:
+        # An id from before a restart gets the current result right away
+        since = 0 if last_event_id else LATEST_RESULT.version
+
+    def stream():
+        version = since
+        yield "retry: 5000\n\n"
+        while True:
+            latest = LATEST_RESULT.wait_for_update(version, timeout=SSE_KEEPALIVE_SECONDS)
+            if latest is None:
+                yield ": keepalive\n\n"
+                continue
+            version = latest["version"]
+            payload = json.dumps({"version": version, "etag": latest["etag"], "email": latest["result"]})
+            yield f"id: {SSE_BOOT_ID}-{version}\nevent: email\ndata: {payload}\n\n"
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/emails", methods=["GET"])
+def list_emails():
+    """Filtered processed emails, newest first, one page per request (follow next_cursor)"""
+    store = get_store()
+    if not isinstance(store, SqliteEmailStore):
+        return {"error": "Querying emails requires the sqlite storage backend."}, 501
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+        emails, next_cursor = store.query(query_filters(), limit=limit, cursor=request.args.get("cursor"))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return {"emails": emails, "count": len(emails), "next_cursor": next_cursor}
+
+@app.route("/emails/counts", methods=["GET"])
+def email_counts():
+    """Totals per category and priority for the same filters as /emails"""
+    store = get_store()
+    if not isinstance(store, SqliteEmailStore):
+        return {"error": "Querying emails requires the sqlite storage backend."}, 501
+    return store.counts(query_filters())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Stage latencies, counters, queue depths and lag in the Prometheus text format"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     # Start the email processing system in a separate thread
     import threading
@@ -35,10 +126,12 @@ if __name__ == "__main__":
         system = IntegratedEmailSystem()
         system.run_continuous_processing()
 
+    load_saved_display()
+
     # Start email processing in a thread
     email_thread = threading.Thread(target=start_email_processing)
     email_thread.daemon = True
     email_thread.start()
 
-    # Run the Flask app
-    app.run(host="0.0.0.0", port=5000)
+    # Run the Flask app; threaded so open SSE streams do not block other requests
+    app.run(host="0.0.0.0", port=5000, threaded=True)
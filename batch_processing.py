@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Iterator, Optional, Tuple
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from Data_cleaning import ANALYSIS_BATCH_SIZE, ANALYSIS_WORKERS, EmailProcessor
+
+logger = logging.getLogger(__name__)
+
+# Rows read, analyzed and appended to the output per step; also the most work a crash can lose
+CHUNK_SIZE = int(os.getenv("batch_chunk_size", "500"))
+JOURNAL_SUFFIX = ".journal"
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE, skip_rows: int = 0) -> Iterator[Tuple[pd.DataFrame, int]]:
+    """
+    Stream a CSV or Excel sheet as DataFrames of at most `chunk_size` rows, starting after
+    `skip_rows` physical data rows. Excel is read row by row (openpyxl read-only mode)
+    instead of loading the whole workbook.
+
+    Blank rows are dropped from the frames but still counted: each frame comes with the
+    number of physical data rows consumed up to its end, which is what a resumed run
+    passes back as `skip_rows`.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        position = skip_rows
+        # Blank lines are kept as empty rows so positions stay line-based like skiprows
+        for chunk in pd.read_csv(path, chunksize=chunk_size, skiprows=range(1, skip_rows + 1),
+                                 skip_blank_lines=False):
+            position += len(chunk)
+            yield chunk.dropna(how="all"), position
+    elif extension in (".xlsx", ".xlsm"):
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            header = next(sheet.iter_rows(max_row=1, values_only=True))
+            columns = [str(name) for name in header]
+            rows = []
+            position = skip_rows
+            for row in sheet.iter_rows(min_row=2 + skip_rows, values_only=True):
+                position += 1
+                if all(value is None for value in row):
+                    continue
+                rows.append(row)
+                if len(rows) == chunk_size:
+                    yield pd.DataFrame(rows, columns=columns), position
+                    rows = []
+            if rows:
+                yield pd.DataFrame(rows, columns=columns), position
+        finally:
+            workbook.close()
+    else:
+        raise ValueError(f"Unsupported input format {extension or path}; use .csv or .xlsx")
+
+class BatchJournal:
+    """
+    Checkpoint log for a batch run, kept next to the output file.
+
+    The first line identifies the input; each completed chunk appends the number of
+    input rows done (physical sheet rows, blank ones included) and the output size at
+    that point. A resumed run truncates the
+    output back to the last checkpoint (dropping a half-written chunk) and skips the
+    rows already done.
+    """
+
+    def __init__(self, output_path: str, input_path: str):
+        self.path = output_path + JOURNAL_SUFFIX
+        stat = os.stat(input_path)
+        self.source = {"input": os.path.abspath(input_path), "size": stat.st_size, "mtime": stat.st_mtime}
+        self.rows_done = 0
+        self.output_bytes = 0
+        self.complete = False
+
+    def load(self) -> bool:
+        """Read an existing journal; False if there is none to resume from."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        if not lines:
+            return False
+        if lines[0] != self.source:
+            raise ValueError(f"{self.path} belongs to a different or modified input; rerun with --restart")
+        for entry in lines[1:]:
+            self.rows_done = entry["rows_done"]
+            self.output_bytes = entry["output_bytes"]
+            self.complete = entry.get("complete", False)
+        return True
+
+    def start(self) -> None:
+        self.rows_done, self.output_bytes, self.complete = 0, 0, False
+        self._write(self.source, mode="w")
+
+    def record(self, rows_done: int, output_bytes: int, complete: bool = False) -> None:
+        self.rows_done, self.output_bytes, self.complete = rows_done, output_bytes, complete
+        entry = {"rows_done": rows_done, "output_bytes": output_bytes}
+        if complete:
+            entry["complete"] = True
+        self._write(entry)
+
+    def _write(self, entry, mode: str = "a") -> None:
+        with open(self.path, mode, encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def process_file(input_path: str, output_path: str, processor: EmailProcessor,
+                 chunk_size: int = CHUNK_SIZE, max_workers: int = ANALYSIS_WORKERS,
+                 batch_size: int = ANALYSIS_BATCH_SIZE, restart: bool = False) -> int:
+    """
+    Analyze a spreadsheet of emails chunk by chunk, appending results to a CSV.
+
+    Each chunk's results are flushed before its checkpoint is written, so a killed or
+    failed run picks up at the first unfinished chunk when started again. Returns the
+    number of rows processed by this call.
+    """
+    journal = BatchJournal(output_path, input_path)
+    if restart or not journal.load():
+        journal.start()
+    if journal.complete:
+        logger.info(f"{input_path} was already fully processed into {output_path} (use --restart to redo it)")
+        return 0
+
+    # Anything past the last checkpoint is a partially written chunk that will be redone
+    with open(output_path, "a+b") as f:
+        f.truncate(journal.output_bytes)
+    if journal.rows_done:
+        logger.info(f"Resuming {input_path} after {journal.rows_done} processed rows")
+
+    processed = 0
+    started = time.monotonic()
+    for chunk, position in read_chunks(input_path, chunk_size, skip_rows=journal.rows_done):
+        output_bytes = journal.output_bytes
+        if len(chunk):
+            results = processor.analyze_frame(chunk, max_workers, batch_size)
+            with open(output_path, "a", encoding="utf-8", newline="") as f:
+                results.to_csv(f, header=journal.output_bytes == 0, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+                output_bytes = f.tell()
+        journal.record(position, output_bytes)
+        processed += len(chunk)
+        rate = processed / max(time.monotonic() - started, 1e-9)
+        logger.info(f"{journal.rows_done} rows done ({rate:.1f} rows/sec)")
+
+    journal.record(journal.rows_done, journal.output_bytes, complete=True)
+    processor.log_stats()
+    logger.info(f"Results saved to {output_path}")
+    return processed
+
+def main(argv: Optional[Tuple[str, ...]] = None):
+    parser = argparse.ArgumentParser(description="Analyze a spreadsheet of emails in resumable chunks")
+    parser.add_argument("input", nargs="?", default="sample data.xlsx", help=".xlsx or .csv with date, from, subject, body")
+    parser.add_argument("--output", default="processed_emails.csv")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=ANALYSIS_BATCH_SIZE, help="Emails per Gemini request")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint journal and start over")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    processor = EmailProcessor(os.getenv("gemini_api"))
+    try:
+        process_file(args.input, args.output, processor, args.chunk_size, args.workers, args.batch_size,
+                     args.restart)
+    finally:
+        processor.cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,627 @@
+import argparse
+import imaplib
+import json
+import logging
+import os
+import random
+import re
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import format_datetime
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+BASELINE_FILE = "benchmark_baseline.json"
+# A stage is flagged when p95 latency grows or throughput drops by more than this fraction
+REGRESSION_TOLERANCE = 0.2
+# Upper bound on the backlog stage, in case the pipeline stops acknowledging emails
+BACKLOG_TIMEOUT = 600
+
+# ---------------------------------------------------------------------------
+# Synthetic corpus
+# ---------------------------------------------------------------------------
+
+_NAMES = ["Emily Brown", "Raj Patel", "Maria Garcia", "John Smith", "Aiko Tanaka", "Lena Fischer",
+          "Omar Haddad", "Grace Lee", "Carlos Silva", "Priya Nair"]
+_CLAIMS = [
+    ("Car accident claim - policy {policy}",
+     "I was in an accident on {day} and my car has serious damage to the front bumper. "
+     "Please open a new claim under policy {policy}. The police report number is {ref}."),
+    ("Status of my claim {ref}",
+     "Could you tell me the status of claim {ref}? I submitted the hospital bills two weeks ago "
+     "and have not heard back."),
+    ("Urgent: injury claim",
+     "My son was injured at school and is in the hospital. This is an emergency, what documents "
+     "do you need for the medical claim on policy {policy}?"),
+]
+_BILLING = [
+    ("Overcharged on my premium",
+     "My last bill shows a premium payment of ${amount} but my policy {policy} should cost less. "
+     "I think this is an overcharge and I would like a refund."),
+    ("Payment confirmation for {policy}",
+     "I made the payment of ${amount} for policy {policy} yesterday. Please confirm it was received."),
+]
+_POLICY = [
+    ("Update address on policy {policy}",
+     "Please update the mailing address on my policy {policy} to 12 Lake Road, Springfield."),
+    ("Cancel my policy",
+     "I would like to cancel policy {policy} effective end of this month. Please send the "
+     "cancellation confirmation."),
+    ("Request for a new quote",
+     "I am interested in a 20-year term life insurance plan with ${amount}000 coverage. "
+     "Could you send me a quote?"),
+]
+_TECHNICAL = [
+    ("Cannot login to the portal",
+     "I keep getting an error when I try to login to the online portal. I reset my password "
+     "twice but still have no access."),
+]
+_NEWSLETTER_HTML = """<!DOCTYPE html><html><head><style>p {{ color: #333; }}</style>
+<script>var tracking = 1;</script></head><body>
+<table width="600"><tr><td><h1>{headline}</h1></td></tr>
+<tr><td><p>Dear customer, our {season} newsletter is here. {line}</p>
+<p>Read more about <a href="https://example.com/offers">seasonal offers</a> and protect your family.</p>
+</td></tr><tr><td><p style="font-size:10px">Unsubscribe | Privacy policy</p></td></tr></table>
+</body></html>"""
+_SIGNATURE = "\n\nThanks,\n{name}\nCustomer since 2015\nPhone: +1 555 0100"
+_QUOTED = "\n\nOn {day}, Support <support@insurer.example> wrote:\n> Thank you for contacting us.\n> {quote}\n"
+
+KINDS = ("claim", "billing", "policy", "technical", "forward", "newsletter", "attachment")
+
+def _fill(template: str, rng: random.Random, name: str) -> str:
+    return template.format(
+        policy=f"PL-{rng.randint(100000, 999999)}", ref=f"CL-{rng.randint(1000, 9999)}",
+        amount=rng.randint(90, 900), day=f"{rng.randint(1, 28)} Oct", name=name,
+        headline=rng.choice(["Stay protected", "Winter driving tips", "New benefits"]),
+        season=rng.choice(["spring", "summer", "autumn", "winter"]),
+        line=rng.choice(["Check your coverage today.", "New discounts are available.", "Renew early and save."]),
+        quote=rng.choice(["We have received your request.", "A representative will reply shortly."]),
+    )
+
+def make_email(kind: str, rng: random.Random, sent: datetime) -> EmailMessage:
+    """Build one synthetic insurance email of the given kind."""
+    name = rng.choice(_NAMES)
+    sender = f"{name} <{name.lower().replace(' ', '.')}@example.com>"
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = "claims@insurer.example"
+    msg["Date"] = format_datetime(sent)
+
+    if kind == "newsletter":
+        msg.replace_header("From", "Insurer News <news@insurer.example>")
+        msg["Subject"] = "Your monthly insurance newsletter"
+        msg.set_content(_fill(_NEWSLETTER_HTML, rng, name), subtype="html")
+        return msg
+
+    templates = {"claim": _CLAIMS, "billing": _BILLING, "policy": _POLICY, "technical": _TECHNICAL}
+    subject, body = rng.choice(templates.get(kind, _CLAIMS + _BILLING + _POLICY))
+    subject, body = _fill(subject, rng, name), _fill(body, rng, name) + _fill(_SIGNATURE, rng, name)
+    if kind == "forward":
+        subject = f"Fwd: {subject}"
+        body = (f"Please see the customer's message below.\n\n---------- Forwarded message ---------\n"
+                f"From: {sender}\nDate: {format_datetime(sent)}\nSubject: {subject[5:]}\n"
+                f"To: claims@insurer.example\n\n{body}" + _fill(_QUOTED, rng, name))
+    msg["Subject"] = subject
+    msg.set_content(body)
+    if kind == "attachment":
+        msg.add_alternative(f"<html><body><p>{body}</p></body></html>", subtype="html")
+        msg.add_attachment(bytes(rng.getrandbits(8) for _ in range(rng.randint(20000, 80000))),
+                           maintype="application", subtype="pdf", filename="claim_documents.pdf")
+    return msg
+
+def generate_corpus(size: int, seed: int = 42, duplicate_rate: float = 0.05) -> List[bytes]:
+    """
+    Deterministic list of raw RFC822 messages mixing claims, billing, policy, technical,
+    forwarded threads, HTML newsletters and emails with PDF attachments. About
+    `duplicate_rate` of them are resends of an earlier message (same subject and body).
+    """
+    rng = random.Random(seed)
+    start = datetime.now().astimezone().replace(microsecond=0) - timedelta(hours=1)
+    corpus, messages = [], []
+    weights = [0.25, 0.15, 0.15, 0.05, 0.15, 0.15, 0.10]
+    for i in range(size):
+        sent = start + timedelta(seconds=i)
+        if messages and rng.random() < duplicate_rate:
+            msg = rng.choice(messages)
+            msg.replace_header("Date", format_datetime(sent))
+        else:
+            msg = make_email(rng.choices(KINDS, weights)[0], rng, sent)
+            messages.append(msg)
+        corpus.append(msg.as_bytes())
+    return corpus
+
+# ---------------------------------------------------------------------------
+# In-process IMAP server
+# ---------------------------------------------------------------------------
+
+def _quote(value) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def body_structure(part) -> str:
+    """IMAP BODYSTRUCTURE of an email.message part, as the fetch code expects to parse it."""
+    if part.is_multipart():
+        children = "".join(body_structure(child) for child in part.get_payload())
+        return f"({children} {_quote(part.get_content_subtype().upper())})"
+    maintype = part.get_content_maintype().upper()
+    params = part.get_params()[1:] if part.get_params() else []
+    params = "(" + " ".join(f"{_quote(k.upper())} {_quote(v)}" for k, v in params) + ")" if params else "NIL"
+    encoding = part.get("Content-Transfer-Encoding", "7BIT").upper()
+    body = part.get_payload()
+    size = len(body.encode("utf-8", errors="replace"))
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        disposition = (f"({_quote(disposition.upper())} "
+                       f"{'(' + _quote('FILENAME') + ' ' + _quote(filename) + ')' if filename else 'NIL'})")
+    else:
+        disposition = "NIL"
+    common = f"{_quote(maintype)} {_quote(part.get_content_subtype().upper())} {params} NIL NIL {_quote(encoding)} {size}"
+    if maintype == "TEXT":
+        return f"({common} {body.count(chr(10))} NIL {disposition} NIL)"
+    return f"({common} NIL {disposition} NIL)"
+
+def _find_part(msg, section: str):
+    part = msg
+    for index in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]
+        elif index != "1":
+            return None
+    return part
+
+class _Mailbox:
+    def __init__(self, uidvalidity: int = 1):
+        self.uidvalidity = uidvalidity
+        self.messages = []  # (uid, raw bytes, parsed message)
+        self.lock = threading.Lock()
+
+    @property
+    def uidnext(self) -> int:
+        return self.messages[-1][0] + 1 if self.messages else 1
+
+    def deliver(self, raw_messages: List[bytes]) -> None:
+        import email
+        with self.lock:
+            for raw in raw_messages:
+                self.messages.append((self.uidnext, raw, email.message_from_bytes(raw)))
+
+    def uids_in(self, uid_set: str) -> List[Tuple[int, bytes, object]]:
+        with self.lock:
+            messages = list(self.messages)
+        last = messages[-1][0] if messages else 0
+        wanted = set()
+        for item in uid_set.split(","):
+            low, _, high = item.partition(":")
+            low = last if low == "*" else int(low)
+            high = low if not high else (last if high == "*" else int(high))
+            wanted.update(range(min(low, high), max(low, high) + 1))
+        return [message for message in messages if message[0] in wanted]
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    """Enough IMAP4rev1 for imaplib and the fetch code: LOGIN, SELECT, UID SEARCH/FETCH, NOOP."""
+
+    def send(self, data) -> None:
+        self.wfile.write(data if isinstance(data, bytes) else data.encode())
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send("* OK [CAPABILITY IMAP4rev1] benchmark IMAP ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode(errors="replace").rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "CAPABILITY":
+                self.send(f"* CAPABILITY IMAP4rev1\r\n{tag} OK CAPABILITY completed\r\n")
+            elif command in ("LOGIN", "NOOP", "CHECK"):
+                self.send(f"{tag} OK {command} completed\r\n")
+            elif command in ("SELECT", "EXAMINE"):
+                self.send(f"* {len(mailbox.messages)} EXISTS\r\n* 0 RECENT\r\n"
+                          f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n"
+                          f"* OK [UIDNEXT {mailbox.uidnext}] Predicted next UID\r\n"
+                          f"{tag} OK [READ-WRITE] SELECT completed\r\n")
+            elif command == "LOGOUT":
+                self.send(f"* BYE logging out\r\n{tag} OK LOGOUT completed\r\n")
+                return
+            elif command == "UID":
+                subcommand, _, args = args.partition(" ")
+                if subcommand.upper() == "SEARCH":
+                    self._search(tag, mailbox, args)
+                elif subcommand.upper() == "FETCH":
+                    self._fetch(tag, mailbox, args)
+                else:
+                    self.send(f"{tag} BAD unsupported UID command\r\n")
+            else:
+                self.send(f"{tag} BAD unsupported command\r\n")
+            self.wfile.flush()
+
+    def _search(self, tag, mailbox, args):
+        match = re.match(r"UID (\S+)", args, re.IGNORECASE)
+        if match:
+            uids = [message[0] for message in mailbox.uids_in(match.group(1))]
+        else:
+            # Every synthetic message arrived today, so SINCE <today> matches all of them
+            with mailbox.lock:
+                uids = [message[0] for message in mailbox.messages]
+        self.send(f"* SEARCH {' '.join(map(str, uids))}\r\n{tag} OK SEARCH completed\r\n")
+
+    def _fetch(self, tag, mailbox, args):
+        uid_set, _, items = args.partition(" ")
+        items = items.upper()
+        partial = re.search(r"BODY\.PEEK\[([\d.]+)\]<(\d+)\.(\d+)>", items)
+        for sequence, (uid, raw, msg) in enumerate(mailbox.uids_in(uid_set), start=1):
+            out = [f"* {sequence} FETCH (UID {uid}".encode()]
+            if "RFC822" in items and "HEADER" not in items:
+                out.append(f" RFC822 {{{len(raw)}}}\r\n".encode() + raw)
+            if "HEADER.FIELDS" in items:
+                header = "".join(f"{name}: {msg[name]}\r\n" for name in ("Subject", "From", "Date") if msg[name])
+                header = (header + "\r\n").encode()
+                out.append(f" BODY[HEADER.FIELDS (SUBJECT FROM DATE)] {{{len(header)}}}\r\n".encode() + header)
+            if "BODYSTRUCTURE" in items:
+                out.append(f" BODYSTRUCTURE {body_structure(msg)}".encode())
+            if partial:
+                section, start, length = partial.group(1), int(partial.group(2)), int(partial.group(3))
+                part = _find_part(msg, section)
+                body = part.get_payload().encode("utf-8", errors="replace") if part is not None else b""
+                body = body[start:start + length]
+                out.append(f" BODY[{section}]<{start}> {{{len(body)}}}\r\n".encode() + body)
+            out.append(b")\r\n")
+            self.send(b"".join(out))
+        self.send(f"{tag} OK FETCH completed\r\n")
+
+class LocalImapServer(socketserver.ThreadingTCPServer):
+    """Plain-text IMAP server on localhost serving one in-memory mailbox."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, uidvalidity: int = 1):
+        super().__init__(("127.0.0.1", 0), _ImapHandler)
+        self.mailbox = _Mailbox(uidvalidity)
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "LocalImapServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="benchmark-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def connect(self):
+        mail = imaplib.IMAP4("127.0.0.1", self.port)
+        mail.login("benchmark", "benchmark")
+        mail.select("inbox")
+        return mail
+
+# ---------------------------------------------------------------------------
+# Stub LLM
+# ---------------------------------------------------------------------------
+
+class StubAPIError(Exception):
+    """Stands in for a 429 from the Gemini API (is_retryable_error reads .code)."""
+
+    def __init__(self, code: int = 429):
+        super().__init__(f"stub API error {code}")
+        self.code = code
+
+class StubResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class StubGenerativeModel:
+    """
+    Drop-in for genai.GenerativeModel: answers after a simulated latency and fails with a
+    retryable error at `error_rate`. Single-email prompts get the line format, batch prompts
+    a JSON array, both classified with the keyword rules so downstream parsing is exercised.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, error_rate: float = 0.0, seed: int = 42):
+        from keyword_classifier import DEFAULT_CLASSIFIER
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.classifier = DEFAULT_CLASSIFIER
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _answer(self, text: str) -> Dict:
+        decision = self.classifier.classify("", text)
+        return {
+            "request_type": f"{decision['request_type']} - Synthetic benchmark answer",
+            "category": decision["category"],
+            "actions": ["Review the request details", "Verify the policy information",
+                        "Process the request", "Send confirmation to the customer"],
+            "priority": decision["priority"],
+        }
+
+    def generate_content(self, prompt: str, **kwargs) -> StubResponse:
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._random.gauss(self.latency, self.latency * self.jitter))
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(delay)
+        if fail:
+            raise StubAPIError(self._random.choice([429, 503]))
+
+        # The emails come before the task and classification guide, whose keywords would skew the last one
+        blocks = re.split(r"\[EMAIL ID (\d+)\]", prompt.split("TASK:")[0])
+        if len(blocks) > 1:
+            answers = [dict(self._answer(blocks[i + 1]), id=int(blocks[i])) for i in range(1, len(blocks) - 1, 2)]
+            return StubResponse(json.dumps(answers))
+        answer = self._answer(prompt.split("TASK:")[0])
+        actions = "\n".join(f"{i}. {action}" for i, action in enumerate(answer["actions"], start=1))
+        text = (f"Request Type: {answer['request_type']}\nCategory: {answer['category']}\n"
+                f"Priority: {answer['priority']}\nActions:\n{actions}")
+        if kwargs.get("stream"):
+            return self._stream(text)
+        return StubResponse(text)
+
+    def _stream(self, text: str, chunk_chars: int = 40):
+        # Streaming answers arrive over a generation time as long again as the first-chunk latency
+        chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        for chunk in chunks:
+            time.sleep(self.latency / len(chunks))
+            yield StubResponse(chunk)
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+class StageTimer:
+    """Latency samples per stage; each sample covers `items` emails."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage: str, seconds: float, items: int = 1) -> None:
+        self.samples.setdefault(stage, []).append((seconds, items))
+
+    def summary(self) -> Dict[str, Dict]:
+        report = {}
+        for stage, samples in self.samples.items():
+            latencies = np.array([seconds for seconds, _ in samples]) * 1000
+            total = sum(seconds for seconds, _ in samples)
+            items = sum(count for _, count in samples)
+            report[stage] = {
+                "calls": len(samples),
+                "emails": items,
+                "total_s": round(total, 4),
+                "emails_per_sec": round(items / total, 2) if total else None,
+                "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+            }
+        return report
+
+class BacklogSource:
+    """Pipeline source that submits a whole fetched backlog at once, as after an outage."""
+
+    def __init__(self, emails: List[Dict]):
+        self.emails = emails
+        self.unacknowledged = len(emails)
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self, pipeline) -> None:
+        fetched_at = time.time()
+        for email_data in self.emails:
+            email_data["fetched_at"] = fetched_at
+        pipeline.submit_many(self.emails)
+        while not pipeline.stopping:
+            time.sleep(0.05)
+
+    def done(self, emails) -> None:
+        with self._lock:
+            self.unacknowledged -= len(list(emails))
+            if self.unacknowledged <= 0:
+                self.finished.set()
+
+    @property
+    def pending(self) -> int:
+        return self.unacknowledged
+
+    def close(self) -> None:
+        pass
+
+def run_benchmark(emails: int = 500, wave_size: int = 100, llm_latency: float = 0.05, llm_jitter: float = 0.5,
+                  error_rate: float = 0.01, workers: int = 4, batch_size: int = 1, fetch_mode: str = "bulk",
+                  seed: int = 42, log_level: int = logging.ERROR, streaming: bool = False) -> Dict:
+    """
+    Drive fetch_incoming_emails, EmailProcessor and IntegratedEmailSystem.save_results over a
+    synthetic corpus served by LocalImapServer with StubGenerativeModel standing in for Gemini.
+
+    Mail is delivered and fetched in waves of `wave_size`. analyze_email is timed per email
+    (sequential), process_emails per run with `workers`/`batch_size`, save_results per wave.
+    Finally the whole corpus is pushed through ProcessingPipeline as one backlog, recording
+    how long High priority mail waits for its fast and confirmed alerts (and, with
+    `streaming`, for the alert raised from the partially streamed analysis).
+    Runs in a scratch directory so no real database, cache, log or model file is touched.
+    """
+    timer = StageTimer()
+    corpus = generate_corpus(emails, seed)
+    server = LocalImapServer().start()
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="email-benchmark-") as workdir:
+        os.chdir(workdir)
+        try:
+            # Imported here so email_processing.log is opened in the scratch directory
+            from Data_cleaning import EmailProcessor
+            from Email_parser import fetch_incoming_emails
+            from analysis_cache import AnalysisCache
+            from integrated_parser import IntegratedEmailSystem
+            from near_duplicates import NearDuplicateIndex
+            from processing_pipeline import ProcessingPipeline
+
+            class TimedPipeline(ProcessingPipeline):
+                def _alert(self, email_data, result=None, path=None):
+                    super()._alert(email_data, result, path)
+                    path = path or ("fast" if result is None else "confirmed")
+                    timer.record(f"alert_{path}", time.time() - email_data["fetched_at"])
+
+            # Per-email INFO lines would be part of what is timed
+            logging.getLogger().setLevel(log_level)
+
+            mail = server.connect()
+            fetched = []
+            for start in range(0, len(corpus), wave_size):
+                server.mailbox.deliver(corpus[start:start + wave_size])
+                began = time.perf_counter()
+                wave = fetch_incoming_emails(mail, state_file="uid_state.json", mode=fetch_mode)
+                timer.record("fetch", time.perf_counter() - began, len(wave))
+                fetched += wave
+            mail.logout()
+
+            model = StubGenerativeModel(llm_latency, llm_jitter, error_rate, seed)
+            processor = EmailProcessor("benchmark", cache=AnalysisCache("analyze_cache.db"),
+                                       near_duplicates=NearDuplicateIndex("analyze_near_duplicates.db"),
+                                       requests_per_minute=0)
+            processor.model = model
+            for email_data in fetched:
+                began = time.perf_counter()
+                processor.analyze_email(email_data["subject"], email_data["body"])
+                timer.record("analyze_email", time.perf_counter() - began)
+            processor.cache.close()
+
+            processor = EmailProcessor("benchmark", cache=AnalysisCache("process_cache.db"),
+                                       near_duplicates=NearDuplicateIndex("process_near_duplicates.db"),
+                                       requests_per_minute=0)
+            processor.model = model
+            frame = pd.DataFrame(fetched)
+            began = time.perf_counter()
+            processed = processor.process_emails(frame, max_workers=workers, batch_size=batch_size)
+            timer.record("process_emails", time.perf_counter() - began, len(frame))
+            processor.cache.close()
+
+            system = IntegratedEmailSystem()
+            # process_emails already returns rows in the storage layout
+            results = processed.to_dict('records')
+            for start in range(0, len(results), wave_size):
+                batch = results[start:start + wave_size]
+                began = time.perf_counter()
+                system.save_results(batch)
+                timer.record("save_results", time.perf_counter() - began, len(batch))
+            system.storage.close()
+
+            os.makedirs("backlog")
+            os.chdir("backlog")
+            system = IntegratedEmailSystem()
+            system.email_processor = EmailProcessor("benchmark", cache=AnalysisCache("backlog_cache.db"),
+                                                    near_duplicates=NearDuplicateIndex("backlog_near_duplicates.db"),
+                                                    requests_per_minute=0)
+            system.email_processor.model = model
+            source = BacklogSource([dict(email_data) for email_data in fetched])
+            pipeline = TimedPipeline(system, source=source, workers=workers, analysis_batch_size=batch_size,
+                                     persist_interval=0.1, streaming=streaming)
+            began = time.perf_counter()
+            pipeline.start()
+            source.finished.wait(timeout=BACKLOG_TIMEOUT)
+            pipeline.stop()
+            timer.record("pipeline_backlog", time.perf_counter() - began, len(fetched))
+            system.email_processor.cache.close()
+            system.storage.close()
+        finally:
+            os.chdir(original_dir)
+            server.stop()
+
+    report = timer.summary()
+    pipeline_seconds = sum(report[stage]["total_s"] for stage in ("fetch", "process_emails", "save_results"))
+    report["end_to_end"] = {
+        "emails": len(fetched),
+        "total_s": round(pipeline_seconds, 4),
+        "emails_per_sec": round(len(fetched) / pipeline_seconds, 2) if pipeline_seconds else None,
+        "llm_calls": model.calls,
+        "llm_errors": model.errors,
+    }
+    return report
+
+def scenario_name(args) -> str:
+    return (f"n{args.emails}-wave{args.wave_size}-lat{args.llm_latency}-err{args.error_rate}"
+            f"-w{args.workers}-b{args.batch_size}-{args.fetch_mode}" + ("-stream" if args.streaming else ""))
+
+def compare_to_baseline(report: Dict, baseline: Dict, tolerance: float = REGRESSION_TOLERANCE) -> List[str]:
+    """Human-readable regressions of `report` against a stored baseline for the same scenario."""
+    regressions = []
+    for stage, metrics in report.items():
+        before = baseline.get(stage)
+        if not before:
+            continue
+        if metrics.get("p95_ms") and before.get("p95_ms") and metrics["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{stage}: p95 {before['p95_ms']}ms -> {metrics['p95_ms']}ms")
+        if (metrics.get("emails_per_sec") and before.get("emails_per_sec")
+                and metrics["emails_per_sec"] < before["emails_per_sec"] * (1 - tolerance)):
+            regressions.append(f"{stage}: {before['emails_per_sec']} -> {metrics['emails_per_sec']} emails/sec")
+    return regressions
+
+def print_report(report: Dict) -> None:
+    rows = [dict(stage=stage, **metrics) for stage, metrics in report.items()]
+    print(pd.DataFrame(rows).set_index("stage").fillna("").to_string())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fetch, analysis and storage on a synthetic corpus")
+    parser.add_argument("--emails", type=int, default=500)
+    parser.add_argument("--wave-size", type=int, default=100, help="Emails delivered per fetch cycle")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Mean stub LLM latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="Latency std-dev as a fraction of the mean")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="Share of LLM calls failing with 429/503")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--fetch-mode", choices=["bulk", "full"], default="bulk")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the scenario's baseline")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--streaming", action="store_true", help="Stream LLM responses in the backlog pipeline")
+    parser.add_argument("--log-level", default="ERROR", help="Log level of the code under test")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    report = run_benchmark(args.emails, args.wave_size, args.llm_latency, args.llm_jitter, args.error_rate,
+                           args.workers, args.batch_size, args.fetch_mode, args.seed, args.log_level.upper(),
+                           args.streaming)
+    print_report(report)
+
+    scenario = scenario_name(args)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+    regressions = compare_to_baseline(report, baselines.get(scenario, {})) if scenario in baselines else []
+    if scenario not in baselines:
+        print(f"\nNo baseline for {scenario} yet")
+    elif regressions:
+        print(f"\nRegressions against the {scenario} baseline:\n  " + "\n  ".join(regressions))
+    else:
+        print(f"\nWithin {REGRESSION_TOLERANCE:.0%} of the {scenario} baseline")
+
+    if args.save_baseline:
+        baselines[scenario] = dict(report, recorded=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Baseline for {scenario} saved to {args.baseline}")
+    if regressions and args.fail_on_regression:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
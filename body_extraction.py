@@ -0,0 +1,118 @@
+import os
+import re
+from html.parser import HTMLParser
+from typing import Optional
+
+# Upper bound on body characters kept per email (~1k tokens); everything downstream
+# (clean_text, the Gemini prompt, the database row) sees at most this much
+BODY_CHAR_CAP = int(os.getenv("body_char_cap", "4000"))
+HTML_FEED_CHUNK = 8192
+
+_SKIPPED_TAGS = {"script", "style", "head", "title", "noscript", "template"}
+_BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "section",
+               "article", "blockquote", "ul", "ol", "hr", "header", "footer"}
+_LOOKS_LIKE_HTML = re.compile(r"<\s*(html|body|div|table|p|br|span|!doctype)\b", re.IGNORECASE)
+
+class HtmlTextExtractor(HTMLParser):
+    """Streaming HTML-to-text converter that stops collecting once it has max_chars of text."""
+
+    def __init__(self, max_chars: int = BODY_CHAR_CAP):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self._skip_depth = 0
+
+    @property
+    def full(self) -> bool:
+        return self.length >= self.max_chars
+
+    def _append(self, text: str) -> None:
+        if self.full:
+            return
+        text = text[:self.max_chars - self.length]
+        self.parts.append(text)
+        self.length += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth and data.strip():
+            self._append(" ".join(data.split()) + " ")
+
+    def text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+def html_to_text(html: str, max_chars: int = BODY_CHAR_CAP) -> str:
+    """Convert HTML to plain text, feeding it in chunks and stopping as soon as the cap is reached."""
+    extractor = HtmlTextExtractor(max_chars)
+    for start in range(0, len(html), HTML_FEED_CHUNK):
+        extractor.feed(html[start:start + HTML_FEED_CHUNK])
+        if extractor.full:
+            break
+    else:
+        extractor.close()
+    return extractor.text()
+
+def looks_like_html(text: str) -> bool:
+    return bool(_LOOKS_LIKE_HTML.search(text[:2000]))
+
+def prepare_body(text: str, max_chars: int = BODY_CHAR_CAP, is_html: Optional[bool] = None) -> str:
+    """Reduce a body to capped plain text, converting HTML (detected if is_html is None)."""
+    if not isinstance(text, str):
+        return ""
+    if is_html is None:
+        is_html = looks_like_html(text)
+    if is_html:
+        return html_to_text(text, max_chars)
+    return text[:max_chars]
+
+def decode_payload(payload: bytes, charset: Optional[str]) -> str:
+    """Decode part bytes with the declared charset, falling back to UTF-8 for unknown charsets."""
+    try:
+        return payload.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+def _is_attachment(part) -> bool:
+    disposition = str(part.get("Content-Disposition", "")).lower()
+    return disposition.startswith("attachment") or part.get_filename() is not None
+
+def extract_body(msg, max_chars: int = BODY_CHAR_CAP) -> str:
+    """
+    Extract a bounded plain-text body from an email.message.Message.
+
+    Prefers the first inline text/plain part, falls back to text/html reduced to text, and
+    never decodes attachment or non-text parts.
+    """
+    plain_part = html_part = None
+    for part in msg.walk():
+        if part.is_multipart() or _is_attachment(part):
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/plain" and plain_part is None:
+            plain_part = part
+            break
+        if content_type == "text/html" and html_part is None:
+            html_part = part
+
+    part = plain_part or html_part
+    if part is None:
+        return ""
+    payload = part.get_payload(decode=True) or b""
+    if part is plain_part:
+        # A character is at most 4 bytes, so nothing past this can survive the cap
+        payload = payload[:max_chars * 4]
+    return prepare_body(decode_payload(payload, part.get_content_charset()), max_chars,
+                        is_html=part is html_part)
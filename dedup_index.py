@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import math
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def email_key(email_data: Dict) -> Tuple[str, str, str]:
+    """The (date, subject, from) key the storage layer deduplicates on."""
+    return (str(email_data.get('date', '')), str(email_data.get('subject', '')), str(email_data.get('from', '')))
+
+def _digest(key: Tuple[str, str, str]) -> bytes:
+    return hashlib.blake2b("\0".join(key).encode("utf-8"), digest_size=16).digest()
+
+class BloomFilter:
+    """Fixed-size Bloom filter over 16-byte key digests (double hashing)."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest: bytes):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, digest: bytes) -> None:
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+class SeenIndex:
+    """
+    Membership index of already-processed emails, consulted before any LLM call.
+
+    "set" mode keeps exact 16-byte digests. "bloom" mode keeps a compact Bloom filter for very
+    large histories; because a false positive would silently drop a new email, Bloom hits are
+    confirmed with `confirm` (an indexed storage lookup) when one is supplied.
+    """
+
+    def __init__(self, mode: str = "set", capacity: int = 1_000_000, error_rate: float = 0.001,
+                 confirm: Optional[Callable[[Tuple[str, str, str]], bool]] = None):
+        if mode not in ("set", "bloom"):
+            raise ValueError(f"Unknown dedup index mode: {mode}")
+        self.mode = mode
+        self.confirm = confirm
+        self._digests = set() if mode == "set" else None
+        self._bloom = BloomFilter(capacity, error_rate) if mode == "bloom" else None
+        self.size = 0
+
+    @classmethod
+    def from_storage(cls, storage, mode: str = "set", error_rate: float = 0.001) -> "SeenIndex":
+        """Build the index once at startup from every key already in the store."""
+        capacity = max(storage.count() * 2, 100_000)
+        index = cls(mode, capacity=capacity, error_rate=error_rate, confirm=storage.contains)
+        index.update(storage.iter_keys())
+        logger.info(f"Loaded {index.size} processed email keys into the {mode} dedup index")
+        return index
+
+    def add(self, key: Tuple[str, str, str]) -> None:
+        digest = _digest(key)
+        if self._digests is not None:
+            self._digests.add(digest)
+        else:
+            self._bloom.add(digest)
+        self.size += 1
+
+    def update(self, keys: Iterable[Tuple[str, str, str]]) -> None:
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: Tuple[str, str, str]) -> bool:
+        digest = _digest(key)
+        if self._digests is not None:
+            return digest in self._digests
+        if digest not in self._bloom:
+            return False
+        return self.confirm(key) if self.confirm else True
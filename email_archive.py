@@ -0,0 +1,173 @@
+import argparse
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from email_storage import load_history
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("archive_dir", "email_archive")
+# Partition value for rows whose date could not be parsed
+UNKNOWN_DAY = "unknown"
+# Row groups this size keep min/max statistics selective for date/priority filters
+ROW_GROUP_SIZE = 64 * 1024
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("date", pa.timestamp("s")),
+    ("from", pa.string()),
+    ("subject", pa.string()),
+    ("body", pa.string()),
+    ("request_type", pa.string()),
+    ("category", pa.dictionary(pa.int32(), pa.string())),
+    ("actions", pa.list_(pa.string())),
+    ("priority", pa.dictionary(pa.int8(), pa.string())),
+    ("processed_timestamp", pa.timestamp("s")),
+])
+PARTITIONING = ds.partitioning(pa.schema([("day", pa.string())]), flavor="hive")
+
+def split_actions(actions) -> List[str]:
+    """Actions are stored as newline-joined text in the CSV/SQLite stores; archive them as a list."""
+    if isinstance(actions, (list, tuple)):
+        return [str(action) for action in actions]
+    if not isinstance(actions, str):
+        return []
+    return [line.strip() for line in actions.split('\n') if line.strip()]
+
+def to_archive_table(results: pd.DataFrame) -> pa.Table:
+    """Convert processed results (CSV layout) to a typed table plus its 'day' partition column."""
+    df = results.reindex(columns=[field.name for field in ARCHIVE_SCHEMA])
+    df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    df['processed_timestamp'] = pd.to_datetime(df['processed_timestamp'], errors='coerce')
+    df['actions'] = df['actions'].map(split_actions)
+    for column in ('from', 'subject', 'body', 'request_type', 'category', 'priority'):
+        df[column] = df[column].where(df[column].notna(), None).map(lambda v: None if v is None else str(v))
+    table = pa.Table.from_pandas(df, schema=ARCHIVE_SCHEMA, preserve_index=False)
+    day = df['date'].dt.strftime('%Y-%m-%d').fillna(UNKNOWN_DAY)
+    return table.append_column("day", pa.array(day, pa.string()))
+
+class EmailArchive:
+    """
+    Date-partitioned Parquet archive of processed emails (<root>/day=YYYY-MM-DD/*.parquet).
+
+    Columns are typed (timestamps, dictionary-encoded category/priority, list<string>
+    actions), so reports read only the columns they need, and date/priority filters
+    prune whole partitions and row groups instead of parsing the full history.
+    Every append adds a file; `compact` merges each day back into one.
+    """
+
+    def __init__(self, root: str = ARCHIVE_DIR):
+        self.root = root
+
+    def append(self, results: Iterable[Dict]) -> int:
+        """Write a batch of processed results; returns the number of rows archived."""
+        df = pd.DataFrame(list(results))
+        if df.empty:
+            return 0
+        # Time-ordered file names let compaction keep the latest copy of a re-processed email
+        ds.write_dataset(
+            to_archive_table(df), self.root, format="parquet", partitioning=PARTITIONING,
+            basename_template=f"part-{time.time_ns()}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore", max_rows_per_group=ROW_GROUP_SIZE
+        )
+        return len(df)
+
+    def dataset(self) -> ds.Dataset:
+        return ds.dataset(self.root, format="parquet", partitioning=PARTITIONING)
+
+    def _filter(self, date_from: Optional[str], date_to: Optional[str], priority: Optional[str]):
+        expression = None
+        def both(condition):
+            return condition if expression is None else expression & condition
+
+        if date_from:
+            start = pd.Timestamp(date_from)
+            expression = both((ds.field("day") >= start.strftime('%Y-%m-%d')) & (ds.field("date") >= start))
+        if date_to:
+            end = pd.Timestamp(date_to)
+            # A bare day includes everything on that day
+            if len(date_to) == 10:
+                end = end + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+            expression = both((ds.field("day") <= end.strftime('%Y-%m-%d')) & (ds.field("date") <= end))
+        if priority:
+            expression = both(ds.field("priority") == priority)
+        return expression
+
+    def to_table(self, columns: Optional[List[str]] = None, date_from: Optional[str] = None,
+                 date_to: Optional[str] = None, priority: Optional[str] = None) -> pa.Table:
+        """Read only `columns`, pushing the date range and priority down to partitions and row groups."""
+        if not os.path.isdir(self.root):
+            return ARCHIVE_SCHEMA.empty_table().select(columns or ARCHIVE_SCHEMA.names)
+        return self.dataset().to_table(columns=columns, filter=self._filter(date_from, date_to, priority))
+
+    def to_frame(self, columns: Optional[List[str]] = None, date_from: Optional[str] = None,
+                 date_to: Optional[str] = None, priority: Optional[str] = None) -> pd.DataFrame:
+        return self.to_table(columns, date_from, date_to, priority).to_pandas()
+
+    def compact(self) -> int:
+        """Merge each day's files into one, dropping superseded duplicates; returns days rewritten."""
+        if not os.path.isdir(self.root):
+            return 0
+        compacted = 0
+        for partition in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, partition)
+            files = sorted(name for name in os.listdir(directory) if name.endswith(".parquet"))
+            if len(files) < 2:
+                continue
+            table = pa.concat_tables(
+                [pq.read_table(os.path.join(directory, name), schema=ARCHIVE_SCHEMA) for name in files]
+            )
+            # Same key as the stores' upsert: the most recently written copy wins
+            df = table.to_pandas()
+            keep = ~df.duplicated(subset=['date', 'subject', 'from'], keep='last')
+            table = table.filter(pa.array(keep.to_numpy()))
+            table = table.take(pc.sort_indices(table, sort_keys=[("date", "ascending")]))
+
+            # Hidden name so readers never pick up a half-written file
+            tmp_path = os.path.join(directory, f".compacting-{time.time_ns()}.parquet")
+            pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_SIZE)
+            os.replace(tmp_path, os.path.join(directory, f"part-{time.time_ns()}-0.parquet"))
+            for name in files:
+                os.remove(os.path.join(directory, name))
+            compacted += 1
+            logger.info(f"Compacted {len(files)} files into one ({table.num_rows} rows) in {directory}")
+        return compacted
+
+def sla_report(archive: EmailArchive, month: str) -> pd.DataFrame:
+    """Emails per priority and category for one month ('YYYY-MM'), reading three columns only."""
+    start = pd.Timestamp(f"{month}-01")
+    end = (start + pd.offsets.MonthEnd(1)).strftime('%Y-%m-%d')
+    df = archive.to_frame(columns=["date", "priority", "category"], date_from=start.strftime('%Y-%m-%d'),
+                          date_to=end)
+    return df.groupby(["priority", "category"], observed=True).size().rename("emails").reset_index()
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain and query the Parquet archive of processed emails")
+    parser.add_argument("command", choices=["import", "compact", "report"])
+    parser.add_argument("--archive", default=ARCHIVE_DIR, help="Archive root directory")
+    parser.add_argument("--source", default="processed_emails.db",
+                        help="import: processed_emails.db or a CSV export such as processed_emails_database.csv")
+    parser.add_argument("--month", help="report: month to summarize, YYYY-MM")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    archive = EmailArchive(args.archive)
+    if args.command == "import":
+        rows = archive.append(load_history(args.source).to_dict('records'))
+        logger.info(f"Archived {rows} rows from {args.source} into {args.archive}")
+    elif args.command == "compact":
+        logger.info(f"Compacted {archive.compact()} partition(s) in {args.archive}")
+    else:
+        if not args.month:
+            parser.error("report needs --month YYYY-MM")
+        print(sla_report(archive, args.month).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
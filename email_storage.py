@@ -0,0 +1,407 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Column order of processed_emails_database.csv
+FIELDS = ['date', 'from', 'subject', 'body', 'request_type', 'category', 'actions', 'priority',
+          'processed_timestamp', 'thread_id', 'analysis_source']
+DEDUPE_KEY = ['date', 'subject', 'from']
+
+CSV_DATABASE_FILE = 'processed_emails_database.csv'
+SQLITE_DATABASE_FILE = 'processed_emails.db'
+# "sqlite" (default) or "csv" for the original rewrite-the-whole-file behaviour
+STORAGE_BACKEND = os.getenv("storage_backend", "sqlite")
+
+# "from" is an SQL keyword, so the sender is stored in a column named sender
+_SQL_COLUMNS = {field: ('sender' if field == 'from' else field) for field in FIELDS}
+# request_type is "<type> - <description>"; the bare type gets its own column so the
+# request_type filter is an equality seek that an index can return in date order
+_STORED_COLUMNS = list(_SQL_COLUMNS.values()) + ['request_type_base']
+_REQUEST_TYPE_BASE_SQL = (
+    "trim(CASE WHEN instr(request_type, ' - ') > 0 "
+    "THEN substr(request_type, 1, instr(request_type, ' - ') - 1) ELSE request_type END)"
+)
+
+# Lowercased address from "Name <address>" (or the bare address); indexed as an expression
+# so the sender filter needs no extra column
+_SENDER_ADDRESS_SQL = (
+    "lower(trim(CASE WHEN instr(sender, '<') > 0 AND instr(sender, '>') > instr(sender, '<') "
+    "THEN substr(sender, instr(sender, '<') + 1, instr(sender, '>') - instr(sender, '<') - 1) "
+    "ELSE sender END))"
+)
+# Every filtered listing is ordered newest first, so each filter column leads an index ending in date
+_QUERY_INDEXES = {
+    "idx_emails_priority_date": "priority, date",
+    "idx_emails_priority_category_date": "priority, category, date",
+    "idx_emails_category_date": "category, date",
+    "idx_emails_request_type_date": "request_type_base, date",
+    "idx_emails_sender_date": f"{_SENDER_ADDRESS_SQL}, date",
+    "idx_emails_thread_date": "thread_id, date",
+}
+QUERY_FILTERS = ('priority', 'category', 'request_type', 'sender', 'thread_id', 'date_from', 'date_to')
+# Row counts per (priority, category), kept current by triggers so unfiltered totals are a
+# read of a few rows instead of a scan of the whole history
+_COUNT_SQL = {
+    "add": ("INSERT INTO email_counts (priority, category, count) SELECT {row}.priority, {row}.category, 0 "
+            "WHERE NOT EXISTS (SELECT 1 FROM email_counts WHERE priority IS {row}.priority "
+            "AND category IS {row}.category); "
+            "UPDATE email_counts SET count = count + 1 WHERE priority IS {row}.priority "
+            "AND category IS {row}.category;"),
+    "remove": ("UPDATE email_counts SET count = count - 1 WHERE priority IS {row}.priority "
+               "AND category IS {row}.category;"),
+}
+_COUNT_TRIGGERS = {
+    "trg_emails_count_insert": ("AFTER INSERT ON emails", _COUNT_SQL["add"].format(row="NEW")),
+    "trg_emails_count_delete": ("AFTER DELETE ON emails", _COUNT_SQL["remove"].format(row="OLD")),
+    "trg_emails_count_update": ("AFTER UPDATE OF priority, category ON emails",
+                                _COUNT_SQL["remove"].format(row="OLD") + " " + _COUNT_SQL["add"].format(row="NEW")),
+}
+# Filters the count table can answer on its own
+_COUNTED_FILTERS = {'priority', 'category'}
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def request_type_base(request_type: Optional[str]) -> Optional[str]:
+    """The type part of "<type> - <description>"."""
+    if request_type is None:
+        return None
+    return request_type.split(' - ', 1)[0].strip()
+
+def encode_cursor(date: str, row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([date, row_id]).encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        date, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(date), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+class CsvEmailStore:
+    """Original storage: read the whole CSV, merge, dedupe, sort and rewrite it (O(N) per save)."""
+
+    def __init__(self, path: str = CSV_DATABASE_FILE):
+        self.path = path
+
+    def save(self, result: Dict) -> None:
+        self.save_many([result])
+
+    def save_many(self, results: List[Dict]) -> None:
+        if not results:
+            return
+        new_df = pd.DataFrame(results)
+        try:
+            existing_df = pd.read_csv(self.path)
+            combined_df = pd.concat([existing_df, new_df], ignore_index=True)
+            combined_df = combined_df.drop_duplicates(subset=DEDUPE_KEY, keep='last')
+        except FileNotFoundError:
+            combined_df = new_df
+
+        # Sort by date (latest first)
+        combined_df['date'] = pd.to_datetime(combined_df['date'])
+        combined_df = combined_df.sort_values(by='date', ascending=False)
+
+        # Write to a temp file first so a crash cannot leave a half-written database
+        tmp_path = f"{self.path}.tmp"
+        combined_df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.path)
+
+    def count(self) -> int:
+        try:
+            return len(pd.read_csv(self.path, usecols=['date']))
+        except FileNotFoundError:
+            return 0
+
+    def to_frame(self) -> pd.DataFrame:
+        try:
+            return pd.read_csv(self.path)
+        except FileNotFoundError:
+            return pd.DataFrame(columns=FIELDS)
+
+    def iter_keys(self) -> Iterator[Tuple[str, str, str]]:
+        """Yield the (date, subject, from) key of every stored email."""
+        try:
+            df = pd.read_csv(self.path, usecols=DEDUPE_KEY, dtype=str, keep_default_na=False)
+        except FileNotFoundError:
+            return
+        yield from zip(df['date'], df['subject'], df['from'])
+
+    def contains(self, key: Tuple[str, str, str]) -> bool:
+        return key in set(self.iter_keys())
+
+    def close(self) -> None:
+        pass
+
+class SqliteEmailStore:
+    """
+    Append-only SQLite store in WAL mode.
+
+    A unique index on (date, subject, from) gives upsert semantics equivalent to the CSV's
+    drop_duplicates(keep='last'), so persisting an email is an O(log N) index update
+    instead of a full-file rewrite.
+    """
+
+    def __init__(self, path: str = SQLITE_DATABASE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(f"{column} TEXT" for column in _STORED_COLUMNS)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS emails (id INTEGER PRIMARY KEY, {columns})")
+        # Databases created before a field existed get its column added (NULL for older rows)
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(emails)")}
+        for column in _STORED_COLUMNS:
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE emails ADD COLUMN {column} TEXT")
+        if 'request_type_base' not in existing:
+            self._conn.execute(f"UPDATE emails SET request_type_base = {_REQUEST_TYPE_BASE_SQL}")
+            # Its prefix-range predecessor on request_type could not serve the date order
+            self._conn.execute("DROP INDEX IF EXISTS idx_emails_request_type_date")
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_key ON emails (date, subject, sender)"
+        )
+        for name, columns in _QUERY_INDEXES.items():
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON emails ({columns})")
+        self._conn.commit()
+        self._create_counts()
+
+    def _create_counts(self) -> None:
+        """Create the per-(priority, category) count table, seeding it from existing rows once."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            created = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'email_counts'"
+            ).fetchone() is None
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS email_counts (priority TEXT, category TEXT, count INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_email_counts ON email_counts (priority, category)"
+            )
+            if created:
+                self._conn.execute(
+                    "INSERT INTO email_counts (priority, category, count) "
+                    "SELECT priority, category, COUNT(*) FROM emails GROUP BY priority, category"
+                )
+            for name, (event, body) in _COUNT_TRIGGERS.items():
+                self._conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+            self._conn.commit()
+        except sqlite3.Error:
+            self._conn.rollback()
+            raise
+
+    def _row(self, result: Dict) -> tuple:
+        row = []
+        for field in FIELDS:
+            value = result.get(field)
+            if value is not None and not isinstance(value, str):
+                value = None if pd.isna(value) else str(value)
+            row.append(value)
+        row.append(request_type_base(row[FIELDS.index('request_type')]))
+        return tuple(row)
+
+    def save(self, result: Dict) -> None:
+        self.save_many([result])
+
+    def save_many(self, results: Iterable[Dict]) -> None:
+        """Upsert a batch of results in a single transaction."""
+        rows = [self._row(result) for result in results]
+        if not rows:
+            return
+        columns = ", ".join(_STORED_COLUMNS)
+        placeholders = ", ".join("?" for _ in _STORED_COLUMNS)
+        key_columns = {_SQL_COLUMNS[field] for field in DEDUPE_KEY}
+        updates = ", ".join(
+            f"{column} = excluded.{column}" for column in _STORED_COLUMNS if column not in key_columns
+        )
+        # A repeated key overwrites the stored analysis, like drop_duplicates(keep='last')
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO emails ({columns}) VALUES ({placeholders}) "
+                f"ON CONFLICT (date, subject, sender) DO UPDATE SET {updates}",
+                rows
+            )
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def iter_keys(self) -> Iterator[Tuple[str, str, str]]:
+        """Yield the (date, subject, from) key of every stored email."""
+        with self._lock:
+            rows = self._conn.execute("SELECT date, subject, sender FROM emails").fetchall()
+        yield from rows
+
+    def contains(self, key: Tuple[str, str, str]) -> bool:
+        """Indexed lookup of a single (date, subject, from) key."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM emails WHERE date = ? AND subject = ? AND sender = ?", key
+            ).fetchone()
+        return row is not None
+
+    def _where(self, filters: Dict) -> Tuple[List[str], List]:
+        """SQL conditions for the query filters; every one of them can be served from an index."""
+        conditions, params = [], []
+        for field in ('priority', 'category', 'thread_id'):
+            if filters.get(field):
+                conditions.append(f"{field} = ?")
+                params.append(filters[field])
+        if filters.get('request_type'):
+            # Matches on the type part of "<type> - <description>"
+            conditions.append("request_type_base = ?")
+            params.append(request_type_base(filters['request_type']))
+        if filters.get('sender'):
+            conditions.append(f"{_SENDER_ADDRESS_SQL} = ?")
+            params.append(filters['sender'].strip().strip('<>').lower())
+        if filters.get('date_from'):
+            conditions.append("date >= ?")
+            params.append(filters['date_from'])
+        if filters.get('date_to'):
+            date_to = filters['date_to']
+            # A bare day includes everything on that day
+            conditions.append("date <= ?")
+            params.append(f"{date_to} 23:59:59" if len(date_to) == 10 else date_to)
+        return conditions, params
+
+    def query(self, filters: Optional[Dict] = None, limit: int = DEFAULT_PAGE_SIZE,
+              cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        One page of stored emails matching the filters, newest first.
+
+        Filters: priority, category, request_type (the type before " - "), sender (address), thread_id
+        (near-duplicate group), date_from and date_to ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'). Pagination is keyset-based on
+        (date, id), so a page costs an index seek regardless of how deep it is. Returns the
+        rows and the cursor of the next page (None on the last page).
+        """
+        conditions, params = self._where(filters or {})
+        if cursor:
+            date, row_id = decode_cursor(cursor)
+            conditions.append("(date < ? OR (date = ? AND id < ?))")
+            params += [date, date, row_id]
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        select = ", ".join(f"{column} AS \"{field}\"" for field, column in _SQL_COLUMNS.items())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # Fetch one extra row to learn whether another page exists
+        with self._lock:
+            cursor_rows = self._conn.execute(
+                f"SELECT id, {select} FROM emails {where} ORDER BY date DESC, id DESC LIMIT ?",
+                params + [limit + 1]
+            )
+            names = [description[0] for description in cursor_rows.description]
+            rows = [dict(zip(names, row)) for row in cursor_rows.fetchall()]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['date'], rows[-1]['id'])
+        return rows, next_cursor
+
+    def counts(self, filters: Optional[Dict] = None) -> Dict:
+        """
+        Number of matching emails in total and per category and priority.
+
+        Without filters, or filtered on priority/category only, this reads the maintained
+        count table; other filters count the matching rows through their index.
+        """
+        filters = {name: value for name, value in (filters or {}).items() if value}
+        conditions, params = self._where(filters)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            if set(filters) <= _COUNTED_FILTERS:
+                rows = self._conn.execute(
+                    f"SELECT priority, category, count FROM email_counts {where} "
+                    f"{'AND' if where else 'WHERE'} count > 0",
+                    params
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    f"SELECT priority, category, COUNT(*) FROM emails {where} GROUP BY priority, category",
+                    params
+                ).fetchall()
+
+        totals = {"total": 0, "by_priority": {}, "by_category": {}}
+        for priority, category, count in rows:
+            totals["total"] += count
+            totals["by_priority"][priority] = totals["by_priority"].get(priority, 0) + count
+            totals["by_category"][category] = totals["by_category"].get(category, 0) + count
+        return totals
+
+    def import_csv(self, path: str = CSV_DATABASE_FILE, chunksize: int = 10000) -> int:
+        """Load an existing CSV database; returns the number of rows read."""
+        total = 0
+        for chunk in pd.read_csv(path, chunksize=chunksize, dtype=str, keep_default_na=False):
+            self.save_many(chunk.to_dict('records'))
+            total += len(chunk)
+        logger.info(f"Imported {total} rows from {path} into {self.path}")
+        return total
+
+    def to_frame(self) -> pd.DataFrame:
+        """All stored emails in the original CSV column layout, latest first."""
+        select = ", ".join(f"{column} AS \"{field}\"" for field, column in _SQL_COLUMNS.items())
+        with self._lock:
+            return pd.read_sql_query(f"SELECT {select} FROM emails ORDER BY date DESC", self._conn)
+
+    def export_csv(self, path: str = CSV_DATABASE_FILE) -> int:
+        """Write the store out in the original CSV layout (latest first); returns the row count."""
+        df = self.to_frame()
+        df.to_csv(path, index=False)
+        logger.info(f"Exported {len(df)} rows from {self.path} to {path}")
+        return len(df)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+def load_history(path: str) -> pd.DataFrame:
+    """Read processed emails from the SQLite store (.db) or a CSV export."""
+    if path.endswith(".db"):
+        store = SqliteEmailStore(path)
+        try:
+            return store.to_frame()
+        finally:
+            store.close()
+    return pd.read_csv(path)
+
+def get_storage(backend: Optional[str] = None):
+    """Create the configured storage backend, seeding a new SQLite store from the legacy CSV."""
+    backend = (backend or STORAGE_BACKEND).lower()
+    if backend == "csv":
+        return CsvEmailStore()
+    if backend != "sqlite":
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+    store = SqliteEmailStore()
+    if store.count() == 0 and os.path.exists(CSV_DATABASE_FILE):
+        store.import_csv(CSV_DATABASE_FILE)
+    return store
+
+def main():
+    parser = argparse.ArgumentParser(description="Import/export the processed email database")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("csv_path", nargs="?", default=CSV_DATABASE_FILE)
+    parser.add_argument("--db", default=SQLITE_DATABASE_FILE, help="SQLite database path")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    store = SqliteEmailStore(args.db)
+    try:
+        if args.command == "import":
+            store.import_csv(args.csv_path)
+        else:
+            store.export_csv(args.csv_path)
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
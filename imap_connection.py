@@ -0,0 +1,179 @@
+import imaplib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, List, Optional, TypeVar
+
+from Email_parser import FETCH_BATCH_SIZE, BODY_BYTE_CAP, bulk_fetch_emails, connect_to_email
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# A connection unused for longer than this is checked with NOOP before it is trusted again
+KEEPALIVE_SECONDS = 5 * 60
+# Blocking reads fail after this long instead of hanging on a half-open socket
+SOCKET_TIMEOUT = 60
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 5 * 60
+# Extra connections used to fetch large UID batches in parallel
+IMAP_POOL_SIZE = int(os.getenv("imap_pool_size", "2"))
+
+# Errors that mean the connection itself is gone; other IMAP4.error responses are command failures
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+class ImapConnection:
+    """
+    A self-healing IMAP connection to one mailbox.
+
+    `mail` always returns a connected, selected session: one unused for KEEPALIVE_SECONDS
+    is probed with NOOP first, and a dead one is replaced, retrying with full-jitter
+    exponential backoff until the server is reachable again. Reconnecting re-SELECTs the
+    mailbox; callers resync by fetching from their UID watermark as usual. `generation`
+    changes on every reconnect so holders of the old session (e.g. a MailWatcher) can
+    tell it was replaced.
+    """
+
+    def __init__(self, server: Optional[str] = None, user: Optional[str] = None,
+                 password: Optional[str] = None, mailbox: str = "inbox",
+                 keepalive: float = KEEPALIVE_SECONDS, stop: Optional[threading.Event] = None):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.keepalive = keepalive
+        self.stop = stop or threading.Event()
+        self.generation = 0
+        self.reconnects = 0
+        self._mail = None
+        self._last_used = 0.0
+
+    @property
+    def mail(self):
+        if self._mail is not None and time.monotonic() - self._last_used > self.keepalive:
+            if not self.is_healthy():
+                logger.warning(f"IMAP connection to {self.mailbox} went stale, reconnecting")
+                self._drop()
+        if self._mail is None:
+            self.connect()
+        self.touch()
+        return self._mail
+
+    def touch(self) -> None:
+        """Record activity on the connection (e.g. after an IDLE wait returned normally)."""
+        self._last_used = time.monotonic()
+
+    def is_healthy(self) -> bool:
+        """NOOP round trip; also lets the server deliver pending EXISTS updates."""
+        try:
+            status, _ = self._mail.noop()
+            return status == "OK"
+        except CONNECTION_ERRORS + (imaplib.IMAP4.error,):
+            return False
+
+    def connect(self, max_attempts: Optional[int] = None) -> None:
+        """Open and select the mailbox, retrying with jittered backoff until it works or stop is set."""
+        attempt = 0
+        while not self.stop.is_set() and (max_attempts is None or attempt < max_attempts):
+            mail = connect_to_email(self.server, self.user, self.password, self.mailbox, timeout=SOCKET_TIMEOUT)
+            if mail:
+                self._mail = mail
+                self.generation += 1
+                if self.generation > 1:
+                    self.reconnects += 1
+                    logger.info(f"Reconnected to {self.mailbox} after {attempt + 1} attempt(s)")
+                return
+            delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * (2 ** attempt)))
+            attempt += 1
+            logger.warning(f"IMAP connection attempt {attempt} failed, retrying in {delay:.1f}s")
+            if max_attempts is None or attempt < max_attempts:
+                self.stop.wait(delay)
+        raise imaplib.IMAP4.abort(f"Could not connect to {self.mailbox}")
+
+    def reconnect(self) -> None:
+        self._drop()
+        self.connect()
+
+    def run(self, operation: Callable[[object], T], retries: int = 1) -> T:
+        """Run operation(mail), reconnecting and retrying if the connection drops underneath it."""
+        attempt = 0
+        while True:
+            try:
+                result = operation(self.mail)
+                self.touch()
+                return result
+            except CONNECTION_ERRORS as e:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.warning(f"IMAP connection to {self.mailbox} lost ({str(e)}), reconnecting")
+                self.reconnect()
+
+    def _drop(self) -> None:
+        if self._mail is not None:
+            try:
+                self._mail.logout()
+            except Exception:
+                pass
+        self._mail = None
+
+    def close(self) -> None:
+        self._drop()
+
+class ImapConnectionPool:
+    """
+    A few managed connections to the same mailbox, borrowed one caller at a time.
+
+    Used to split large UID batches across sessions so header/body fetches run in
+    parallel instead of back to back on the single watcher connection.
+    """
+
+    def __init__(self, size: int = IMAP_POOL_SIZE, **connection_args):
+        self.size = max(1, size)
+        self._connection_args = connection_args
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, opening a new one while the pool is below its size."""
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            connection = ImapConnection(**self._connection_args) if create else self._idle.get()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def _fetch_chunk(self, uids: List[int], body_byte_cap: int) -> List[dict]:
+        with self.connection() as connection:
+            def fetch(mail):
+                # NOOP first: a session only sees messages that arrived after its SELECT once told so
+                mail.noop()
+                return bulk_fetch_emails(mail, uids, body_byte_cap)
+            return connection.run(fetch)
+
+    def bulk_fetch(self, uids: List[int], body_byte_cap: int = BODY_BYTE_CAP) -> List[dict]:
+        """bulk_fetch_emails with the UID batches spread over the pool; results stay in UID order."""
+        chunks = [uids[start:start + FETCH_BATCH_SIZE] for start in range(0, len(uids), FETCH_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=min(self.size, len(chunks))) as executor:
+            results = executor.map(lambda chunk: self._fetch_chunk(chunk, body_byte_cap), chunks)
+            return [email_data for chunk_emails in results for email_data in chunk_emails]
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
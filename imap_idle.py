@@ -0,0 +1,151 @@
+import imaplib
+import logging
+import re
+import select
+import ssl
+import time
+
+logger = logging.getLogger(__name__)
+
+# RFC 2177: servers may drop an IDLE after 30 minutes, so re-issue it well before that
+IDLE_RENEW_SECONDS = 25 * 60
+# Polling bounds used when the server does not advertise IDLE
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 60
+
+_NEW_MAIL_RESPONSE = re.compile(rb"\* \d+ (EXISTS|RECENT)", re.IGNORECASE)
+
+def supports_idle(mail):
+    """Check whether the server advertises the IDLE capability."""
+    return "IDLE" in getattr(mail, "capabilities", ())
+
+def _buffered(mail):
+    """
+    Whether imaplib's reader already holds unread bytes (e.g. an EXISTS that arrived in the
+    same packet as the IDLE continuation); select() on the socket cannot see those.
+    """
+    sock = mail.sock
+    timeout = sock.gettimeout()
+    # peek() returns buffered bytes without touching the socket; with an empty buffer it
+    # tries one read, which must not block here
+    sock.settimeout(0)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+def _data_pending(mail, timeout):
+    """Wait up to `timeout` seconds for the server to send something."""
+    sock = mail.sock
+    if _buffered(mail):
+        return True
+    # TLS may already hold decrypted bytes that select() cannot see
+    if hasattr(sock, "pending") and sock.pending():
+        return True
+    readable, _, _ = select.select([sock], [], [], max(timeout, 0))
+    return bool(readable)
+
+def _announced_before_idle(mail):
+    """
+    Pop the EXISTS/RECENT counts imaplib collected during earlier commands and report
+    whether one grew past the first (the fetch's SELECT); the server will not repeat that
+    announcement once IDLE starts.
+    """
+    grown = False
+    for name in ("EXISTS", "RECENT"):
+        counts = [int(value) for value in mail.untagged_responses.pop(name, []) if value and value.isdigit()]
+        if counts and max(counts) > counts[0]:
+            grown = True
+    return grown
+
+def idle_wait(mail, timeout=IDLE_RENEW_SECONDS):
+    """
+    Issue IMAP IDLE on the selected mailbox and block until new mail or timeout.
+
+    imaplib has no IDLE support before Python 3.14, so the command is driven by hand on
+    the existing connection. Returns True when the server reported EXISTS/RECENT.
+    """
+    # Mail that arrived during the last SEARCH/FETCH was announced then, not during IDLE
+    if _announced_before_idle(mail):
+        return True
+
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    new_mail = False
+
+    # Wait for the continuation; untagged updates may arrive before it
+    while True:
+        line = mail._get_line()
+        if line.startswith(b"+"):
+            break
+        if line.startswith(tag):
+            mail.tagged_commands.pop(tag, None)
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line.decode(errors='replace')}")
+        if _NEW_MAIL_RESPONSE.match(line):
+            new_mail = True
+
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not _data_pending(mail, remaining):
+            break
+        if _NEW_MAIL_RESPONSE.match(mail._get_line()):
+            new_mail = True
+
+    mail.send(b"DONE\r\n")
+    # Drain anything the server sent until IDLE is acknowledged
+    while not mail._get_line().startswith(tag):
+        pass
+    mail.tagged_commands.pop(tag, None)
+    return new_mail
+
+class AdaptivePoller:
+    """Poll interval that shrinks while mail is arriving and backs off while the mailbox is quiet."""
+
+    def __init__(self, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL, backoff=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def next_interval(self, found_mail):
+        """Return how long to sleep before the next poll."""
+        if found_mail:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+class MailWatcher:
+    """Blocks until the mailbox may have new mail: IDLE push when available, adaptive polling otherwise."""
+
+    def __init__(self, mail, idle_timeout=IDLE_RENEW_SECONDS, poller=None):
+        self.mail = mail
+        self.idle_timeout = idle_timeout
+        self.poller = poller or AdaptivePoller()
+        self.use_idle = supports_idle(mail)
+        logger.info(f"Waiting for new mail using {'IMAP IDLE' if self.use_idle else 'adaptive polling'}")
+
+    def wait(self, found_mail=False):
+        """
+        Block until the next fetch should run.
+
+        Args:
+            found_mail (bool): Whether the previous fetch returned any emails (drives polling backoff)
+
+        Returns:
+            bool: True if the server signalled new mail, False on timeout or a plain poll tick
+        """
+        if self.use_idle:
+            try:
+                return idle_wait(self.mail, self.idle_timeout)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                logger.warning(f"IDLE failed, falling back to polling: {str(e)}")
+                self.use_idle = False
+
+        time.sleep(self.poller.next_interval(found_mail))
+        return False
@@ -1,20 +1,29 @@
 import os
+import time
 from datetime import datetime
-import pandas as pd
 from dotenv import load_dotenv
 import logging
-import time  # Added missing import
-from Email_parser import connect_to_email, fetch_incoming_emails
+from imap_connection import IMAP_POOL_SIZE, ImapConnection, ImapConnectionPool
 from Data_cleaning import EmailProcessor
+from email_storage import get_storage
+from dedup_index import SeenIndex, email_key
+from Email_parser import flatten_body
+from latest_result import LATEST_RESULT
+from processing_pipeline import ProcessingPipeline
+from mailbox_shards import ShardedSource, load_mailbox_config
+from metrics import (DASHBOARD_LAG, EMAILS_SAVED, LAST_DASHBOARD_UPDATE, LOG_FORMAT, STAGE_ERRORS,
+                     track_stage)
 
-# Set up logging
+# Set up logging; force replaces the console-only config Data_cleaning installs on import,
+# and each line carries the trace ID of the email being handled
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
         logging.FileHandler('email_processing.log'),
         logging.StreamHandler()
-    ]
+    ],
+    force=True
 )
 logger = logging.getLogger(__name__)
 
@@ -23,84 +32,87 @@ class IntegratedEmailSystem:
         load_dotenv()
         self.gemini_api_key = os.getenv("gemini_api")
         self.email_processor = EmailProcessor(self.gemini_api_key)
+        self.storage = get_storage()
+        # Keys of everything already stored, so known emails never reach Gemini again
+        self.seen_index = SeenIndex.from_storage(self.storage, mode=os.getenv("dedup_mode", "set"))
+        # Optional Parquet archive for reporting; needs pyarrow, so only loaded when enabled
+        self.archive = None
+        if os.getenv("archive_results", "false").lower() == "true":
+            from email_archive import EmailArchive
+            self.archive = EmailArchive()
+        self.connection = None
+        self.connection_pool = None
         self.mail_connection = None
         
     def initialize_connection(self):
-        """Initialize email connection"""
-        self.mail_connection = connect_to_email()
-        if not self.mail_connection:
-            raise ConnectionError("Failed to connect to email server")
+        """Open the managed email connection (it reconnects by itself) and the parallel fetch pool"""
+        self.connection = ImapConnection()
+        if IMAP_POOL_SIZE > 1:
+            self.connection_pool = ImapConnectionPool(stop=self.connection.stop)
+        self.mail_connection = self.connection.mail
             
-    def process_single_email(self, email_data):
-        """Process a single email and return analysis"""
-        try:
-            analysis = self.email_processor.analyze_email(
-                email_data['subject'],
-                email_data['body']
-            )
-            
-            result = {
-                'date': email_data['date'],
-                'from': email_data['from'],
-                'subject': email_data['subject'],
-                'body': email_data['body'],
-                'request_type': analysis['request_type'],
-                'category': analysis['category'],
-                'actions': '\n'.join(analysis['actions']),
-                'priority': analysis['priority'],
-                'processed_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
-            
-            return result
-        except Exception as e:
-            logger.error(f"Error processing email: {str(e)}")
-            return None
+    def is_known_email(self, email_data):
+        """Check the dedup index for an email that was already analyzed and stored"""
+        return email_key(email_data) in self.seen_index
+
+    def build_result(self, email_data, analysis):
+        """Combine fetched email fields with their analysis into a database row"""
+        return {
+            'date': email_data['date'],
+            'from': email_data['from'],
+            'subject': email_data['subject'],
+            # Fetched bodies keep their line breaks for analysis; stored ones fit a single cell
+            'body': flatten_body(email_data['body']),
+            'request_type': analysis['request_type'],
+            'category': analysis['category'],
+            'actions': '\n'.join(analysis['actions']),
+            'priority': analysis['priority'],
+            'processed_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'thread_id': analysis.get('thread_id'),
+            'analysis_source': analysis.get('analysis_source')
+        }
 
-    def save_results(self, results, filename='processed_emails_database.csv'):
+    @track_stage("save_results")
+    def save_results(self, results):
         """
-        Save processed results to a single CSV file
+        Persist processed results through the configured storage backend
         
         Args:
-            results (dict): Dictionary containing processed email data
-            filename (str): Name of the file to save results (defaults to processed_emails_database.csv)
+            results (dict or list): One processed email, or every result from a fetch cycle
+                (committed together in a single transaction)
         """
+        if isinstance(results, dict):
+            results = [results]
+        if not results:
+            return
         try:
-            # Convert single result to DataFrame
-            new_df = pd.DataFrame([results])
-            
-            # Try to read existing file
-            try:
-                existing_df = pd.read_csv(filename)
-                
-                # Concatenate new results with existing data
-                combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-                
-                # Remove any duplicates based on date, subject, and from fields
-                combined_df = combined_df.drop_duplicates(
-                    subset=['date', 'subject', 'from'], 
-                    keep='last'
-                )
-                
-                # Sort by date (latest first)
-                combined_df['date'] = pd.to_datetime(combined_df['date'])
-                combined_df = combined_df.sort_values(by='date', ascending=False)
-                
-                # Save updated DataFrame
-                combined_df.to_csv(filename, index=False)
-                
-            except FileNotFoundError:
-                # If file doesn't exist, create it with the new data
-                new_df.to_csv(filename, index=False)
-                
-            logger.info(f"Results successfully saved to {filename}")
+            self.storage.save_many(results)
+            EMAILS_SAVED.inc(len(results))
+            self.seen_index.update(email_key(result) for result in results)
+            logger.info(f"{len(results)} result(s) successfully saved to {self.storage.path}")
+            if self.archive:
+                self.archive.append(results)
             
             # Generate HTML display for the latest email
-            self.update_html_display(results)
+            self.update_html_display(results[-1])
+            self.record_dashboard_lag(results)
             
         except Exception as e:
-            logger.error(f"Error saving results to {filename}: {str(e)}")
+            logger.error(f"Error saving results to {self.storage.path}: {str(e)}")
             raise
 
+    def record_dashboard_lag(self, results):
+        """Observe mailbox-to-dashboard lag (from each email's Date header) for saved results"""
+        now = time.time()
+        LAST_DASHBOARD_UPDATE.set(now)
+        for result in results:
+            try:
+                sent = datetime.strptime(str(result['date']), '%Y-%m-%d %H:%M:%S').timestamp()
+            except ValueError:
+                continue
+            DASHBOARD_LAG.observe(max(0.0, now - sent))
+
+    @track_stage("update_html_display")
     def update_html_display(self, latest_email):
         try:
             html_template = '''
@@ -108,8 +120,13 @@ class IntegratedEmailSystem:
             <html>
             <head>
                 <title>Email Processing Results</title>
-                <meta http-equiv="refresh" content="60">
                 <link rel="stylesheet" href="styles.css">
+                <script>
+                    // Reload as soon as the server pushes a newly processed email
+                    new EventSource("/events").addEventListener("email", function () {{
+                        window.location.reload();
+                    }});
+                </script>
             </head>
             <body>
                 <header>
@@ -153,53 +170,63 @@ class IntegratedEmailSystem:
             )
             with open('latest_email.html', 'w', encoding='utf-8') as f:
                 f.write(html_content)
+            # Serve from memory and notify live dashboards without touching the filesystem
+            LATEST_RESULT.publish(latest_email, html_content)
             logger.info("HTML display updated successfully")
         except Exception as e:
+            STAGE_ERRORS.inc(stage="update_html_display")
             logger.error(f"Error updating HTML display: {str(e)}")
 
 
+    def log_high_priority(self, results):
+        """Log a warning for every high priority result"""
+        for result in results:
+            if result['priority'].lower() == 'high':
+                logger.warning(
+                    f"High priority email detected!\n"
+                    f"From: {result['from']}\n"
+                    f"Subject: {result['subject']}\n"
+                    f"Type: {result['request_type']}"
+                )
+
+    def log_likely_high_priority(self, email_data, source="keywords"):
+        """Early warning for a likely High priority email, from its keywords or a partial analysis"""
+        logger.warning(
+            f"Likely high priority email received (from {source}, pending full analysis)\n"
+            f"From: {email_data['from']}\n"
+            f"Subject: {email_data['subject']}"
+        )
+
     def run_continuous_processing(self):
         """Continuously monitor and process incoming emails"""
+        pipeline = None
         try:
-            self.initialize_connection()
+            mailboxes = load_mailbox_config()
+            if mailboxes:
+                # Configured mailboxes are fetched by a pool of shard processes
+                source = ShardedSource(mailboxes)
+            else:
+                self.initialize_connection()
+                source = None
             logger.info("Starting continuous email processing...")
-            
-            while True:
-                # Fetch new emails
-                new_emails = fetch_incoming_emails(self.mail_connection)
-                
-                if new_emails:
-                    logger.info(f"Found {len(new_emails)} new emails")
-                    
-                    for email_data in new_emails:
-                        # Process each email
-                        result = self.process_single_email(email_data)
-                        
-                        if result:
-                            # Save results
-                            self.save_results(result)
-                            
-                            # Log high priority items
-                            if result['priority'].lower() == 'high':
-                                logger.warning(
-                                    f"High priority email detected!\n"
-                                    f"From: {result['from']}\n"
-                                    f"Subject: {result['subject']}\n"
-                                    f"Type: {result['request_type']}"
-                                )
-                                
-                else:
-                    logger.info("No new emails found")
-                    
-                time.sleep(60)  # Check every minute
+            # Fetch, analysis and persistence run as concurrent stages over bounded queues
+            pipeline = ProcessingPipeline(self, source=source)
+            pipeline.start()
+            pipeline.wait()
+            logger.error("Email processing pipeline stopped unexpectedly")
                 
         except KeyboardInterrupt:
             logger.info("Stopping email processing...")
         except Exception as e:
             logger.error(f"Error in continuous processing: {str(e)}")
         finally:
-            if self.mail_connection:
-                self.mail_connection.logout()
+            if pipeline:
+                # Persist everything already fetched; the rest is re-fetched next run
+                pipeline.stop()
+            if self.connection_pool:
+                self.connection_pool.close()
+            if self.connection:
+                self.connection.close()
 
 def main():
     system = IntegratedEmailSystem()
@@ -0,0 +1,145 @@
+import re
+from typing import Dict, FrozenSet, List, Tuple
+
+# Keywords for category detection, checked in this order (first match wins)
+CATEGORY_KEYWORDS = {
+    "claim": ["claim", "accident", "damage", "injury", "loss", "medical", "hospital"],
+    "billing": ["bill", "payment", "premium", "charge", "refund", "overcharge", "cost"],
+    "policy_update": ["update", "change", "modify", "cancel", "cancellation"],
+    "premium_inquiry": ["quote", "cost", "price", "rate", "calculation"],
+    "technical_support": ["portal", "website", "login", "technical", "error", "access", "online"]
+}
+
+# (trigger keywords, [(refining keywords, request type), ...], default request type), in priority order
+REQUEST_TYPE_RULES = [
+    (["claim", "accident", "damage", "injury"],
+     [(["status"], "Claim Status Inquiry")],
+     "New Claim Submission"),
+    (["bill", "payment", "charge", "overcharge"],
+     [(["dispute", "overcharge"], "Billing Dispute")],
+     "Premium Payment Request"),
+    (["policy", "coverage"],
+     [(["cancel"], "Policy Cancellation Request"), (["update", "change"], "Policy Update Request")],
+     "Policy Information Request"),
+    (["portal", "login", "technical", "website"],
+     [],
+     "Technical Support Request"),
+]
+DEFAULT_REQUEST_TYPE = "General Inquiry"
+
+# Terms that make an email likely High priority (accidents, injuries, outages)
+HIGH_PRIORITY_KEYWORDS = ["accident", "injury", "hospital", "emergency", "urgent", "outage"]
+MEDIUM_PRIORITY_REQUEST_TYPES = {
+    "New Claim Submission", "Claim Status Inquiry", "Billing Dispute", "Premium Payment Request",
+    "Policy Cancellation Request", "Policy Update Request", "Technical Support Request"
+}
+
+# Irregular forms folded onto their keyword; regular inflections come from _word_forms
+KEYWORD_ALIASES = {
+    "cancelled": "cancel", "canceled": "cancel", "cancelling": "cancel", "canceling": "cancel",
+    "cancellation": "cancel", "cancellations": "cancel",
+    "policies": "policy", "policyholder": "policy", "policyholders": "policy",
+    "injuries": "injury", "injured": "injury",
+    "modified": "modify", "modifies": "modify", "modification": "modify",
+    "calculated": "calculation", "calculate": "calculation",
+    "logins": "login",
+}
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+def _word_forms(word: str) -> List[str]:
+    """Regular inflections of a keyword (claim -> claims/claimed/claiming, change -> changing)."""
+    forms = [word, word + "s", word + "es", word + "ed", word + "ing"]
+    if word.endswith("e"):
+        forms += [word + "d", word[:-1] + "ing"]
+    if word.endswith("y"):
+        forms += [word[:-1] + "ies", word[:-1] + "ied"]
+    return forms
+
+class KeywordClassifier:
+    """
+    Single-pass keyword classifier used as the fast local fallback for analyze_email.
+
+    All keyword tables are compiled once into a map of accepted word forms. Each email is
+    tokenized in one regex pass and its words are looked up in that map, so matching is
+    whole-word ("bill" matches "billing" but not "billion") and the set of hits drives
+    category, request type and a priority hint together.
+    """
+
+    def __init__(self, category_keywords: Dict[str, List[str]] = None,
+                 request_type_rules: List[Tuple] = None,
+                 high_priority_keywords: List[str] = None):
+        self.category_keywords = category_keywords or CATEGORY_KEYWORDS
+        self.request_type_rules = request_type_rules or REQUEST_TYPE_RULES
+        self.high_priority_keywords = frozenset(high_priority_keywords or HIGH_PRIORITY_KEYWORDS)
+
+        vocabulary = set(self.high_priority_keywords)
+        for keywords in self.category_keywords.values():
+            vocabulary.update(keywords)
+        for triggers, refinements, _ in self.request_type_rules:
+            vocabulary.update(triggers)
+            for keywords, _ in refinements:
+                vocabulary.update(keywords)
+        # Every accepted surface form maps back to its keyword; aliases are pre-resolved
+        self.forms = {}
+        for word in vocabulary:
+            word = KEYWORD_ALIASES.get(word, word)
+            for form in _word_forms(word):
+                self.forms.setdefault(form, word)
+        self.forms.update(KEYWORD_ALIASES)
+        self._form_set = frozenset(self.forms)
+
+        # Resolve aliases in the tables too so matching is plain set intersection
+        self._categories = [
+            (category.replace('_', ' ').title(), frozenset(KEYWORD_ALIASES.get(k, k) for k in keywords))
+            for category, keywords in self.category_keywords.items()
+        ]
+        self._rules = [
+            (frozenset(KEYWORD_ALIASES.get(k, k) for k in triggers),
+             [(frozenset(KEYWORD_ALIASES.get(k, k) for k in keywords), name) for keywords, name in refinements],
+             default)
+            for triggers, refinements, default in self.request_type_rules
+        ]
+
+    def find_keywords(self, text: str) -> FrozenSet[str]:
+        """Return the canonical keywords present in already-lowercased text."""
+        return self._keywords_in(WORD_PATTERN.findall(text))
+
+    def _keywords_in(self, words: List[str]) -> FrozenSet[str]:
+        return frozenset(self.forms[form] for form in self._form_set.intersection(words))
+
+    def request_type_from(self, found: FrozenSet[str]) -> str:
+        for triggers, refinements, default in self._rules:
+            if found & triggers:
+                for keywords, name in refinements:
+                    if found & keywords:
+                        return name
+                return default
+        return DEFAULT_REQUEST_TYPE
+
+    def category_from(self, found: FrozenSet[str]) -> str:
+        for category, keywords in self._categories:
+            if found & keywords:
+                return category
+        return "Other"
+
+    def priority_from(self, found: FrozenSet[str], request_type: str) -> str:
+        if found & self.high_priority_keywords:
+            return "High"
+        if request_type in MEDIUM_PRIORITY_REQUEST_TYPES:
+            return "Medium"
+        return "Low"
+
+    def classify_keywords(self, found: FrozenSet[str]) -> Dict[str, str]:
+        request_type = self.request_type_from(found)
+        return {
+            "request_type": request_type,
+            "category": self.category_from(found),
+            "priority": self.priority_from(found, request_type),
+        }
+
+    def classify(self, subject: str, body: str) -> Dict[str, str]:
+        """Classify one email: request_type, category and priority hint from a single scan."""
+        return self.classify_keywords(self.find_keywords(f"{subject} {body}".lower()))
+
+DEFAULT_CLASSIFIER = KeywordClassifier()
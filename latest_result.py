@@ -0,0 +1,52 @@
+import hashlib
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+class LatestResultBroker:
+    """
+    In-memory hand-off of the latest processed email from the processing thread to the web app.
+
+    The processor publishes each rendered result; HTTP handlers read the current snapshot
+    (with a stable ETag and Last-Modified) or block until a newer version is published.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.version = 0
+        self.html = None
+        self.result = None
+        self.etag = None
+        self.last_modified = None
+
+    def publish(self, result: Optional[Dict], html: str) -> int:
+        """Store a new latest result and wake every waiting listener; returns its version."""
+        with self._condition:
+            self.version += 1
+            self.html = html
+            self.result = result
+            self.etag = hashlib.sha1(html.encode("utf-8")).hexdigest()
+            # HTTP dates have one-second resolution
+            self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+            self._condition.notify_all()
+            return self.version
+
+    def snapshot(self) -> Dict:
+        with self._condition:
+            return {
+                "version": self.version,
+                "html": self.html,
+                "result": self.result,
+                "etag": self.etag,
+                "last_modified": self.last_modified,
+            }
+
+    def wait_for_update(self, since_version: int, timeout: float) -> Optional[Dict]:
+        """Block until a version newer than since_version exists; None on timeout."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.version > since_version, timeout):
+                return None
+        return self.snapshot()
+
+# Shared by the processing thread and the Flask app running in the same process
+LATEST_RESULT = LatestResultBroker()
@@ -0,0 +1,194 @@
+import argparse
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+import joblib
+import pandas as pd
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+
+from email_storage import load_history
+
+logger = logging.getLogger(__name__)
+
+LOCAL_MODEL_FILE = "local_classifier.joblib"
+# Emails the local model is less sure about than this still go to Gemini
+CONFIDENCE_THRESHOLD = float(os.getenv("local_confidence_threshold", "0.85"))
+TARGETS = ("request_type", "category", "priority")
+
+def normalize_labels(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Turn stored LLM output into training labels.
+
+    The LLM writes request types as "<type> - <description>", so only the type is kept;
+    rows whose labels are missing or "Unknown" are dropped.
+    """
+    df = df.copy()
+    df['request_type'] = df['request_type'].astype(str).str.split(' - ', n=1).str[0].str.strip()
+    df['category'] = df['category'].astype(str).str.strip().str.title()
+    df['priority'] = df['priority'].astype(str).str.strip().str.capitalize()
+    for target in TARGETS:
+        df = df[~df[target].isin(['', 'Nan', 'nan', 'None', 'Unknown'])]
+    return df
+
+def llm_labelled(history: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rows whose analysis came from the LLM.
+
+    Local predictions, near-duplicate and cache reuse and keyword fallbacks are stored with
+    their analysis_source and left out, so the model never learns from its own output.
+    Histories written before the column existed are used as they are.
+    """
+    if 'analysis_source' not in history:
+        return history
+    labelled = history[history['analysis_source'] == 'llm']
+    if len(labelled) < len(history):
+        logger.info(f"Using {len(labelled)} of {len(history)} emails; the rest were not labelled by the LLM")
+    return labelled
+
+def email_text(subjects: pd.Series, bodies: pd.Series) -> pd.Series:
+    return subjects.fillna('').astype(str) + ' ' + bodies.fillna('').astype(str)
+
+def _build_model(labels: pd.Series) -> Pipeline:
+    """TF-IDF + logistic regression, sigmoid-calibrated when every class has enough examples."""
+    classifier = LogisticRegression(max_iter=1000, class_weight='balanced')
+    if labels.value_counts().min() >= 3:
+        classifier = CalibratedClassifierCV(classifier, method='sigmoid', cv=3)
+    return Pipeline([
+        ('tfidf', TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=1, max_features=50000)),
+        ('classifier', classifier),
+    ])
+
+class LocalClassifier:
+    """
+    CPU-only first tier for email triage, trained on the labelled history.
+
+    One TF-IDF + logistic regression model per target (request type, category, priority).
+    The overall confidence is the lowest of the three top-class probabilities, so an email
+    is only handled locally when every field is confident.
+    """
+
+    def __init__(self, models: Dict[str, Pipeline], trained_on: int = 0):
+        self.models = models
+        self.trained_on = trained_on
+        self._lock = threading.Lock()
+        self.compared = 0
+        self.agreed = {target: 0 for target in TARGETS}
+
+    @classmethod
+    def train(cls, history: pd.DataFrame) -> "LocalClassifier":
+        history = normalize_labels(llm_labelled(history))
+        texts = email_text(history['subject'], history['body'])
+        models = {}
+        for target in TARGETS:
+            labels = history[target]
+            if labels.nunique() < 2:
+                raise ValueError(f"Need at least two distinct {target} labels to train, got {labels.nunique()}")
+            models[target] = _build_model(labels).fit(texts, labels)
+        logger.info(f"Trained local classifier on {len(history)} labelled emails")
+        return cls(models, trained_on=len(history))
+
+    def predict(self, subject: str, body: str) -> Dict:
+        """Predict all targets for one email; includes an overall 'confidence' in [0, 1]."""
+        return self.predict_frame(pd.Series([subject]), pd.Series([body]))[0]
+
+    def predict_frame(self, subjects: pd.Series, bodies: pd.Series) -> list:
+        texts = email_text(subjects, bodies)
+        predictions = [{} for _ in range(len(texts))]
+        confidences = [1.0] * len(texts)
+        for target, model in self.models.items():
+            probabilities = model.predict_proba(texts)
+            classes = model.classes_
+            for i, row in enumerate(probabilities):
+                best = row.argmax()
+                predictions[i][target] = classes[best]
+                confidences[i] = min(confidences[i], float(row[best]))
+        for prediction, confidence in zip(predictions, confidences):
+            prediction['confidence'] = confidence
+        return predictions
+
+    def record_agreement(self, local: Dict, llm: Dict) -> None:
+        """Compare a local prediction with the LLM's answer for the same email."""
+        llm = normalize_labels(pd.DataFrame([{target: llm.get(target) for target in TARGETS}]))
+        if llm.empty:
+            return
+        with self._lock:
+            self.compared += 1
+            for target in TARGETS:
+                if local.get(target) == llm.iloc[0][target]:
+                    self.agreed[target] += 1
+
+    def agreement_stats(self) -> Dict[str, float]:
+        """Live agreement rate with the LLM per target, over emails that were sent to both."""
+        with self._lock:
+            stats = {"compared": self.compared}
+            for target in TARGETS:
+                stats[target] = self.agreed[target] / self.compared if self.compared else 0.0
+            return stats
+
+    def save(self, path: str = LOCAL_MODEL_FILE) -> None:
+        joblib.dump({"models": self.models, "trained_on": self.trained_on}, path)
+
+    @classmethod
+    def load(cls, path: str = LOCAL_MODEL_FILE) -> "LocalClassifier":
+        data = joblib.load(path)
+        return cls(data["models"], trained_on=data.get("trained_on", 0))
+
+    @classmethod
+    def load_if_available(cls, path: str = LOCAL_MODEL_FILE) -> Optional["LocalClassifier"]:
+        """Load a trained model, or None (every email goes to the LLM) if there is none yet."""
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls.load(path)
+        except Exception as e:
+            logger.error(f"Could not load local classifier from {path}: {str(e)}")
+            return None
+
+def evaluate(history: pd.DataFrame, threshold: float = CONFIDENCE_THRESHOLD, test_size: float = 0.2) -> Dict:
+    """
+    Hold-out agreement of the local model with the LLM labels in the history.
+
+    Reports overall agreement per target, plus the share of emails that would be handled
+    locally at `threshold` and how often those confident answers agree with the LLM.
+    """
+    history = normalize_labels(llm_labelled(history))
+    train_df, test_df = train_test_split(history, test_size=test_size, random_state=42)
+    classifier = LocalClassifier.train(train_df)
+    predictions = pd.DataFrame(
+        classifier.predict_frame(test_df['subject'], test_df['body']), index=test_df.index
+    )
+    confident = predictions['confidence'] >= threshold
+
+    report = {"test_emails": len(test_df), "threshold": threshold, "local_share": float(confident.mean())}
+    for target in TARGETS:
+        matches = predictions[target] == test_df[target]
+        report[f"{target}_agreement"] = float(matches.mean())
+        report[f"{target}_agreement_when_confident"] = float(matches[confident].mean()) if confident.any() else None
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the local triage classifier")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--data", default="processed_emails.db",
+                        help="Labelled history: processed_emails.db or a CSV such as processed_emails_database.csv")
+    parser.add_argument("--model", default=LOCAL_MODEL_FILE)
+    parser.add_argument("--threshold", type=float, default=CONFIDENCE_THRESHOLD)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    history = load_history(args.data)
+    if args.command == "train":
+        LocalClassifier.train(history).save(args.model)
+        logger.info(f"Local classifier saved to {args.model}")
+    else:
+        for name, value in evaluate(history, args.threshold).items():
+            print(f"{name}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import imaplib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from typing import Dict, Iterable, List
+
+from Email_parser import IMAP_SERVER, UID_STATE_FILE, fetch_new_emails, load_uid_state, mailbox_key, save_uid_state
+from imap_connection import CONNECTION_ERRORS, ImapConnection
+from imap_idle import AdaptivePoller, MailWatcher
+from metrics import EMAILS_FETCHED
+from processing_pipeline import PIPELINE_QUEUE_SIZE, WatermarkTracker
+
+logger = logging.getLogger(__name__)
+
+# List of accounts to ingest, e.g.
+# [{"server": "imap.gmail.com", "user": "claims-eu@example.com", "password_env": "CLAIMS_EU_PASSWORD",
+#   "folders": ["inbox", "Claims"]}]
+# Without this file the processor reads the single account from .env as before
+MAILBOX_CONFIG_FILE = os.getenv("mailbox_config", "mailboxes.json")
+# One watermark file per mailbox, so shard processes never rewrite each other's state
+UID_STATE_DIR = "uid_state"
+# Fetch processes; 0 means one per mailbox, capped at the CPU count
+INGEST_PROCESSES = int(os.getenv("ingest_processes", "0"))
+# A shard with a single mailbox IDLEs at most this long before handling acks/shutdown
+SHARD_IDLE_SECONDS = 30
+# Initial connection attempts before a shard gives up on a mailbox (e.g. wrong credentials)
+STARTUP_CONNECT_ATTEMPTS = 3
+# How long a stopping shard waits for the final acknowledgements of its emails
+SHARD_ACK_TIMEOUT = 60
+STATS_INTERVAL = 60
+_POLL_SECONDS = 0.5
+
+def load_mailbox_config(path: str = MAILBOX_CONFIG_FILE) -> List[Dict]:
+    """
+    Expand the mailbox config into one spec per (account, folder).
+
+    Passwords come from "password" or, preferably, from the environment variable named by
+    "password_env". Returns an empty list when there is no config file.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        accounts = json.load(f)
+
+    specs = []
+    for account in accounts:
+        user = account["user"]
+        password = account.get("password") or os.getenv(account.get("password_env", ""), "")
+        if not password:
+            raise ValueError(f"No password configured for {user}")
+        for folder in account.get("folders", ["inbox"]):
+            specs.append({
+                "id": mailbox_key(folder, user),
+                "server": account.get("server", IMAP_SERVER),
+                "user": user,
+                "password": password,
+                "folder": folder,
+            })
+    return specs
+
+def uid_state_path(mailbox_id: str) -> str:
+    return os.path.join(UID_STATE_DIR, re.sub(r"[^\w.@-]", "_", mailbox_id) + ".json")
+
+def _seed_uid_state(mailbox_id: str, path: str) -> None:
+    """Carry a mailbox's watermark over from the single-process uid_state.json."""
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = load_uid_state(UID_STATE_FILE).get(mailbox_id)
+    if entry:
+        save_uid_state({mailbox_id: entry}, path)
+
+def shard_mailboxes(specs: List[Dict], processes: int) -> List[List[Dict]]:
+    """Deal mailboxes round-robin onto `processes` shards."""
+    processes = max(1, min(processes, len(specs)))
+    return [specs[i::processes] for i in range(processes)]
+
+def run_shard(specs: List[Dict], out_queue, ack_queue, stop_fetching) -> None:
+    """
+    Fetch loop of one shard process.
+
+    Each mailbox gets its own connection and watermark. Fetched emails are tagged with
+    their mailbox id and sent to the shared analysis/storage process; watermarks only
+    advance past emails that process has acknowledged.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    mailboxes = {}
+    for spec in specs:
+        connection = ImapConnection(spec["server"], spec["user"], spec["password"], spec["folder"],
+                                    stop=stop_fetching)
+        try:
+            connection.connect(max_attempts=STARTUP_CONNECT_ATTEMPTS)
+        except imaplib.IMAP4.abort:
+            logger.error(f"Skipping mailbox {spec['id']}: connection failed")
+            continue
+        state_path = uid_state_path(spec["id"])
+        _seed_uid_state(spec["id"], state_path)
+        tracker = WatermarkTracker(spec["folder"], state_path, account=spec["user"])
+        mailboxes[spec["id"]] = {"spec": spec, "connection": connection, "tracker": tracker,
+                                 "entry": tracker.committed, "poller": AdaptivePoller(), "due": 0.0,
+                                 "found": False}
+
+    def apply_acks(timeout=None) -> bool:
+        """Apply queued acknowledgements; False once the closing sentinel arrives."""
+        while True:
+            try:
+                acks = ack_queue.get(timeout=timeout) if timeout else ack_queue.get_nowait()
+            except queue.Empty:
+                return True
+            if acks is None:
+                return False
+            uids = {}
+            for mailbox_id, uid in acks:
+                uids.setdefault(mailbox_id, []).append(uid)
+            for mailbox_id, mailbox_uids in uids.items():
+                mailboxes[mailbox_id]["tracker"].done(mailbox_uids)
+
+    if not mailboxes:
+        return
+
+    # A lone mailbox can block on IDLE; several share the shard by polling in turn
+    single = next(iter(mailboxes.values())) if len(mailboxes) == 1 else None
+    watcher, generation = None, None
+
+    try:
+        while not stop_fetching.is_set():
+            apply_acks()
+            for mailbox_id, mailbox in mailboxes.items():
+                if time.monotonic() < mailbox["due"] or stop_fetching.is_set():
+                    continue
+                try:
+                    # A dropped session is reconnected (re-SELECTed) and the fetch retried once
+                    emails, mailbox["entry"] = mailbox["connection"].run(
+                        lambda mail: fetch_new_emails(mail, mailbox["entry"], mailbox["spec"]["folder"])
+                    )
+                except Exception as e:
+                    logger.error(f"Error fetching {mailbox_id}: {str(e)}")
+                    emails = []
+                else:
+                    mailbox["tracker"].fetched(mailbox["entry"], [email_data["uid"] for email_data in emails])
+                for email_data in emails:
+                    email_data["mailbox"] = mailbox_id
+                    while not stop_fetching.is_set():
+                        try:
+                            out_queue.put(email_data, timeout=_POLL_SECONDS)
+                            break
+                        except queue.Full:
+                            apply_acks()
+                mailbox["found"] = bool(emails)
+                mailbox["due"] = time.monotonic() + (0 if single else mailbox["poller"].next_interval(bool(emails)))
+
+            if single:
+                connection = single["connection"]
+                try:
+                    mail = connection.mail
+                    if generation != connection.generation:
+                        watcher = MailWatcher(mail, idle_timeout=SHARD_IDLE_SECONDS)
+                        generation = connection.generation
+                    watcher.wait(found_mail=single["found"])
+                    connection.touch()
+                except CONNECTION_ERRORS as e:
+                    logger.warning(f"IMAP connection to {single['spec']['id']} lost ({str(e)}), reconnecting")
+                    connection.reconnect()
+            else:
+                time.sleep(max(0.0, min(1.0, min(m["due"] for m in mailboxes.values()) - time.monotonic())))
+    except Exception as e:
+        logger.error(f"Shard for {[spec['id'] for spec in specs]} stopped: {str(e)}")
+    finally:
+        # Emails still queued for the main process are simply fetched again next run
+        out_queue.cancel_join_thread()
+        deadline = time.monotonic() + SHARD_ACK_TIMEOUT
+        while time.monotonic() < deadline and apply_acks(timeout=_POLL_SECONDS):
+            pass
+        for mailbox in mailboxes.values():
+            mailbox["connection"].close()
+
+class ShardedSource:
+    """
+    Fetch stage for many mailboxes: shard processes fetch, the pipeline analyzes and stores.
+
+    Mailboxes are spread over a process pool, each shard with its own connections and
+    per-mailbox UID state. Their emails feed the one ProcessingPipeline in this process,
+    and persisted emails are acknowledged back to the shard that fetched them.
+    """
+
+    def __init__(self, specs: List[Dict], processes: int = INGEST_PROCESSES,
+                 queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.shards = shard_mailboxes(specs, processes or min(len(specs), os.cpu_count() or 1))
+        self._context = multiprocessing.get_context("spawn")
+        # Bounded, so shards stop fetching when analysis falls behind
+        self.out_queue = self._context.Queue(maxsize=queue_size)
+        self.ack_queues = [self._context.Queue() for _ in self.shards]
+        self._stop_fetching = self._context.Event()
+        self._shard_of = {spec["id"]: i for i, shard in enumerate(self.shards) for spec in shard}
+        self._processes = []
+        self._lock = threading.Lock()
+        self._stats = {spec["id"]: {"fetched": 0, "persisted": 0} for spec in specs}
+        self._started = time.monotonic()
+
+    def run(self, pipeline) -> None:
+        self._processes = [
+            self._context.Process(target=run_shard, name=f"mailbox-shard-{i}", daemon=True,
+                                  args=(shard, self.out_queue, self.ack_queues[i], self._stop_fetching))
+            for i, shard in enumerate(self.shards)
+        ]
+        for process in self._processes:
+            process.start()
+        logger.info(f"Ingesting {len(self._shard_of)} mailbox(es) across {len(self._processes)} process(es)")
+
+        last_report = time.monotonic()
+        while not pipeline.stopping:
+            if time.monotonic() - last_report >= STATS_INTERVAL:
+                self.log_stats()
+                last_report = time.monotonic()
+            try:
+                email_data = self.out_queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self._processes):
+                    raise RuntimeError("All mailbox shards have stopped")
+                continue
+            with self._lock:
+                self._stats[email_data["mailbox"]]["fetched"] += 1
+            # Shard processes keep their own counters; count arrivals where /metrics is served
+            EMAILS_FETCHED.inc()
+            if not pipeline.submit(email_data):
+                return
+
+    def done(self, emails: Iterable[Dict]) -> None:
+        """Route acknowledgements back to the shard that owns each mailbox."""
+        acks = {}
+        with self._lock:
+            for email_data in emails:
+                mailbox_id = email_data["mailbox"]
+                self._stats[mailbox_id]["persisted"] += 1
+                acks.setdefault(self._shard_of[mailbox_id], []).append((mailbox_id, email_data["uid"]))
+        for shard, shard_acks in acks.items():
+            self.ack_queues[shard].put(shard_acks)
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(stats["fetched"] - stats["persisted"] for stats in self._stats.values())
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per-mailbox fetched/persisted counts and persisted emails per minute since start."""
+        minutes = max((time.monotonic() - self._started) / 60, 1e-9)
+        with self._lock:
+            return {
+                mailbox_id: dict(stats, per_minute=round(stats["persisted"] / minutes, 2))
+                for mailbox_id, stats in self._stats.items()
+            }
+
+    def log_stats(self) -> None:
+        for mailbox_id, stats in self.stats().items():
+            logger.info(f"{mailbox_id}: fetched {stats['fetched']}, persisted {stats['persisted']} "
+                        f"({stats['per_minute']}/min)")
+
+    def close(self) -> None:
+        """Stop the shards once every acknowledgement they can still get has been sent."""
+        self._stop_fetching.set()
+        for ack_queue in self.ack_queues:
+            ack_queue.put(None)
+        for process in self._processes:
+            process.join(SHARD_ACK_TIMEOUT)
+        self.log_stats()
@@ -0,0 +1,248 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# Seconds; spans a fast clean_text call up to a slow, retried Gemini request
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Seconds from mailbox to dashboard, which includes the polling/IDLE wait
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600)
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Iterable[str], values: Iterable, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, label values, extra label, value) tuples for the exposition format."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_number(value)}")
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [("_total" if not self.name.endswith("_total") else "", key, None, value)
+                    for key, value in sorted(self._values.items())]
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            current = self._values.get(key, 0)
+            self._values[key] = (current() if callable(current) else current) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        """Read the value from `function` at scrape time (e.g. a queue's qsize)."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = function
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        samples = []
+        for key, value in values:
+            try:
+                samples.append(("", key, None, value() if callable(value) else value))
+            except Exception:
+                # A source that is gone (e.g. a stopped pipeline) simply drops out of the scrape
+                continue
+        return samples
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[2] if state else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        samples = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", key, ("le", _format_number(bound)), cumulative))
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, count))
+        return samples
+
+class Registry:
+    """Metrics rendered together in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram(
+    "email_stage_seconds", "Time spent in each processing stage (fetch, clean_text, analyze_email, "
+    "gemini_request, save_results, update_html_display)", ("stage",)
+)
+STAGE_ERRORS = Counter("email_stage_errors_total", "Failures per processing stage", ("stage",))
+EMAILS_FETCHED = Counter("emails_fetched_total", "Emails fetched from the mailbox")
+EMAILS_SAVED = Counter("emails_saved_total", "Processed emails written to storage")
+ANALYSES = Counter(
+    "email_analyses_total", "Analyses by how they were resolved: llm, cache, near_duplicate, local or fallback", ("path",)
+)
+GEMINI_REQUESTS = Counter("gemini_requests_total", "Gemini API calls by outcome (ok or error)", ("outcome",))
+QUEUE_DEPTH = Gauge(
+    "pipeline_queue_depth", "Emails waiting per pipeline queue; 'unacknowledged' is fetched but not yet saved",
+    ("queue",)
+)
+PROCESSING_LAG = Histogram(
+    "email_processing_lag_seconds", "From fetching an email to its result being saved", buckets=LAG_BUCKETS
+)
+DASHBOARD_LAG = Histogram(
+    "email_dashboard_lag_seconds", "From an email's Date header to its result reaching the dashboard",
+    buckets=LAG_BUCKETS
+)
+ALERT_LATENCY = Histogram(
+    "email_alert_latency_seconds", "From fetching a High priority email to its alert; path is fast "
+    "(keyword pre-score, before analysis) or confirmed (analyzed and saved)", ("path",)
+)
+LAST_DASHBOARD_UPDATE = Gauge("dashboard_last_update_timestamp_seconds", "Unix time of the last dashboard update")
+
+@contextmanager
+def track_stage(stage: str):
+    """Time a stage and count it as failed if it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+# ---------------------------------------------------------------------------
+# Trace IDs: one per fetched email, carried on email_data["trace_id"] and in log lines
+# ---------------------------------------------------------------------------
+
+_TRACE_ID = contextvars.ContextVar("trace_id", default="-")
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+def current_trace_id() -> str:
+    return _TRACE_ID.get()
+
+@contextmanager
+def trace(trace_id: Optional[str]):
+    """Tag every log record emitted in this block (on this thread) with `trace_id`."""
+    token = _TRACE_ID.set(trace_id or "-")
+    try:
+        yield
+    finally:
+        _TRACE_ID.reset(token)
+
+def trace_batch(emails: Iterable[Dict]):
+    """trace() for several emails handled together; their IDs are joined with commas."""
+    return trace(",".join(email_data.get("trace_id", "-") for email_data in emails))
+
+_default_record_factory = logging.getLogRecordFactory()
+
+def _record_with_trace_id(*args, **kwargs):
+    record = _default_record_factory(*args, **kwargs)
+    record.trace_id = _TRACE_ID.get()
+    return record
+
+# Every record gets a trace_id attribute, so LOG_FORMAT works with any handler
+logging.setLogRecordFactory(_record_with_trace_id)
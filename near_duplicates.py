@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import uuid
+import zlib
+from collections import deque
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NEAR_DUPLICATE_FILE = "near_duplicates.db"
+# Estimated Jaccard similarity (of word-pair shingles) above which an earlier analysis is reused
+REUSE_THRESHOLD = float(os.getenv("near_duplicate_threshold", "0.8"))
+# Lower bar for grouping two emails into the same dashboard thread
+THREAD_THRESHOLD = float(os.getenv("thread_threshold", "0.5"))
+# Most recent analyzed emails kept in the index (memory and disk)
+MAX_ENTRIES = int(os.getenv("near_duplicate_max_entries", "200000"))
+
+NUM_PERMUTATIONS = 128
+# 32 bands of 4 rows: pairs at 0.8 similarity share a band almost surely, at 0.5 ~87% of the
+# time, while unrelated emails (~0.2) become candidates only ~5% of the time
+BANDS = 32
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+
+_PRIME = (1 << 61) - 1
+# Fixed seed so signatures written by earlier runs stay comparable
+_random = np.random.RandomState(20240601)
+_A = _random.randint(1, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _random.randint(0, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+_SUBJECT_PREFIX = re.compile(r'^\s*((re|fw|fwd)\s*:?\s+)+', re.IGNORECASE)
+_WORD = re.compile(r'[a-z0-9@.]+')
+_NUMBER = re.compile(r'\d+')
+# Policy/claim numbers, amounts, dates and addresses: what differs between templated notices
+IDENTIFIER = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+|\b(?:[A-Za-z]{1,4}-)?\d[\d,./-]*\b')
+
+def shingles(text: str) -> List[int]:
+    """Hashed word pairs of an email, with digits masked so only the template is compared."""
+    words = _WORD.findall(_NUMBER.sub('0', _SUBJECT_PREFIX.sub('', text.lower())))
+    pairs = words if len(words) < 2 else [f"{a} {b}" for a, b in zip(words, words[1:])]
+    return sorted({zlib.crc32(pair.encode("utf-8")) for pair in pairs})
+
+def minhash(text: str) -> Optional[np.ndarray]:
+    """MinHash signature (uint32 per permutation) of an email's shingles; None for empty text."""
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    values = np.array(hashes, dtype=np.uint64)
+    # a*h + b stays below 2**64 because a, b and h are 32-bit
+    permuted = (np.outer(_A, values) + _B[:, None]) % _PRIME
+    return (permuted.min(axis=1) & 0xFFFFFFFF).astype(np.uint32)
+
+def identifiers(text: str) -> List[str]:
+    return IDENTIFIER.findall(text)
+
+def personalize(analysis: Dict, old_identifiers: List[str], new_identifiers: List[str]) -> Dict:
+    """
+    Copy of an earlier email's analysis with its identifiers (policy/claim numbers, amounts,
+    addresses) in the actions replaced by the new email's, matched by position.
+    """
+    replacements = {old: new for old, new in zip(old_identifiers, new_identifiers) if old != new}
+    actions = list(analysis.get("actions", []))
+    if replacements:
+        pattern = re.compile("|".join(rf"(?<![\w-]){re.escape(old)}(?![\w-])"
+                                      for old in sorted(replacements, key=len, reverse=True)))
+        actions = [pattern.sub(lambda match: replacements[match.group(0)], action) for action in actions]
+    return dict(analysis, actions=actions)
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index over the cleaned text of analyzed emails.
+
+    Resends, "Fwd:" copies and templated notices that differ only in names or numbers are
+    found among candidates sharing an LSH band, so a lookup touches a handful of entries
+    instead of the whole history. A close enough match lends its analysis (see personalize)
+    and its thread id; entries persist in SQLite per prompt version. The thread of each
+    analysis cache key is kept too, so exact repeats get theirs without a search.
+    """
+
+    def __init__(self, path: Optional[str] = NEAR_DUPLICATE_FILE, version: str = "",
+                 reuse_threshold: float = REUSE_THRESHOLD, thread_threshold: float = THREAD_THRESHOLD,
+                 max_entries: int = MAX_ENTRIES):
+        self.version = version
+        self.reuse_threshold = reuse_threshold
+        self.thread_threshold = min(thread_threshold, reuse_threshold)
+        self.max_entries = max_entries
+        self._entries = {}
+        self._bands = [{} for _ in range(BANDS)]
+        self._order = deque()
+        self._threads = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.reused = 0
+        self.threaded = 0
+
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS near_duplicates (id INTEGER PRIMARY KEY, version TEXT NOT NULL, "
+                    "signature BLOB NOT NULL, analysis TEXT NOT NULL, identifiers TEXT NOT NULL, "
+                    "thread_id TEXT NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS content_threads (key TEXT PRIMARY KEY, thread_id TEXT NOT NULL)"
+                )
+                self._db.commit()
+                self._load()
+            except sqlite3.Error as e:
+                logger.error(f"Near-duplicate index kept in memory only, could not open {path}: {str(e)}")
+                self._db = None
+
+    def _load(self) -> None:
+        rows = self._db.execute(
+            "SELECT id, signature, analysis, identifiers, thread_id FROM near_duplicates "
+            "WHERE version = ? ORDER BY id DESC LIMIT ?", (self.version, self.max_entries)
+        ).fetchall()
+        for entry_id, signature, analysis, entry_identifiers, thread_id in reversed(rows):
+            self._insert(entry_id, np.frombuffer(signature, dtype=np.uint32),
+                         json.loads(analysis), json.loads(entry_identifiers), thread_id)
+        self._next_id = (self._db.execute("SELECT MAX(id) FROM near_duplicates").fetchone()[0] or 0) + 1
+        # Cache keys already include the prompt version
+        for key, thread_id in reversed(self._db.execute(
+                "SELECT key, thread_id FROM content_threads ORDER BY rowid DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()):
+            self._threads[key] = thread_id
+        if rows:
+            logger.info(f"Loaded {len(rows)} analyzed emails into the near-duplicate index")
+
+    @staticmethod
+    def _band_keys(signature: np.ndarray):
+        return [signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes() for band in range(BANDS)]
+
+    def _insert(self, entry_id: int, signature: np.ndarray, analysis: Dict, entry_identifiers: List[str],
+                thread_id: str) -> None:
+        self._entries[entry_id] = (signature, analysis, entry_identifiers, thread_id)
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            band.setdefault(key, []).append(entry_id)
+        self._order.append(entry_id)
+        while len(self._order) > self.max_entries:
+            self._evict(self._order.popleft())
+
+    def _evict(self, entry_id: int) -> None:
+        signature = self._entries.pop(entry_id)[0]
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            bucket = band.get(key)
+            if bucket is not None:
+                bucket.remove(entry_id)
+                if not bucket:
+                    del band[key]
+
+    def find(self, signature: Optional[np.ndarray]) -> Optional[Dict]:
+        """
+        Closest indexed email at or above the thread threshold, as
+        {"similarity", "analysis", "identifiers", "thread_id"}; None if there is none.
+        """
+        if signature is None:
+            return None
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band, key in zip(self._bands, self._band_keys(signature)):
+                candidates.update(band.get(key, ()))
+            best, best_similarity = None, self.thread_threshold
+            for entry_id in candidates:
+                similarity = float(np.mean(self._entries[entry_id][0] == signature))
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None:
+                return None
+            _, analysis, entry_identifiers, thread_id = self._entries[best]
+            self.threaded += 1
+            return {"similarity": best_similarity, "analysis": dict(analysis),
+                    "identifiers": list(entry_identifiers), "thread_id": thread_id}
+
+    def thread_of(self, key: str) -> Optional[str]:
+        """Thread of the email whose analysis is cached under `key`, if it was recorded."""
+        with self._lock:
+            return self._threads.get(key)
+
+    def remember_thread(self, key: str, thread_id: str) -> None:
+        """Record the thread of an analysis cache key (see thread_of)."""
+        with self._lock:
+            self._threads.pop(key, None)
+            self._threads[key] = thread_id
+            while len(self._threads) > self.max_entries:
+                del self._threads[next(iter(self._threads))]
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO content_threads (key, thread_id) VALUES (?, ?)",
+                                     (key, thread_id))
+                    self._db.execute("DELETE FROM content_threads WHERE rowid <= "
+                                     "(SELECT MAX(rowid) FROM content_threads) - ?", (self.max_entries,))
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing near-duplicate index: {str(e)}")
+
+    def record_reuse(self, key: str, thread_id: str) -> None:
+        """Count an analysis that was actually answered from a near-duplicate."""
+        with self._lock:
+            self.reused += 1
+        self.remember_thread(key, thread_id)
+
+    def add(self, signature: Optional[np.ndarray], analysis: Dict, entry_identifiers: List[str],
+            thread_id: str, key: Optional[str] = None) -> None:
+        """
+        Index an analyzed email so later near-copies can reuse its analysis and thread; `key`
+        is its analysis cache key, recorded for thread_of.
+        """
+        if key is not None:
+            self.remember_thread(key, thread_id)
+        if signature is None:
+            return
+        analysis = {field: analysis[field] for field in ("request_type", "category", "actions", "priority")}
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._insert(entry_id, signature, analysis, entry_identifiers, thread_id)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT INTO near_duplicates (id, version, signature, analysis, identifiers, thread_id) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (entry_id, self.version, signature.tobytes(), json.dumps(analysis),
+                         json.dumps(entry_identifiers), thread_id)
+                    )
+                    self._db.execute("DELETE FROM near_duplicates WHERE id <= ?", (entry_id - self.max_entries,))
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing near-duplicate index: {str(e)}")
+
+    @staticmethod
+    def new_thread_id() -> str:
+        return uuid.uuid4().hex[:12]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "lookups": self.lookups, "reused": self.reused,
+                    "threaded": self.threaded}
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
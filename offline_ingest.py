@@ -0,0 +1,271 @@
+import argparse
+import email
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from Email_parser import parse_email_message
+from metrics import EMAILS_FETCHED, new_trace_id
+
+logger = logging.getLogger(__name__)
+
+# Messages per unit of work sent to a parser process, and the most bytes one unit may span
+PARSE_BATCH_SIZE = int(os.getenv("ingest_parse_batch_size", "200"))
+PARSE_BATCH_BYTES = 8 * 1024 * 1024
+# Parser processes; 0 means one per CPU
+PARSE_PROCESSES = int(os.getenv("ingest_parse_processes", "0"))
+EML_EXTENSION = ".eml"
+STATS_INTERVAL = 60
+_POLL_SECONDS = 0.5
+
+# mboxrd escapes body lines starting with "From " as ">From " (and ">From " as ">>From ")
+_ESCAPED_FROM = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+def scan_mbox(path: str) -> Iterator[Tuple[int, int]]:
+    """
+    Yield the (start, end) byte offsets of every message in an mbox file.
+
+    Boundaries are "From " lines, found with mmap.find over the mapped file, so even a
+    multi-GB archive is scanned at disk speed without being read into memory. Each span
+    starts at its "From " separator line.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:5] == b"From ":
+                start = 0
+            else:
+                start = mm.find(b"\nFrom ")
+                if start == -1:
+                    logger.warning(f"{path} has no mbox \"From \" separators; is it a single .eml message?")
+                    return
+                start += 1
+            while True:
+                boundary = mm.find(b"\nFrom ", start)
+                if boundary == -1:
+                    yield start, len(mm)
+                    return
+                yield start, boundary + 1
+                start = boundary + 1
+
+def find_archives(paths: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """Split inputs into mbox files and .eml files; directories are searched recursively for .eml files."""
+    mboxes, emls = [], []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                emls += sorted(os.path.join(directory, name) for name in names
+                               if name.lower().endswith(EML_EXTENSION))
+        elif path.lower().endswith(EML_EXTENSION):
+            emls.append(path)
+        else:
+            mboxes.append(path)
+    return mboxes, emls
+
+def plan_units(paths: Iterable[str], batch_size: int = PARSE_BATCH_SIZE) -> Iterator[Tuple[str, Optional[str], List]]:
+    """
+    Group the messages of mbox files and .eml files into parser work units: ("mbox", path,
+    [(start, end), ...]) spanning one contiguous region, or ("eml", None, [path, ...]).
+    """
+    mboxes, emls = find_archives(paths)
+    for path in mboxes:
+        spans = []
+        for span in scan_mbox(path):
+            spans.append(span)
+            if len(spans) >= batch_size or span[1] - spans[0][0] >= PARSE_BATCH_BYTES:
+                yield "mbox", path, spans
+                spans = []
+        if spans:
+            yield "mbox", path, spans
+    for start in range(0, len(emls), batch_size):
+        yield "eml", None, emls[start:start + batch_size]
+
+def _parse_message(raw: bytes, source: str, errors: List[Tuple[str, str]]) -> Optional[Dict]:
+    try:
+        return parse_email_message(email.message_from_bytes(raw))
+    except Exception as e:
+        errors.append((source, str(e)))
+        return None
+
+def parse_unit(unit: Tuple[str, Optional[str], List]) -> Tuple[List[Dict], List[Tuple[str, str]]]:
+    """
+    Parse one work unit in a worker process with the same extraction as an IMAP fetch
+    (parse_email_message). Returns the emails and a (source, error) pair per message that
+    could not be parsed.
+    """
+    kind, path, items = unit
+    emails, errors = [], []
+    if kind == "mbox":
+        first = items[0][0]
+        # One read for the whole unit; its spans are contiguous
+        with open(path, "rb") as f:
+            f.seek(first)
+            data = f.read(items[-1][1] - first)
+        for start, end in items:
+            message = data[start - first:end - first]
+            # Drop the "From " separator line and undo mboxrd quoting
+            message = _ESCAPED_FROM.sub(rb'\1', message[message.find(b"\n") + 1:])
+            email_data = _parse_message(message, f"{path}@{start}", errors)
+            if email_data is not None:
+                emails.append(email_data)
+    else:
+        for eml_path in items:
+            try:
+                with open(eml_path, "rb") as f:
+                    message = f.read()
+            except OSError as e:
+                errors.append((eml_path, str(e)))
+                continue
+            email_data = _parse_message(message, eml_path, errors)
+            if email_data is not None:
+                emails.append(email_data)
+    return emails, errors
+
+def parse_archives(paths: Iterable[str], processes: int = PARSE_PROCESSES,
+                   stop: Optional[threading.Event] = None) -> Iterator[List[Dict]]:
+    """
+    Yield parsed emails from mbox files and .eml directories, one work unit at a time.
+
+    Units are parsed on a process pool with a bounded number in flight, so memory stays
+    flat when the consumer (analysis) is slower than parsing. Units finish out of order;
+    within one unit the archive order is kept.
+    """
+    processes = processes or os.cpu_count() or 1
+    units = plan_units(paths)
+    # Workers are spawned, like the mailbox shards, so they never inherit this process's threads
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        in_flight = set()
+        exhausted = False
+        try:
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < processes * 2:
+                    unit = next(units, None)
+                    if unit is None:
+                        exhausted = True
+                    else:
+                        in_flight.add(executor.submit(parse_unit, unit))
+                if not in_flight:
+                    break
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    emails, errors = future.result()
+                    for source, error in errors:
+                        logger.warning(f"Skipping unparseable email {source}: {error}")
+                    yield emails
+                if stop is not None and stop.is_set():
+                    return
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+class ArchiveSource:
+    """
+    Pipeline source that replays mbox files and .eml directories instead of an IMAP mailbox.
+
+    Messages are parsed in worker processes (see parse_archives) and submitted to the
+    ProcessingPipeline like fetched mail, so analysis and storage are unchanged. Already
+    stored emails are skipped by the pipeline's dedup check, so an interrupted replay can
+    simply be run again. `finished` is set once every email has been acknowledged.
+    """
+
+    def __init__(self, paths: List[str], processes: int = PARSE_PROCESSES):
+        self.paths = paths
+        self.processes = processes
+        self.finished = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._exhausted = False
+        self._stats = {"parsed": 0, "persisted": 0}
+        self._started = time.monotonic()
+
+    def run(self, pipeline) -> None:
+        last_report = time.monotonic()
+        for emails in parse_archives(self.paths, self.processes, stop=self._stop):
+            fetched_at = time.time()
+            for email_data in emails:
+                email_data["trace_id"] = new_trace_id()
+                email_data["fetched_at"] = fetched_at
+            with self._lock:
+                self._stats["parsed"] += len(emails)
+            EMAILS_FETCHED.inc(len(emails))
+            if not pipeline.submit_many(emails):
+                return
+            if time.monotonic() - last_report >= STATS_INTERVAL:
+                self.log_stats()
+                last_report = time.monotonic()
+        with self._lock:
+            self._exhausted = True
+            self._check_finished()
+        logger.info(f"Parsed all {self.stats()['parsed']} emails; waiting for analysis to finish")
+        # Like ImapSource, the fetch stage lives until the pipeline stops; here that is once all is saved
+        while not pipeline.stopping and not self.finished.wait(_POLL_SECONDS):
+            pass
+
+    def _check_finished(self) -> None:
+        if self._exhausted and self._stats["persisted"] >= self._stats["parsed"]:
+            self.finished.set()
+
+    def done(self, emails: Iterable[Dict]) -> None:
+        """Acknowledge persisted (or deliberately skipped) emails."""
+        with self._lock:
+            self._stats["persisted"] += len(list(emails))
+            self._check_finished()
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._stats["parsed"] - self._stats["persisted"]
+
+    def stats(self) -> Dict[str, float]:
+        """Parsed/persisted counts and persisted emails per minute since start."""
+        minutes = max((time.monotonic() - self._started) / 60, 1e-9)
+        with self._lock:
+            return dict(self._stats, per_minute=round(self._stats["persisted"] / minutes, 2))
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.info(f"Archive replay: parsed {stats['parsed']}, persisted {stats['persisted']} "
+                    f"({stats['per_minute']}/min)")
+
+    def close(self) -> None:
+        self._stop.set()
+
+def main(argv: Optional[Tuple[str, ...]] = None):
+    from Data_cleaning import ANALYSIS_BATCH_SIZE, ANALYSIS_WORKERS
+    from integrated_parser import IntegratedEmailSystem
+    from processing_pipeline import ProcessingPipeline
+
+    parser = argparse.ArgumentParser(description="Analyze and store emails from mbox files or .eml directories")
+    parser.add_argument("paths", nargs="+", help="mbox files, .eml files or directories of .eml files")
+    parser.add_argument("--processes", type=int, default=PARSE_PROCESSES, help="Parser processes (0: one per CPU)")
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS, help="Analyzer threads")
+    parser.add_argument("--batch-size", type=int, default=ANALYSIS_BATCH_SIZE, help="Emails per Gemini request")
+    args = parser.parse_args(argv)
+    missing = [path for path in args.paths if not os.path.exists(path)]
+    if missing:
+        parser.error(f"not found: {', '.join(missing)}")
+
+    system = IntegratedEmailSystem()
+    source = ArchiveSource(args.paths, args.processes)
+    pipeline = ProcessingPipeline(system, source=source, workers=args.workers, analysis_batch_size=args.batch_size)
+    try:
+        pipeline.start()
+        # Returns once the source has everything acknowledged, or a stage died
+        pipeline.wait()
+    except KeyboardInterrupt:
+        logger.info("Stopping archive replay; run it again to pick up the remaining emails")
+    finally:
+        pipeline.stop()
+        source.log_stats()
+        system.email_processor.log_stats()
+        system.storage.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+import heapq
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from Email_parser import UID_STATE_FILE, commit_uid_watermark, fetch_new_emails, load_uid_state, mailbox_key
+from Data_cleaning import ANALYSIS_BATCH_SIZE, ANALYSIS_WORKERS, STREAMING_ANALYSIS
+from imap_connection import (CONNECTION_ERRORS, KEEPALIVE_SECONDS, RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY,
+                             ImapConnection, ImapConnectionPool)
+from imap_idle import MailWatcher
+from keyword_classifier import DEFAULT_CLASSIFIER
+from metrics import ALERT_LATENCY, PROCESSING_LAG, QUEUE_DEPTH, trace, trace_batch
+
+logger = logging.getLogger(__name__)
+
+# Fetched emails waiting for analysis; a full queue pauses the fetcher (backpressure)
+PIPELINE_QUEUE_SIZE = int(os.getenv("pipeline_queue_size", "100"))
+# The persister commits up to this many results at once, or whatever it has after the interval
+PERSIST_BATCH_SIZE = int(os.getenv("persist_batch_size", "50"))
+PERSIST_INTERVAL = float(os.getenv("persist_interval", "2.0"))
+# How often blocked stages re-check for shutdown
+_POLL_SECONDS = 0.5
+# Delay before retrying a batch the storage backend rejected
+PERSIST_RETRY_SECONDS = 5.0
+# Head start per priority level in the analysis queue: a queued Medium email is overtaken by
+# High mail for at most this long, a Low one for twice this long, so nothing starves
+PRIORITY_AGING_SECONDS = float(os.getenv("priority_aging_seconds", "60"))
+PRIORITY_RANKS = {"High": 0, "Medium": 1, "Low": 2}
+
+def pre_score(email_data: Dict) -> str:
+    """Cheap priority guess from the keyword tables, available before any analysis."""
+    return DEFAULT_CLASSIFIER.classify(email_data.get('subject') or '', email_data.get('body') or '')["priority"]
+
+class PriorityEmailQueue:
+    """
+    Bounded queue that hands out likely-High emails first, with aging.
+
+    Drop-in for the queue.Queue calls the pipeline makes (put/get with timeouts raising
+    queue.Full/queue.Empty). An item is ordered by enqueue time plus `aging` seconds per
+    rank below High, so a fixed key still gives every waiting email a bounded delay: it
+    is only ever overtaken by higher-ranked mail that arrived less than its head start later.
+    """
+
+    def __init__(self, maxsize: int = 0, aging: float = PRIORITY_AGING_SECONDS,
+                 rank=lambda item: PRIORITY_RANKS.get(item.get("pre_priority"), 1)):
+        self.maxsize = maxsize
+        self.aging = aging
+        self.rank = rank
+        self._heap = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    def qsize(self) -> int:
+        with self._condition:
+            return len(self._heap)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.qsize()
+
+    def put(self, item, block: bool = True, timeout: Optional[float] = None) -> None:
+        with self._condition:
+            if self.maxsize > 0 and not self._condition.wait_for(
+                    lambda: len(self._heap) < self.maxsize, timeout if block else 0):
+                raise queue.Full
+            key = time.monotonic() + self.rank(item) * self.aging
+            heapq.heappush(self._heap, (key, next(self._order), item))
+            self._condition.notify_all()
+
+    def put_nowait(self, item) -> None:
+        self.put(item, block=False)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._heap, timeout if block else 0):
+                raise queue.Empty
+            item = heapq.heappop(self._heap)[2]
+            self._condition.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+class WatermarkTracker:
+    """
+    Commits the UID watermark only past emails that are fully persisted.
+
+    Fetched UIDs stay pending until the persister acknowledges them; the committed watermark
+    is always just below the oldest pending UID, so a crash re-fetches (never loses) any
+    email that was fetched but not yet saved.
+    """
+
+    def __init__(self, mailbox: str = "inbox", state_file: str = UID_STATE_FILE, account: Optional[str] = None):
+        self.mailbox = mailbox
+        self.account = account
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._fetched = None
+        self.committed = load_uid_state(state_file).get(mailbox_key(mailbox, account))
+
+    def fetched(self, entry: Dict, uids: Iterable[int]) -> None:
+        """Record a fetch: its new watermark and the UIDs now in flight."""
+        with self._lock:
+            if self._fetched and self._fetched["uidvalidity"] != entry["uidvalidity"]:
+                # The mailbox was recreated; in-flight UIDs no longer refer to its messages
+                self._pending.clear()
+            self._fetched = entry
+            self._pending.update(uids)
+            self._commit()
+
+    def done(self, uids: Iterable[int]) -> None:
+        """Acknowledge persisted (or deliberately skipped) UIDs."""
+        with self._lock:
+            self._pending.difference_update(uids)
+            self._commit()
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _commit(self) -> None:
+        if not self._fetched:
+            return
+        last_uid = self._fetched["last_uid"]
+        if self._pending:
+            last_uid = min(last_uid, min(self._pending) - 1)
+        entry = {"uidvalidity": self._fetched["uidvalidity"], "last_uid": last_uid}
+        if entry != self.committed:
+            commit_uid_watermark(entry, self.mailbox, self.state_file, self.account)
+            self.committed = entry
+
+class ImapSource:
+    """
+    The fetch stage for one mailbox: fetches new mail and waits on IDLE.
+
+    Runs on a managed connection, so a dropped session is reconnected (with backoff) and
+    fetching resumes from the in-memory watermark; a command the server refuses is retried
+    the same way after a backoff. Large batches are fetched over `pool`.
+    """
+
+    def __init__(self, connection: ImapConnection, mailbox: str = "inbox", state_file: str = UID_STATE_FILE,
+                 pool: Optional[ImapConnectionPool] = None):
+        self.connection = connection
+        self.mailbox = mailbox
+        self.pool = pool
+        self.tracker = WatermarkTracker(mailbox, state_file)
+
+    def run(self, pipeline: "ProcessingPipeline") -> None:
+        watcher, generation = None, None
+        entry = self.tracker.committed
+        failures = 0
+        while not pipeline.stopping:
+            try:
+                mail = self.connection.mail
+                if generation != self.connection.generation:
+                    # IDLE for at most the keepalive period so a half-open socket is noticed
+                    watcher, generation = MailWatcher(mail, KEEPALIVE_SECONDS), self.connection.generation
+                emails, entry = fetch_new_emails(mail, entry, self.mailbox, pool=self.pool)
+            except CONNECTION_ERRORS as e:
+                logger.warning(f"IMAP connection lost ({str(e)}), reconnecting")
+                self.connection.reconnect()
+                continue
+            except Exception as e:
+                # A refused SELECT/SEARCH/FETCH (e.g. "[UNAVAILABLE]") is retried from the same watermark
+                delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * (2 ** failures)))
+                failures += 1
+                logger.error(f"Error fetching new emails ({str(e)}), retrying in {delay:.1f}s")
+                self.connection.stop.wait(delay)
+                continue
+            failures = 0
+            self.tracker.fetched(entry, [email_data["uid"] for email_data in emails])
+            if emails:
+                logger.info(f"Found {len(emails)} new emails")
+            else:
+                logger.info("No new emails found")
+            if not pipeline.submit_many(emails):
+                return
+            try:
+                # Wake as soon as the server pushes EXISTS (adaptive polling if IDLE is unsupported)
+                watcher.wait(found_mail=bool(emails))
+                self.connection.touch()
+            except CONNECTION_ERRORS as e:
+                logger.warning(f"IMAP connection lost while waiting ({str(e)}), reconnecting")
+                self.connection.reconnect()
+
+    def done(self, emails: Iterable[Dict]) -> None:
+        """Acknowledge persisted (or deliberately skipped) emails."""
+        self.tracker.done(email_data["uid"] for email_data in emails)
+
+    @property
+    def pending(self) -> int:
+        return self.tracker.pending
+
+    def close(self) -> None:
+        # Unblocks a reconnect loop; the connections themselves are closed by their owner
+        self.connection.stop.set()
+
+class ProcessingPipeline:
+    """
+    Fetch -> analyze -> persist as concurrent stages connected by bounded queues.
+
+    One fetcher thread runs the source (by default ImapSource on the system's managed
+    IMAP connection), `workers` analyzer threads call the LLM
+    and one persister writes results in batches. Full queues block the stage upstream,
+    so memory stays bounded and throughput follows the slowest stage. Analysis takes
+    likely-High emails first (see PriorityEmailQueue), and those are alerted on as soon
+    as they are fetched, before their analysis confirms it. `stop` drains what
+    was already fetched; anything not yet persisted keeps the watermark below it and is
+    fetched again on the next run (at-least-once).
+    """
+
+    def __init__(self, system, source=None, mailbox: str = "inbox", state_file: str = UID_STATE_FILE,
+                 workers: int = ANALYSIS_WORKERS, queue_size: int = PIPELINE_QUEUE_SIZE,
+                 persist_batch_size: int = PERSIST_BATCH_SIZE, persist_interval: float = PERSIST_INTERVAL,
+                 analysis_batch_size: int = ANALYSIS_BATCH_SIZE, streaming: bool = STREAMING_ANALYSIS):
+        self.system = system
+        self.mailbox = mailbox
+        self.workers = max(1, workers)
+        self.persist_batch_size = max(1, persist_batch_size)
+        self.persist_interval = persist_interval
+        self.analysis_batch_size = max(1, analysis_batch_size)
+        # Streaming reads one response per email, so it only applies without multi-email prompts
+        self.streaming = streaming and self.analysis_batch_size == 1
+        self.source = source or ImapSource(system.connection, mailbox, state_file, system.connection_pool)
+        self.fetch_queue = PriorityEmailQueue(maxsize=queue_size)
+        self.persist_queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._analyzers_running = 0
+        self._analyzers_lock = threading.Lock()
+        self._threads = []
+
+    def start(self) -> None:
+        QUEUE_DEPTH.set_function(self.fetch_queue.qsize, queue="fetch")
+        QUEUE_DEPTH.set_function(self.persist_queue.qsize, queue="persist")
+        QUEUE_DEPTH.set_function(lambda: self.source.pending, queue="unacknowledged")
+        self._analyzers_running = self.workers
+        self._threads = [threading.Thread(target=self._fetch_loop, name="fetcher", daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._analyze_loop, name=f"analyzer-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        self._threads.append(threading.Thread(target=self._persist_loop, name="persister", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop fetching and wait for analyzers and the persister to drain what is in flight."""
+        self._stop.set()
+        # The fetcher may be parked in IDLE; it exits on its next wake-up, nothing depends on it
+        for thread in self._threads[1:]:
+            thread.join(timeout)
+        self.source.close()
+        logger.info(f"Pipeline stopped; {self.source.pending} fetched email(s) left for the next run")
+
+    def wait(self) -> None:
+        """Block until a stage dies (e.g. the IMAP connection was lost)."""
+        while all(thread.is_alive() for thread in self._threads):
+            time.sleep(_POLL_SECONDS)
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def submit(self, email_data: Dict) -> bool:
+        """Queue a fetched email for analysis, blocking while the queue is full; False on shutdown."""
+        return self.submit_many([email_data])
+
+    def submit_many(self, emails: List[Dict]) -> bool:
+        """
+        Pre-score a fetch's emails, alert on likely-High ones right away and queue them
+        for analysis, highest first (so a backlog larger than the queue is ordered too).
+        """
+        for email_data in emails:
+            email_data["pre_priority"] = pre_score(email_data)
+            if email_data["pre_priority"] == "High":
+                self._alert(email_data)
+        ranked = sorted(emails, key=lambda email_data: PRIORITY_RANKS.get(email_data["pre_priority"], 1))
+        return all(self._put(self.fetch_queue, email_data) for email_data in ranked)
+
+    def _alert(self, email_data: Dict, result: Optional[Dict] = None, path: Optional[str] = None) -> None:
+        """
+        Warn about a High priority email: the fast path from its pre-score (no result yet),
+        "streamed" when a streaming analysis reports High before it finishes, or confirmed
+        once it is analyzed and saved.
+        """
+        path = path or ("fast" if result is None else "confirmed")
+        if "fetched_at" in email_data:
+            ALERT_LATENCY.observe(time.time() - email_data["fetched_at"], path=path)
+        with trace(email_data.get("trace_id")):
+            if path == "confirmed":
+                self.system.log_high_priority([result])
+            else:
+                self.system.log_likely_high_priority(email_data, source="analysis" if path == "streamed" else "keywords")
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        """Blocking put that gives up on shutdown; False if the item was not queued."""
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch_loop(self) -> None:
+        try:
+            self.source.run(self)
+        except Exception as e:
+            logger.error(f"Fetcher stopped: {str(e)}")
+
+    def _take_batch(self, source: queue.Queue, size: int, timeout: float) -> List:
+        """Wait up to `timeout` for one item, then take whatever else is ready, up to `size`."""
+        try:
+            batch = [source.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < size:
+            try:
+                batch.append(source.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _analyze_loop(self) -> None:
+        try:
+            while not (self._stop.is_set() and self.fetch_queue.empty()):
+                emails = self._take_batch(self.fetch_queue, self.analysis_batch_size, _POLL_SECONDS)
+                if emails:
+                    self._analyze(emails)
+        finally:
+            with self._analyzers_lock:
+                self._analyzers_running -= 1
+
+    def _analyze(self, emails: List[Dict]) -> None:
+        known = [email_data for email_data in emails if self.system.is_known_email(email_data)]
+        if known:
+            logger.info(f"Skipping {len(known)} already processed emails")
+            self.source.done(known)
+            emails = [email_data for email_data in emails if email_data not in known]
+        if not emails:
+            return
+        with trace_batch(emails):
+            try:
+                if self.streaming:
+                    analyses = [self._analyze_streaming(email_data) for email_data in emails]
+                else:
+                    # This worker is already one of N parallel stages, so analyze its batch on one thread
+                    analyses = self.system.email_processor.analyze_emails(
+                        [(email_data['subject'], email_data['body']) for email_data in emails],
+                        max_workers=1, batch_size=self.analysis_batch_size
+                    )
+                results = [self.system.build_result(email_data, analysis)
+                           for email_data, analysis in zip(emails, analyses)]
+            except Exception as e:
+                # A message that cannot be analyzed is skipped, not retried forever
+                logger.error(f"Error processing emails: {str(e)}")
+                self.source.done(emails)
+                return
+        for email_data, result in zip(emails, results):
+            # No shutdown check: these emails are fetched and analyzed, the persister drains them
+            self.persist_queue.put((email_data, result))
+
+    def _analyze_streaming(self, email_data: Dict) -> Dict:
+        """Analyze one email from a streamed response, alerting as soon as it reports High priority"""
+        # The keyword fast path has already warned about these
+        alerted = email_data.get("pre_priority") == "High"
+
+        def on_partial(fields):
+            nonlocal alerted
+            if not alerted and fields.get("priority", "").lower() == "high":
+                alerted = True
+                self._alert(email_data, fields, path="streamed")
+
+        return self.system.email_processor.analyze_email_streaming(
+            email_data['subject'], email_data['body'], on_partial
+        )
+
+    def _analyzers_done(self) -> bool:
+        with self._analyzers_lock:
+            return self._analyzers_running == 0
+
+    def _persist_loop(self) -> None:
+        pending = []
+        deadline = None
+        while True:
+            finished = self._analyzers_done() and self.persist_queue.empty()
+            if not finished:
+                timeout = _POLL_SECONDS if deadline is None else max(0.0, min(_POLL_SECONDS, deadline - time.monotonic()))
+                batch = self._take_batch(self.persist_queue, self.persist_batch_size - len(pending), timeout)
+                if batch and deadline is None:
+                    deadline = time.monotonic() + self.persist_interval
+                pending += batch
+            due = pending and (len(pending) >= self.persist_batch_size or finished
+                               or time.monotonic() >= deadline)
+            if due:
+                if self._persist(pending):
+                    pending, deadline = [], None
+                elif not finished:
+                    time.sleep(PERSIST_RETRY_SECONDS)
+                else:
+                    logger.error(f"Giving up on {len(pending)} unsaved result(s); they will be fetched again")
+                    return
+            if finished and not pending:
+                return
+
+    def _persist(self, items: List) -> bool:
+        results = [result for _, result in items]
+        try:
+            self.system.save_results(results)
+        except Exception:
+            # save_results already logged the error; the batch stays pending and is retried
+            return False
+        self.source.done(email_data for email_data, _ in items)
+        now = time.time()
+        for email_data, result in items:
+            if "fetched_at" in email_data:
+                PROCESSING_LAG.observe(now - email_data["fetched_at"])
+            if result['priority'].lower() == 'high':
+                self._alert(email_data, result)
+        return True
@@ -0,0 +1,61 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# HTTP statuses worth retrying: quota exhaustion and transient server errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a request is allowed under the quota."""
+
+    def __init__(self, rate_per_second: float, capacity: float = 1.0):
+        self.rate = rate_per_second
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def is_retryable_error(error: Exception) -> bool:
+    """True for 429/5xx API errors (google.api_core exceptions carry the HTTP status in .code)."""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    return type(error).__name__ in {
+        "TooManyRequests", "ResourceExhausted", "InternalServerError",
+        "ServiceUnavailable", "GatewayTimeout", "DeadlineExceeded",
+    }
+
+def call_with_backoff(func: Callable[[], T], max_retries: int = 5, base_delay: float = 1.0,
+                      max_delay: float = 60.0) -> T:
+    """Call func, retrying retryable errors with full-jitter exponential backoff."""
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_error(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            attempt += 1
+            logger.warning(f"Retryable API error ({str(e)}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
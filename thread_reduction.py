@@ -0,0 +1,117 @@
+import math
+import re
+from typing import Dict, Tuple
+
+# Header lines that open a forwarded message; the forwarded content below them is kept
+_FORWARD_MARKER = re.compile(
+    r"-{3,}\s*Forwarded message\s*-{3,}|Begin forwarded message:|-{3,}\s*Forwarded by",
+    re.IGNORECASE
+)
+# Markers that open quoted history in a reply; everything from them on is dropped
+_REPLY_MARKERS = [
+    # "On <date>, <name> <address> wrote:" on its own line (clients wrap it onto a second one);
+    # the date or address keeps an ordinary sentence with "on ... wrote:" from matching
+    re.compile(
+        r"^[ \t]*On (?=[^\n]{0,200}?(?:\d|@|\b(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug"
+        r"|Sep|Oct|Nov|Dec)))[^\n]{0,200}?(?:\n[^\n]{0,200}?)?\bwrote:",
+        re.MULTILINE
+    ),
+    re.compile(r"-{3,}\s*Original Message\s*-{3,}", re.IGNORECASE),
+    re.compile(r"(?:^|\s)From:[^\n]{0,200}?\s(?:Sent|Date):[^\n]{0,200}?\sTo:", re.IGNORECASE),
+    re.compile(r"^\s*>", re.MULTILINE),
+]
+# Header fields at the top of a forwarded message
+_FORWARD_HEADER_FIELD = re.compile(r"\s*(From|Date|Sent|Subject|To|Cc):\s*", re.IGNORECASE)
+# A field value ends at a line break or at the run of spaces left by a joined blank line
+_FIELD_VALUE_END = re.compile(r"\n|\s{2,}")
+
+_SIGNATURE_MARKERS = [
+    re.compile(r"^--\s*$", re.MULTILINE),
+    re.compile(r"\bSent from my (?:iPhone|iPad|Android|mobile|Samsung|Galaxy)[^\n]*", re.IGNORECASE),
+]
+# A line holding only a sign-off; the name line after it is kept, the rest of the block dropped
+_SIGN_OFF = re.compile(
+    r"^[ \t]*(?:Thanks|Thank you|Regards|Best regards|Kind regards|Warm regards|Sincerely|Cheers|Best)"
+    r"\b[,!.]?[ \t]*\n[ \t]*[^\n]+",
+    re.IGNORECASE | re.MULTILINE
+)
+# Only treat what follows a sign-off as a signature block when it is this short
+_SIGNATURE_MAX_CHARS = 300
+_LEGAL_FOOTER = re.compile(
+    r"CONFIDENTIALITY NOTICE|DISCLAIMER:|This (?:e-?mail|message)(?: and any (?:files|attachments)[^.]{0,40})? "
+    r"(?:is|are|may be) (?:confidential|intended (?:only|solely))",
+    re.IGNORECASE
+)
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count (~4 characters per token)."""
+    return math.ceil(len(text) / 4)
+
+def _strip_forward_header(text: str) -> str:
+    """Drop the From/Date/Subject/To block at the top of forwarded content."""
+    position = 0
+    while True:
+        field = _FORWARD_HEADER_FIELD.match(text, position)
+        if not field:
+            return text[position:]
+        # Single-line bodies have no line breaks, so the next field label also ends a value
+        ends = [match for match in (_FIELD_VALUE_END.search(text, field.end()),
+                                    _FORWARD_HEADER_FIELD.search(text, field.end())) if match]
+        if not ends:
+            return ""
+        end = min(ends, key=lambda match: match.start())
+        position = end.start() if end.re is _FORWARD_HEADER_FIELD else end.end()
+
+def _cut_at_first(text: str, patterns) -> str:
+    cut = len(text)
+    for pattern in patterns:
+        match = pattern.search(text)
+        if match:
+            cut = min(cut, match.start())
+    return text[:cut]
+
+def _strip_signature_block(text: str) -> str:
+    """Keep a trailing sign-off and the name under it, drop titles/phone numbers after that."""
+    for match in _SIGN_OFF.finditer(text):
+        if len(text) - match.end() <= _SIGNATURE_MAX_CHARS:
+            return text[:match.end()]
+    return text
+
+def reduce_thread(text: str) -> Tuple[str, Dict[str, int]]:
+    """
+    Keep only the newest authored content of an email body.
+
+    Quoted reply history, signatures and legal footers are removed; for forwards the
+    forwarder's note is kept together with the forwarded message minus its header block.
+    Returns the reduced text and token statistics for it.
+    """
+    if not isinstance(text, str):
+        text = ""
+    original = text
+
+    forward = _FORWARD_MARKER.search(text)
+    if forward:
+        note = _cut_at_first(text[:forward.start()], _REPLY_MARKERS)
+        forwarded = _strip_forward_header(text[forward.end():])
+        forwarded = _cut_at_first(forwarded, _REPLY_MARKERS + [_FORWARD_MARKER])
+        text = f"{note.strip()}\n{forwarded.strip()}".strip()
+    else:
+        text = _cut_at_first(text, _REPLY_MARKERS)
+
+    text = _cut_at_first(text, _SIGNATURE_MARKERS)
+    footer = _LEGAL_FOOTER.search(text)
+    if footer and footer.start() > 0:
+        text = text[:footer.start()]
+    text = _strip_signature_block(text).strip()
+
+    # Never hand the model an empty body because everything looked like quoting
+    if not text:
+        text = original.strip()
+
+    original_tokens = estimate_tokens(original)
+    reduced_tokens = estimate_tokens(text)
+    return text, {
+        "original_tokens": original_tokens,
+        "reduced_tokens": reduced_tokens,
+        "saved_tokens": original_tokens - reduced_tokens
+    }